@@ -0,0 +1,27 @@
+"""Add external storage columns to query_results.
+
+Revision ID: 3f1c8a2b7d90
+Revises: e5c7a4e2df4d
+Create Date: 2026-10-17 10:12:41.183522
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '3f1c8a2b7d90'
+down_revision = 'e5c7a4e2df4d'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('query_results', sa.Column('data_key', sa.String(length=255), nullable=True))
+    op.add_column('query_results', sa.Column('data_hash', sa.String(length=64), nullable=True))
+    op.add_column('query_results', sa.Column('data_size', sa.Integer(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('query_results', 'data_size')
+    op.drop_column('query_results', 'data_hash')
+    op.drop_column('query_results', 'data_key')
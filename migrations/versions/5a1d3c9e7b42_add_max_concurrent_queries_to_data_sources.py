@@ -0,0 +1,23 @@
+"""Add max_concurrent_queries to data_sources.
+
+Revision ID: 5a1d3c9e7b42
+Revises: 8c2f4b1e6a37
+Create Date: 2026-10-17 15:12:44.730118
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '5a1d3c9e7b42'
+down_revision = '8c2f4b1e6a37'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('data_sources', sa.Column('max_concurrent_queries', sa.Integer(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('data_sources', 'max_concurrent_queries')
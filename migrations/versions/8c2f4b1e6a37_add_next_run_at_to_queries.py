@@ -0,0 +1,27 @@
+"""Add next_run_at to queries.
+
+Revision ID: 8c2f4b1e6a37
+Revises: 3f1c8a2b7d90
+Create Date: 2026-10-17 13:40:02.518204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '8c2f4b1e6a37'
+down_revision = '3f1c8a2b7d90'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('queries', sa.Column('next_run_at', sa.DateTime(timezone=True), nullable=True))
+    op.create_index('ix_queries_next_run_at', 'queries', ['next_run_at'], unique=False)
+    # Scheduled queries are due for the next refresh, which works out when they actually run next.
+    op.execute("UPDATE queries SET next_run_at = now() WHERE schedule IS NOT NULL")
+
+
+def downgrade():
+    op.drop_index('ix_queries_next_run_at', table_name='queries')
+    op.drop_column('queries', 'next_run_at')
@@ -1,11 +1,15 @@
+from __future__ import print_function
 import time
 
 import sqlalchemy
+from click import option
 from flask.cli import AppGroup
 from flask_migrate import stamp
 import sqlalchemy
 from sqlalchemy.exc import DatabaseError
 
+from redash import settings
+
 manager = AppGroup(help="Manage the database (create/drop tables).")
 
 
@@ -42,3 +46,45 @@ def drop_tables():
 
     _wait_for_db_connection(db)
     db.drop_all()
+
+
+@manager.command()
+@option('--chunk-size', default=100, help="Number of query results to compress in each transaction.")
+def compress_query_results(chunk_size):
+    """Compress the stored query results that are above the compression threshold."""
+    from redash.models import db, QueryResult
+    from redash.utils.query_results import COMPRESSED_PREFIX
+
+    _wait_for_db_connection(db)
+
+    last_id = 0
+    total_count = 0
+    original_size = 0
+    compressed_size = 0
+
+    while True:
+        query_result_ids = [row[0] for row in db.session.query(QueryResult.id).filter(
+            QueryResult.id > last_id,
+            sqlalchemy.func.length(QueryResult.data) >= settings.QUERY_RESULTS_COMPRESSION_THRESHOLD,
+            ~QueryResult.data.startswith(COMPRESSED_PREFIX)
+        ).order_by(QueryResult.id).limit(chunk_size)]
+
+        if not query_result_ids:
+            break
+
+        for query_result_id in query_result_ids:
+            query_result = QueryResult.query.get(query_result_id)
+            original_size += len(query_result.data)
+            query_result.data = QueryResult.compress_data(query_result.data)
+            compressed_size += len(query_result.data)
+        db.session.commit()
+
+        last_id = query_result_ids[-1]
+        total_count += len(query_result_ids)
+        print("Compressed {} query results (up to id {}).".format(total_count, last_id))
+
+    if total_count:
+        print("Done: {} -> {} bytes (ratio {:.2f}).".format(original_size, compressed_size,
+                                                            float(original_size) / compressed_size))
+    else:
+        print("No query results to compress.")
@@ -1,4 +1,4 @@
-from click import argument
+from click import argument, option
 from flask.cli import AppGroup
 from sqlalchemy.orm.exc import NoResultFound
 
@@ -62,3 +62,21 @@ def remove_tag(query_id, tag):
     models.db.session.commit()
 
     print("Tag removed.")
+
+
+@manager.command()
+@option('--minutes', default=120, help="How many minutes ahead to report (default: 120).")
+@option('--jitter-window', type=int, default=None,
+        help="Report the load with this jitter window (in seconds) instead of the configured one.")
+def schedule_report(minutes, jitter_window):
+    """Show how many scheduled queries are expected to be enqueued in each of the next minutes."""
+    from redash.monitor import get_schedule_load
+
+    load = get_schedule_load(minutes, jitter_window)
+    peak = max(count for _, count in load) if load else 0
+
+    for minute, count in load:
+        bar = '#' * int(round(50.0 * count / peak)) if peak else ''
+        print("{} {:6d} {}".format(minute.strftime('%Y-%m-%d %H:%M'), count, bar))
+
+    print("Total: {}, peak: {} per minute.".format(sum(count for _, count in load), peak))
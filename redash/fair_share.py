@@ -0,0 +1,221 @@
+"""
+Fair share dispatching of adhoc queries across organizations.
+
+Instead of going straight to the Celery queue, jobs are added to a queue of their organization. Jobs are then
+dispatched (sent to Celery) from the organizations with pending jobs in turns, skipping organizations that already
+have their quota of jobs dispatched (queued in Celery or running). A job stops counting against the quota when it
+finishes; jobs that never report back (e.g. their worker was killed) stop counting when their lease runs out: their
+time limit plus DISPATCH_LEASE_MARGIN once dispatched (settings.JOB_EXPIRY_TIME without a time limit), renewed when
+they start running.
+
+All the state is kept in Redis, under the `fair_share:` prefix:
+
+* `fair_share:pending:<org id>`: list of the ids of the organization's pending jobs.
+* `fair_share:jobs`: hash of the pending jobs (job id -> JSON with the Celery task arguments).
+* `fair_share:orgs`: sorted set of the organizations with pending jobs, scored by their turn.
+* `fair_share:running:<org id>` and `fair_share:dispatched`: sorted sets of the dispatched jobs (of the organization
+  and overall), scored by when they stop counting.
+* `fair_share:quotas`: hash of the quota of each organization (org id -> quota, 0 for no limit).
+* `fair_share:waits:<org id>`: list of the latest wait times (seconds) of the organization's jobs.
+"""
+import math
+import time
+
+from redash import redis_connection, settings, statsd_client
+from redash.utils import json_dumps, json_loads
+
+KEY_PREFIX = 'fair_share:'
+PENDING_ORGS_KEY = KEY_PREFIX + 'orgs'
+TURN_KEY = KEY_PREFIX + 'turn'
+QUOTAS_KEY = KEY_PREFIX + 'quotas'
+JOBS_KEY = KEY_PREFIX + 'jobs'
+DISPATCHED_KEY = KEY_PREFIX + 'dispatched'
+
+# How long a dispatched job can wait in its Celery queue before it starts running, when it counts against the quota of
+# its organization for its time limit plus this.
+DISPATCH_LEASE_MARGIN = 10 * 60
+
+WAIT_SAMPLES = 1000
+WAIT_SAMPLES_EXPIRY = 24 * 3600
+
+
+def _pending_key(org_id):
+    return '{}pending:{}'.format(KEY_PREFIX, org_id)
+
+
+def _running_key(org_id):
+    return '{}running:{}'.format(KEY_PREFIX, org_id)
+
+
+def _waits_key(org_id):
+    return '{}waits:{}'.format(KEY_PREFIX, org_id)
+
+
+# KEYS[1]: the organization's pending jobs; KEYS[2]: organizations with pending jobs; KEYS[3]: turn counter;
+# KEYS[4]: quotas; KEYS[5]: pending job descriptions.
+# ARGV[1]: org id; ARGV[2]: job id; ARGV[3]: job description; ARGV[4]: quota.
+#
+# Organizations that had no pending jobs take the current turn, so they're served after the ones already waiting.
+PUSH_JOB_SCRIPT = """
+redis.call('RPUSH', KEYS[1], ARGV[2])
+redis.call('HSET', KEYS[5], ARGV[2], ARGV[3])
+redis.call('HSET', KEYS[4], ARGV[1], ARGV[4])
+if not redis.call('ZSCORE', KEYS[2], ARGV[1]) then
+    redis.call('ZADD', KEYS[2], tonumber(redis.call('GET', KEYS[3]) or 0), ARGV[1])
+end
+"""
+
+# KEYS[1]: organizations with pending jobs; KEYS[2]: turn counter; KEYS[3]: quotas; KEYS[4]: pending job descriptions;
+# KEYS[5]: all dispatched jobs.
+# ARGV[1]: key prefix (of the per organization keys); ARGV[2]: current time; ARGV[3]: lease of dispatched jobs without
+# a time limit; ARGV[4]: maximum number of dispatched jobs (0 for no limit); ARGV[5]: lease margin of jobs with a time
+# limit (`soft_time_limit` of their description).
+#
+# Returns {org id, job description} of the next job to dispatch, or nil when there is none (or all organizations with
+# pending jobs are over their quota). The organization of the job goes to the end of the line.
+TAKE_JOB_SCRIPT = """
+local now = tonumber(ARGV[2])
+local max_dispatched = tonumber(ARGV[4])
+
+redis.call('ZREMRANGEBYSCORE', KEYS[5], '-inf', now)
+if max_dispatched > 0 and redis.call('ZCARD', KEYS[5]) >= max_dispatched then
+    return nil
+end
+
+for _, org_id in ipairs(redis.call('ZRANGE', KEYS[1], 0, -1)) do
+    local pending_key = ARGV[1] .. 'pending:' .. org_id
+    local running_key = ARGV[1] .. 'running:' .. org_id
+    redis.call('ZREMRANGEBYSCORE', running_key, '-inf', now)
+
+    local quota = tonumber(redis.call('HGET', KEYS[3], org_id) or 0)
+    if quota <= 0 or redis.call('ZCARD', running_key) < quota then
+        local job_id = redis.call('LPOP', pending_key)
+        local job = job_id and redis.call('HGET', KEYS[4], job_id)
+        if job then
+            local soft_time_limit = cjson.decode(job)['soft_time_limit']
+            local expires_at = now + tonumber(ARGV[3])
+            if type(soft_time_limit) == 'number' then
+                expires_at = now + soft_time_limit + tonumber(ARGV[5])
+            end
+            redis.call('HDEL', KEYS[4], job_id)
+            redis.call('ZADD', running_key, expires_at, job_id)
+            redis.call('ZADD', KEYS[5], expires_at, job_id)
+        end
+
+        if redis.call('LLEN', pending_key) > 0 then
+            redis.call('ZADD', KEYS[1], redis.call('INCR', KEYS[2]), org_id)
+        else
+            redis.call('ZREM', KEYS[1], org_id)
+        end
+
+        if job then
+            return {org_id, job}
+        end
+    end
+end
+
+return nil
+"""
+
+_push_job_script = redis_connection.register_script(PUSH_JOB_SCRIPT)
+_take_job_script = redis_connection.register_script(TAKE_JOB_SCRIPT)
+
+
+def push_job(org_id, job_id, quota, **job):
+    """Adds a job to the queue of its organization. `job` holds the arguments to dispatch it with."""
+    job['job_id'] = job_id
+    job['org_id'] = org_id
+    job['enqueued_at'] = time.time()
+    _push_job_script(keys=[_pending_key(org_id), PENDING_ORGS_KEY, TURN_KEY, QUOTAS_KEY, JOBS_KEY],
+                     args=[org_id, job_id, json_dumps(job), quota])
+
+
+def take_job():
+    """Returns the next job to dispatch (as passed to push_job), counting it as dispatched, or None."""
+    taken = _take_job_script(keys=[PENDING_ORGS_KEY, TURN_KEY, QUOTAS_KEY, JOBS_KEY, DISPATCHED_KEY],
+                             args=[KEY_PREFIX, time.time(), settings.JOB_EXPIRY_TIME,
+                                   settings.QUERY_FAIR_SHARE_MAX_DISPATCHED, DISPATCH_LEASE_MARGIN])
+    if not taken:
+        return None
+
+    job = json_loads(taken[1])
+    wait = time.time() - job['enqueued_at']
+    statsd_client.timing('fair_share.wait', int(wait * 1000))
+
+    pipe = redis_connection.pipeline()
+    pipe.lpush(_waits_key(job['org_id']), '{:.3f}'.format(wait))
+    pipe.ltrim(_waits_key(job['org_id']), 0, WAIT_SAMPLES - 1)
+    pipe.expire(_waits_key(job['org_id']), WAIT_SAMPLES_EXPIRY)
+    pipe.execute()
+
+    return job
+
+
+def return_job(job):
+    """Puts back a taken job (that couldn't be dispatched) at the head of its organization's queue."""
+    org_id, job_id = job['org_id'], job['job_id']
+
+    pipe = redis_connection.pipeline()
+    pipe.zrem(_running_key(org_id), job_id)
+    pipe.zrem(DISPATCHED_KEY, job_id)
+    pipe.hset(JOBS_KEY, job_id, json_dumps(job))
+    pipe.lpush(_pending_key(org_id), job_id)
+    # Its turn was already taken, so it goes first.
+    pipe.zadd(PENDING_ORGS_KEY, {org_id: -1})
+    pipe.execute()
+
+
+def renew_job(org_id, job_id, lease):
+    """Keeps a running job counting against its organization's quota for `lease` seconds from now."""
+    expires_at = time.time() + lease
+
+    pipe = redis_connection.pipeline()
+    pipe.zadd(_running_key(org_id), {job_id: expires_at})
+    pipe.zadd(DISPATCHED_KEY, {job_id: expires_at})
+    pipe.execute()
+
+
+def release_job(org_id, job_id):
+    """Stops counting a finished job against its organization's quota."""
+    pipe = redis_connection.pipeline()
+    pipe.zrem(_running_key(org_id), job_id)
+    pipe.zrem(DISPATCHED_KEY, job_id)
+    pipe.execute()
+
+
+def _percentile(values, percent):
+    """Nearest-rank percentile of sorted values."""
+    if not values:
+        return None
+
+    rank = int(math.ceil(percent / 100.0 * len(values)))
+    return values[max(rank, 1) - 1]
+
+
+def get_status():
+    """Returns the pending and dispatched jobs of each organization, along with percentiles of their wait times."""
+    now = time.time()
+    orgs = []
+
+    for org_id, quota in sorted(redis_connection.hgetall(QUOTAS_KEY).items(), key=lambda item: int(item[0])):
+        pipe = redis_connection.pipeline()
+        pipe.llen(_pending_key(org_id))
+        pipe.zcount(_running_key(org_id), now, '+inf')
+        pipe.lrange(_waits_key(org_id), 0, -1)
+        pending, dispatched, waits = pipe.execute()
+
+        waits = sorted(float(wait) for wait in waits)
+        orgs.append({
+            'org_id': int(org_id),
+            'quota': int(quota),
+            'pending': pending,
+            'dispatched': dispatched,
+            'wait_p50': _percentile(waits, 50),
+            'wait_p90': _percentile(waits, 90),
+            'wait_p99': _percentile(waits, 99),
+        })
+
+    return {
+        'dispatched': redis_connection.zcount(DISPATCHED_KEY, now, '+inf'),
+        'orgs': orgs
+    }
@@ -16,6 +16,21 @@ from redash.utils import filter_none
 from redash.utils.configuration import ConfigurationContainer, ValidationError
 
 
+def parse_max_concurrent_queries(value):
+    if value is None or value == '':
+        return None
+
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        abort(400, message="max_concurrent_queries should be a number.")
+
+    if value < 0:
+        abort(400, message="max_concurrent_queries can't be negative.")
+
+    return value or None
+
+
 class DataSourceTypeListResource(BaseResource):
     @require_admin
     def get(self):
@@ -51,6 +66,8 @@ class DataSourceResource(BaseResource):
 
         data_source.type = req['type']
         data_source.name = req['name']
+        if 'max_concurrent_queries' in req:
+            data_source.max_concurrent_queries = parse_max_concurrent_queries(req['max_concurrent_queries'])
         models.db.session.add(data_source)
 
         try:
@@ -130,7 +147,9 @@ class DataSourceListResource(BaseResource):
             datasource = models.DataSource.create_with_group(org=self.current_org,
                                                              name=req['name'],
                                                              type=req['type'],
-                                                             options=config)
+                                                             options=config,
+                                                             max_concurrent_queries=parse_max_concurrent_queries(
+                                                                 req.get('max_concurrent_queries')))
 
             models.db.session.commit()
         except IntegrityError as e:
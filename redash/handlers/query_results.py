@@ -1,19 +1,23 @@
+import hashlib
 import logging
+import tempfile
 import time
 
-from flask import make_response, request
+from flask import make_response, request, send_file, Response
 from flask_login import current_user
 from flask_restful import abort
-from redash import models, settings
+from redash import models, query_result_cache, settings
 from redash.handlers.base import BaseResource, get_object_or_404, record_event
 from redash.permissions import (has_access, not_view_only, require_access,
                                 require_permission, view_only)
 from redash.tasks import QueryTask
 from redash.tasks.queries import enqueue_query
 from redash.utils import (collect_parameters_from_request, gen_query_hash, json_dumps, utcnow, to_filename)
+from redash.utils.query_results import ColumnNotFound
 from redash.models.parameterized_query import (ParameterizedQuery, InvalidParameterError,
                                                QueryDetachedFromDataSourceError, dropdown_values)
-from redash.serializers import serialize_query_result, serialize_query_result_to_csv, serialize_query_result_to_xlsx
+from redash.serializers import (arrow_enabled, serialize_query_result_to_json, stream_query_result_to_arrow,
+                                stream_query_result_to_csv, write_query_result_to_xlsx)
 
 from redash.varanus import can_query_securely, has_parameter, header2dict, ALLOW_HEADER_PARAMETERS
 
@@ -101,7 +105,8 @@ def run_query(query, parameters, data_source, query_id, max_age=0):
     if max_age == 0:
         query_result = None
     else:
-        query_result = models.QueryResult.get_latest(data_source, query.text, max_age)
+        query_result = models.QueryResult.get_latest(data_source, query.text, max_age,
+                                                     with_data=not query_result_cache.enabled())
 
     record_event(current_user.org, current_user, {
         'action': 'execute_query',
@@ -114,7 +119,8 @@ def run_query(query, parameters, data_source, query_id, max_age=0):
     })
 
     if query_result:
-        return {'query_result': serialize_query_result(query_result, current_user.is_api_user())}
+        return make_response(serialize_query_result_to_json(query_result, current_user.is_api_user()), 200,
+                             {'Content-Type': "application/json"})
     else:
         job = enqueue_query(query.text, data_source, current_user.id, metadata={
             "Username": repr(current_user) if current_user.is_api_user() else current_user.email,
@@ -123,6 +129,23 @@ def run_query(query, parameters, data_source, query_id, max_age=0):
         return {'job': job.to_dict()}
 
 
+def get_page_parameters(args):
+    """Parses the offset, limit and columns parameters of a query result request (None if none of them is given)."""
+    if not any(name in args for name in ('offset', 'limit', 'columns')):
+        return None
+
+    try:
+        offset = int(args.get('offset', 0))
+        limit = int(args['limit']) if 'limit' in args else None
+    except ValueError:
+        abort(400, message='offset and limit should be numbers.')
+
+    if offset < 0 or (limit is not None and limit < 0):
+        abort(400, message="offset and limit can't be negative.")
+
+    return {'offset': offset, 'limit': limit, 'columns': args.getlist('columns') or None}
+
+
 def get_download_filename(query_result, query, filetype):
     retrieved_at = query_result.retrieved_at.strftime("%Y_%m_%d")
     if query:
@@ -267,12 +290,17 @@ class QueryResultResource(BaseResource):
 
         :param number query_id: The ID of the query whose results should be fetched
         :param number query_result_id: the ID of the query result to fetch
-        :param string filetype: Format to return. One of 'json', 'xlsx', or 'csv'. Defaults to 'json'.
+        :param string filetype: Format to return. One of 'json', 'xlsx', 'csv', 'arrow' (Arrow IPC stream) or 'parquet'.
+                                Defaults to 'json'. Arrow and Parquet require pyarrow to be installed.
+        :qparam number offset: Return rows starting from this one (JSON only).
+        :qparam number limit: Return at most this many rows (JSON only).
+        :qparam string columns: Return only these columns, in this order; can be repeated (JSON only).
 
         :<json number id: Query result ID
         :<json string query: Query that produced this result
         :<json string query_hash: Hash code for query text
         :<json object data: Query output
+        :<json number data.total_rows: Total number of rows, when offset, limit or columns are given
         :<json number data_source_id: ID of data source that produced this result
         :<json number runtime: Length of execution time in seconds
         :<json string retrieved_at: Query retrieval date/time, in ISO format
@@ -290,9 +318,13 @@ class QueryResultResource(BaseResource):
 
         query_result = None
         query = None
+        # Conditional requests are likely answered with a 304, and JSON responses might be served from the cache, both
+        # without the data.
+        with_data = not request.if_none_match and (filetype != 'json' or not query_result_cache.enabled())
 
         if query_result_id:
-            query_result = get_object_or_404(models.QueryResult.get_by_id_and_org, query_result_id, self.current_org)
+            query_result = get_object_or_404(models.QueryResult.get_by_id_and_org, query_result_id, self.current_org,
+                                             with_data=with_data)
 
         if query_id is not None:
             query = get_object_or_404(models.Query.get_by_id_and_org, query_id, self.current_org)
@@ -301,7 +333,8 @@ class QueryResultResource(BaseResource):
                 if settings.ALLOW_PARAMETERS_IN_EMBEDS and has_parameter(query.query_text):
                     query_result = run_query_sync(query.data_source, parameter_values, query.query_text, max_age=max_age)
                 elif query.latest_query_data_id is not None:
-                    query_result = get_object_or_404(models.QueryResult.get_by_id_and_org, query.latest_query_data_id, self.current_org)
+                    query_result = get_object_or_404(models.QueryResult.get_by_id_and_org, query.latest_query_data_id, self.current_org,
+                                                     with_data=with_data)
 
             if query is not None and query_result is not None and self.current_user.is_api_user():
                 if query.query_hash != query_result.query_hash:
@@ -330,13 +363,26 @@ class QueryResultResource(BaseResource):
 
                 self.record_event(event)
 
-            if filetype == 'json':
-                response = self.make_json_response(query_result)
+            page = get_page_parameters(request.args) if filetype == 'json' else None
+
+            # Query results never change, so the result id and format (and page) identify the response.
+            etag = '{}.{}'.format(query_result.id, filetype)
+            if page is not None:
+                etag += '.' + hashlib.md5(json_dumps(page, sort_keys=True).encode('utf-8')).hexdigest()
+
+            if request.if_none_match.contains(etag):
+                response = make_response('', 304)
+            elif filetype == 'json':
+                response = self.make_json_response(query_result, page)
             elif filetype == 'xlsx':
                 response = self.make_excel_response(query_result)
+            elif filetype in ('arrow', 'parquet'):
+                response = self.make_arrow_response(query_result, filetype)
             else:
                 response = self.make_csv_response(query_result)
 
+            response.set_etag(etag)
+
             if len(settings.ACCESS_CONTROL_ALLOW_ORIGIN) > 0:
                 self.add_cors_headers(response.headers)
 
@@ -355,20 +401,52 @@ class QueryResultResource(BaseResource):
         else:
             abort(404, message='No cached result found for this query.')
 
-    def make_json_response(self, query_result):
-        data = json_dumps({'query_result': query_result.to_dict()})
+    def make_json_response(self, query_result, page=None):
+        if page is None:
+            data = serialize_query_result_to_json(query_result)
+        else:
+            try:
+                data = json_dumps({'query_result': query_result.to_dict(page)})
+            except ColumnNotFound as e:
+                abort(400, message=e.message)
         headers = {'Content-Type': "application/json"}
         return make_response(data, 200, headers)
 
     @staticmethod
     def make_csv_response(query_result):
         headers = {'Content-Type': "text/csv; charset=UTF-8"}
-        return make_response(serialize_query_result_to_csv(query_result), 200, headers)
+        return Response(stream_query_result_to_csv(query_result), 200, headers)
+
+    @staticmethod
+    def make_arrow_response(query_result, filetype):
+        if not arrow_enabled:
+            abort(400, message='Arrow and Parquet downloads are not available (pyarrow is not installed).')
+
+        if filetype == 'parquet':
+            headers = {'Content-Type': "application/octet-stream"}
+        else:
+            headers = {'Content-Type': "application/vnd.apache.arrow.stream"}
+        return Response(stream_query_result_to_arrow(query_result, filetype), 200, headers)
 
     @staticmethod
     def make_excel_response(query_result):
-        headers = {'Content-Type': "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"}
-        return make_response(serialize_query_result_to_xlsx(query_result), 200, headers)
+        f = tempfile.TemporaryFile()
+        try:
+            write_query_result_to_xlsx(query_result, f)
+            size = f.tell()
+            f.seek(0)
+        except Exception:
+            f.close()
+            raise
+
+        # The file is closed (and so removed) once the response is sent.
+        response = send_file(f, mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+                             add_etags=False)
+        response.headers['Content-Length'] = size
+        # Caching headers are set by the resource, like for the other formats.
+        response.headers.remove('Cache-Control')
+        response.headers.remove('Expires')
+        return response
 
 
 class JobResource(BaseResource):
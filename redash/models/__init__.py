@@ -1,29 +1,33 @@
 import datetime
 import calendar
 import logging
+import math
 import time
 import pytz
 
-from six import python_2_unicode_compatible, text_type
-from sqlalchemy import distinct, or_, and_, UniqueConstraint
+from six import python_2_unicode_compatible, string_types, text_type
+from sqlalchemy import cast, distinct, or_, and_, UniqueConstraint
 from sqlalchemy.dialects import postgresql
 from sqlalchemy.event import listens_for
 from sqlalchemy.ext.hybrid import hybrid_property
-from sqlalchemy.orm import backref, contains_eager, joinedload, subqueryload, load_only
+from sqlalchemy.orm import backref, contains_eager, defer, joinedload, subqueryload, load_only
 from sqlalchemy.orm.exc import NoResultFound  # noqa: F401
+from sqlalchemy.orm.util import identity_key
 from sqlalchemy import func
 from sqlalchemy_utils import generic_relationship
 from sqlalchemy_utils.types import TSVectorType
 from sqlalchemy_utils.models import generic_repr
 from sqlalchemy_utils.types.encrypted.encrypted_type import FernetEngine
 
-from redash import redis_connection, utils, settings
+from redash import redis_connection, result_storage, statsd_client, utils, settings
 from redash.destinations import (get_configuration_schema_for_destination_type,
                                  get_destination)
 from redash.metrics import database  # noqa: F401
 from redash.query_runner import (get_configuration_schema_for_query_runner_type,
                                  get_query_runner, TYPE_BOOLEAN, TYPE_DATE, TYPE_DATETIME)
 from redash.utils import generate_token, json_dumps, json_loads, mustache_render
+from redash.utils.query_results import (ResultWriter, compact_result, compress_result, decode_result,
+                                        decompress_result, is_compressed, iter_rows, load_result_lazily, slice_result)
 from redash.utils.configuration import ConfigurationContainer
 from redash.models.parameterized_query import ParameterizedQuery
 
@@ -43,14 +47,22 @@ class ScheduledQueriesExecutions(object):
     def __init__(self):
         self.executions = {}
 
-    def refresh(self):
-        self.executions = redis_connection.hgetall(self.KEY_NAME)
+    def refresh(self, query_ids=None):
+        if query_ids is None:
+            self.executions = redis_connection.hgetall(self.KEY_NAME)
+        elif query_ids:
+            self.executions = dict(zip(map(str, query_ids), redis_connection.hmget(self.KEY_NAME, query_ids)))
+        else:
+            self.executions = {}
 
     def update(self, query_id):
+        executed_at = time.time()
         redis_connection.hmset(self.KEY_NAME, {
-            query_id: time.time()
+            query_id: executed_at
         })
 
+        return utils.dt_from_timestamp(executed_at)
+
     def get(self, query_id):
         timestamp = self.executions.get(str(query_id))
         if timestamp:
@@ -62,6 +74,29 @@ class ScheduledQueriesExecutions(object):
 scheduled_queries_executions = ScheduledQueriesExecutions()
 
 
+# Takes one of the query slots of a data source, or marks the job as waiting for one:
+#
+# KEYS[1]: the jobs holding a slot; KEYS[2]: the jobs waiting for one. Both are sorted sets of job ids, scored by when
+# the entry expires, so the slots of jobs that never released them (e.g. their worker was killed) are reclaimed.
+# ARGV[1]: job id; ARGV[2]: number of slots; ARGV[3]: current time; ARGV[4]: slot lease; ARGV[5]: waiting lease.
+#
+# Returns 1 when the slot was taken (or the job already holds one), 0 otherwise.
+ACQUIRE_QUERY_SLOT_SCRIPT = """
+local now = tonumber(ARGV[3])
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now)
+redis.call('ZREMRANGEBYSCORE', KEYS[2], '-inf', now)
+if redis.call('ZSCORE', KEYS[1], ARGV[1]) or redis.call('ZCARD', KEYS[1]) < tonumber(ARGV[2]) then
+    redis.call('ZADD', KEYS[1], now + tonumber(ARGV[4]), ARGV[1])
+    redis.call('ZREM', KEYS[2], ARGV[1])
+    return 1
+end
+redis.call('ZADD', KEYS[2], now + tonumber(ARGV[5]), ARGV[1])
+return 0
+"""
+
+_acquire_query_slot_script = redis_connection.register_script(ACQUIRE_QUERY_SLOT_SCRIPT)
+
+
 @python_2_unicode_compatible
 @generic_repr('id', 'name', 'type', 'org_id', 'created_at')
 class DataSource(BelongsToOrgMixin, db.Model):
@@ -74,6 +109,8 @@ class DataSource(BelongsToOrgMixin, db.Model):
     options = Column('encrypted_options', ConfigurationContainer.as_mutable(EncryptedConfiguration(db.Text, settings.DATASOURCE_SECRET_KEY, FernetEngine)))
     queue_name = Column(db.String(255), default="queries")
     scheduled_queue_name = Column(db.String(255), default="scheduled_queries")
+    # Maximum number of queries executing against the data source at once (None for no limit).
+    max_concurrent_queries = Column(db.Integer, nullable=True)
     created_at = Column(db.DateTime(True), default=db.func.now())
 
     data_source_groups = db.relationship("DataSourceGroup", back_populates="data_source",
@@ -100,6 +137,7 @@ class DataSource(BelongsToOrgMixin, db.Model):
             d['options'] = self.options.to_dict(mask_secrets=True)
             d['queue_name'] = self.queue_name
             d['scheduled_queue_name'] = self.scheduled_queue_name
+            d['max_concurrent_queries'] = self.max_concurrent_queries
             d['groups'] = self.groups
 
         if with_permissions_for is not None:
@@ -137,11 +175,14 @@ class DataSource(BelongsToOrgMixin, db.Model):
 
     def delete(self):
         Query.query.filter(Query.data_source == self).update(dict(data_source_id=None, latest_query_data_id=None))
+        data_keys = QueryResult.external_data_keys(QueryResult.data_source == self)
         QueryResult.query.filter(QueryResult.data_source == self).delete()
         res = db.session.delete(self)
         db.session.commit()
 
-        redis_connection.delete(self._schema_key)
+        result_storage.delete_results(data_keys)
+
+        redis_connection.delete(self._schema_key, self._in_flight_key, self._waiting_key)
 
         return res
 
@@ -182,6 +223,37 @@ class DataSource(BelongsToOrgMixin, db.Model):
     def resume(self):
         redis_connection.delete(self._pause_key)
 
+    @property
+    def _in_flight_key(self):
+        return 'ds:{}:in_flight'.format(self.id)
+
+    @property
+    def _waiting_key(self):
+        return 'ds:{}:waiting'.format(self.id)
+
+    def acquire_query_slot(self, job_id, lease, waiting_lease):
+        """Takes a slot for the job, for at most `lease` seconds. When all of `max_concurrent_queries` slots are taken
+        the job is counted as waiting (for `waiting_lease` seconds) instead, and False is returned."""
+        if not self.max_concurrent_queries:
+            return True
+
+        acquired = _acquire_query_slot_script(keys=[self._in_flight_key, self._waiting_key],
+                                              args=[job_id, self.max_concurrent_queries, time.time(), lease,
+                                                    waiting_lease])
+        return bool(acquired)
+
+    def release_query_slot(self, job_id):
+        if self.max_concurrent_queries:
+            redis_connection.zrem(self._in_flight_key, job_id)
+
+    @property
+    def queries_in_flight(self):
+        return redis_connection.zcount(self._in_flight_key, time.time(), '+inf')
+
+    @property
+    def queries_waiting(self):
+        return redis_connection.zcount(self._waiting_key, time.time(), '+inf')
+
     def add_group(self, group, view_only=False):
         dsg = DataSourceGroup(group=group, data_source=self, view_only=view_only)
         db.session.add(dsg)
@@ -204,7 +276,7 @@ class DataSource(BelongsToOrgMixin, db.Model):
 
     @property
     def query_runner(self):
-        return get_query_runner(self.type, self.options)
+        return get_query_runner(self.type, self.options, self.id)
 
     @classmethod
     def get_by_name(cls, name):
@@ -243,6 +315,10 @@ class QueryResult(db.Model, BelongsToOrgMixin):
     query_hash = Column(db.String(32), index=True)
     query_text = Column('query', db.Text)
     data = Column(db.Text)
+    # Large results are kept in the external result storage (see redash.result_storage) instead of `data`:
+    data_key = Column(db.String(255), nullable=True)
+    data_hash = Column(db.String(64), nullable=True)
+    data_size = Column(db.Integer, nullable=True)
     runtime = Column(postgresql.DOUBLE_PRECISION)
     retrieved_at = Column(db.DateTime(True))
 
@@ -251,17 +327,74 @@ class QueryResult(db.Model, BelongsToOrgMixin):
     def __str__(self):
         return u"%d | %s | %s" % (self.id, self.query_hash, self.retrieved_at)
 
-    def to_dict(self):
+    def to_dict(self, page=None):
+        """`page` (offset, limit and columns, see `get_data_page`) returns only those rows and columns of the data."""
         return {
             'id': self.id,
             'query_hash': self.query_hash,
             'query': self.query_text,
-            'data': json_loads(self.data),
+            'data': self.get_data() if page is None else self.get_data_page(**page),
             'data_source_id': self.data_source_id,
             'runtime': self.runtime,
             'retrieved_at': self.retrieved_at
         }
 
+    @property
+    def has_data(self):
+        return self.data is not None or self.data_key is not None
+
+    def get_encoded_data(self):
+        """Returns the result as it was encoded for storage, fetching it from the external storage if needed."""
+        if self.data_key is None:
+            return self.data
+
+        with statsd_client.timer('query_results.external_storage.get'):
+            content = result_storage.get_result(self.data_key, self.data_hash)
+
+        return content.decode('utf-8')
+
+    def set_encoded_data(self, data):
+        """Sets the encoded result, moving it to the external storage if it's configured and the result is large.
+
+        `data` can also be a finished `ResultWriter`, whose file is streamed to the external storage as is; it's only
+        read into a string when it goes into the `data` column.
+        """
+        if (result_storage.get_result_storage() is not None and isinstance(data, string_types + (ResultWriter,)) and
+                len(data) >= settings.QUERY_RESULTS_STORAGE_THRESHOLD):
+            content = data.getfile() if isinstance(data, ResultWriter) else data.encode('utf-8')
+            with statsd_client.timer('query_results.external_storage.put'):
+                self.data_key, self.data_hash, self.data_size = result_storage.put_result(self.org_id, content)
+            db.session.info.setdefault(UNCOMMITTED_RESULT_KEYS, []).append(self.data_key)
+            self.data = None
+        elif isinstance(data, ResultWriter):
+            self.data = data.getvalue()
+        else:
+            self.data = data
+
+    def get_stored_data(self, lazy_rows=False):
+        """Returns the parsed result in the format it was stored in (see `redash.utils.query_results`).
+
+        With `lazy_rows`, the rows of a compact result are decoded as they're iterated over (see `load_result_lazily`).
+        """
+        data = self.get_encoded_data()
+        if is_compressed(data):
+            with statsd_client.timer('query_results.decompress'):
+                data = decompress_result(data)
+
+        if lazy_rows:
+            return load_result_lazily(data)
+
+        return json_loads(data)
+
+    def get_data(self):
+        """Returns the parsed result in the legacy `{"columns": [...], "rows": [{...}, ...]}` format."""
+        return decode_result(self.get_stored_data())
+
+    def get_data_page(self, offset=0, limit=None, columns=None):
+        """Like `get_data`, with only `limit` rows from `offset` (and the `total_rows` count). Only the rows of the
+        page are kept in memory."""
+        return slice_result(self.get_stored_data(lazy_rows=True), offset, limit, columns)
+
     @classmethod
     def unused(cls, days=7):
         age_threshold = datetime.datetime.now() - datetime.timedelta(days=days)
@@ -274,7 +407,16 @@ class QueryResult(db.Model, BelongsToOrgMixin):
         ).options(load_only('id'))
 
     @classmethod
-    def get_latest(cls, data_source, query, max_age=0):
+    def get_by_id_and_org(cls, object_id, org, with_data=True):
+        query = cls.query.filter(cls.id == object_id, cls.org == org)
+        if not with_data:
+            # Loaded on first access instead, for callers that might not need it.
+            query = query.options(defer(cls.data))
+
+        return query.one()
+
+    @classmethod
+    def get_latest(cls, data_source, query, max_age=0, with_data=True):
         query_hash = utils.gen_query_hash(query)
 
         if max_age == -1:
@@ -293,30 +435,72 @@ class QueryResult(db.Model, BelongsToOrgMixin):
                 )
             )
 
+        if not with_data:
+            query = query.options(defer(cls.data))
+
         return query.order_by(cls.retrieved_at.desc()).first()
 
+    @classmethod
+    def external_data_keys(cls, *criterion):
+        """Returns the external storage keys of the query results matching the criterion."""
+        query = db.session.query(cls.data_key).filter(cls.data_key.isnot(None), *criterion)
+        return [data_key for data_key, in query]
+
+    @staticmethod
+    def encode_data(data):
+        """Encodes a result returned by a query runner the way it should be stored, according to the settings.
+
+        Results streamed into a `ResultWriter` are already in the configured format, and are returned as is unless
+        they're compressed.
+        """
+        if settings.QUERY_RESULTS_COMPACT_FORMAT:
+            data = compact_result(data)
+
+        if (settings.QUERY_RESULTS_COMPRESSION_ENABLED and isinstance(data, string_types + (ResultWriter,)) and
+                len(data) >= settings.QUERY_RESULTS_COMPRESSION_THRESHOLD):
+            data = QueryResult.compress_data(data)
+
+        return data
+
+    @staticmethod
+    def compress_data(data):
+        with statsd_client.timer('query_results.compress'):
+            compressed = compress_result(data, settings.QUERY_RESULTS_COMPRESSION_LEVEL)
+        statsd_client.gauge('query_results.compression_ratio', float(len(data)) / len(compressed))
+
+        return compressed
+
     @classmethod
     def store_result(cls, org, data_source, query_hash, query, data, run_time, retrieved_at):
+        data = cls.encode_data(data)
+
         query_result = cls(org_id=org,
                            query_hash=query_hash,
                            query_text=query,
                            runtime=run_time,
                            data_source=data_source,
-                           retrieved_at=retrieved_at,
-                           data=data)
+                           retrieved_at=retrieved_at)
+        query_result.set_encoded_data(data)
         db.session.add(query_result)
+        db.session.flush()
         logging.info("Inserted query (%s) data; id=%s", query_hash, query_result.id)
-        # TODO: Investigate how big an impact this select-before-update makes.
-        queries = Query.query.filter(
-            Query.query_hash == query_hash,
-            Query.data_source == data_source
-        )
-        for q in queries:
-            q.latest_query_data = query_result
-            # don't auto-update the updated_at timestamp
-            q.skip_updated_at = True
-            db.session.add(q)
-        query_ids = [q.id for q in queries]
+
+        # A single UPDATE instead of loading and saving each query. Like before, it doesn't touch updated_at (which is
+        # only set by the ORM) or the version of the queries.
+        query_ids = [row[0] for row in db.session.execute(
+            Query.__table__.update()
+            .where(Query.query_hash == query_hash)
+            .where(Query.data_source_id == data_source.id)
+            .values(latest_query_data_id=query_result.id)
+            .returning(Query.id)
+        )]
+
+        # Queries already loaded in the session still point to their previous result.
+        for query_id in query_ids:
+            query = db.session.identity_map.get(identity_key(Query, query_id))
+            if query is not None:
+                db.session.expire(query, ['latest_query_data', 'latest_query_data_id'])
+
         logging.info("Updated %s queries with result (%s).", len(query_ids), query_hash)
 
         return query_result, query_ids
@@ -326,12 +510,57 @@ class QueryResult(db.Model, BelongsToOrgMixin):
         return self.data_source.groups
 
 
-def should_schedule_next(previous_iteration, now, interval, time=None, day_of_week=None, failures=0):
+# Session info key of the blobs written to the external result storage for rows that aren't committed yet.
+UNCOMMITTED_RESULT_KEYS = 'uncommitted_result_keys'
+
+
+@listens_for(db.session, 'after_commit')
+def keep_committed_result_blobs(session):
+    session.info.pop(UNCOMMITTED_RESULT_KEYS, None)
+
+
+@listens_for(db.session, 'after_transaction_end')
+def delete_uncommitted_result_blobs(session, transaction):
+    # Blobs are written before their rows are committed: the ones of rows that were rolled back (or whose commit
+    # failed) would be left behind otherwise.
+    if transaction.parent is None:
+        keys = session.info.pop(UNCOMMITTED_RESULT_KEYS, None)
+        if keys:
+            result_storage.delete_results(keys)
+
+
+def schedule_offset(query_id, window):
+    """Returns the phase offset (in seconds) of a query's schedule: a deterministic value in [0, window), which spreads
+    consecutive query ids evenly across the window. Returns None when jitter is disabled (`window` is 0)."""
+    if not window or query_id is None:
+        return None
+
+    # Knuth's multiplicative hash, so queries created together don't end up next to each other.
+    return (query_id * 2654435761) % 2 ** 32 % window
+
+
+def _align(iteration, interval, offset):
+    """Moves an iteration to the first time at or after it that is `offset` seconds past a multiple of `interval` (in
+    seconds since the epoch), so queries with the same interval keep their own phase instead of firing together. It is
+    never moved earlier, so a query doesn't run sooner than its interval after the previous run."""
+    timestamp = calendar.timegm(iteration.utctimetuple())
+    aligned = int(math.ceil(float(timestamp - offset) / interval)) * interval + offset
+    return iteration + datetime.timedelta(seconds=aligned - timestamp)
+
+
+def compute_next_run_at(previous_iteration, interval, time=None, day_of_week=None, failures=0, offset=None):
+    """Returns when a query that last ran at `previous_iteration` is next due, or None if it never is.
+
+    With an `offset` (see `schedule_offset`), interval based schedules run at that phase of their interval, and
+    schedules at a specific time run that many seconds after it.
+    """
     # if time exists then interval > 23 hours (82800s)
     # if day_of_week exists then interval > 6 days (518400s)
     if (time is None):
         ttl = int(interval)
         next_iteration = previous_iteration + datetime.timedelta(seconds=ttl)
+        if offset is not None:
+            next_iteration = _align(next_iteration, ttl, offset % ttl)
     else:
         hour, minute = time.split(':')
         hour, minute = int(hour), int(minute)
@@ -353,12 +582,19 @@ def should_schedule_next(previous_iteration, now, interval, time=None, day_of_we
 
         next_iteration = (previous_iteration + datetime.timedelta(days=days_delay) +
                           datetime.timedelta(days=days_to_add)).replace(hour=hour, minute=minute)
+        if offset is not None:
+            next_iteration += datetime.timedelta(seconds=offset)
     if failures:
         try:
             next_iteration += datetime.timedelta(minutes=2**failures)
         except OverflowError:
-            return False
-    return now > next_iteration
+            return None
+    return next_iteration
+
+
+def should_schedule_next(previous_iteration, now, interval, time=None, day_of_week=None, failures=0, offset=None):
+    next_run_at = compute_next_run_at(previous_iteration, interval, time, day_of_week, failures, offset)
+    return next_run_at is not None and now > next_run_at
 
 
 @python_2_unicode_compatible
@@ -389,6 +625,9 @@ class Query(ChangeTrackingMixin, TimestampMixin, BelongsToOrgMixin, db.Model):
     is_draft = Column(db.Boolean, default=True, index=True)
     schedule = Column(MutableDict.as_mutable(PseudoJSON), nullable=True)
     schedule_failures = Column(db.Integer, default=0)
+    # When the query is next due according to its schedule, failures and last execution; NULL when it never is. Saving
+    # the schedule or the query text sets it to the current time, so `outdated_queries` works it out on its next run.
+    next_run_at = Column(db.DateTime(True), nullable=True, index=True)
     visualizations = db.relationship("Visualization", cascade="all, delete-orphan")
     options = Column(MutableDict.as_mutable(PseudoJSON), default={})
     search_vector = Column(TSVectorType('id', 'name', 'description', 'query',
@@ -541,27 +780,23 @@ class Query(ChangeTrackingMixin, TimestampMixin, BelongsToOrgMixin, db.Model):
 
     @classmethod
     def outdated_queries(cls):
+        now = utils.utcnow()
+        schedule = cast(Query.schedule, postgresql.JSON)
         queries = (
             Query.query
             .options(joinedload(Query.latest_query_data).load_only('retrieved_at'))
-            .filter(Query.schedule.isnot(None))
+            .filter(Query.schedule.isnot(None),
+                    schedule['interval'].astext.isnot(None),
+                    # A schedule runs until the end of the day before its `until` date.
+                    or_(schedule['until'].astext.is_(None), schedule['until'].astext > now.strftime('%Y-%m-%d')),
+                    Query.next_run_at <= now)
             .order_by(Query.id)
-        )
+        ).all()
 
-        now = utils.utcnow()
         outdated_queries = {}
-        scheduled_queries_executions.refresh()
+        scheduled_queries_executions.refresh([query.id for query in queries])
 
         for query in queries:
-            if query.schedule['interval'] is None:
-                continue
-
-            if query.schedule['until'] is not None:
-                schedule_until = pytz.utc.localize(datetime.datetime.strptime(query.schedule['until'], '%Y-%m-%d'))
-
-                if schedule_until <= now:
-                    continue
-
             if query.latest_query_data:
                 retrieved_at = query.latest_query_data.retrieved_at
             else:
@@ -569,13 +804,36 @@ class Query(ChangeTrackingMixin, TimestampMixin, BelongsToOrgMixin, db.Model):
 
             retrieved_at = scheduled_queries_executions.get(query.id) or retrieved_at
 
-            if should_schedule_next(retrieved_at, now, query.schedule['interval'], query.schedule['time'],
-                                    query.schedule['day_of_week'], query.schedule_failures):
+            next_run_at = query.get_next_run_at(retrieved_at)
+            if next_run_at is not None and now > next_run_at:
                 key = "{}:{}".format(query.query_hash, query.data_source_id)
                 outdated_queries[key] = query
+            else:
+                # Not due after all (e.g. it was just saved): it isn't loaded again until it is.
+                Query.query.filter(Query.id == query.id).update({'next_run_at': next_run_at},
+                                                                synchronize_session=False)
 
         return outdated_queries.values()
 
+    def get_next_run_at(self, previous_iteration, failures=None):
+        """Returns when the query is next due given when it last ran, or None if that's unknown."""
+        schedule = self.schedule
+        if previous_iteration is None or not schedule or schedule.get('interval') is None:
+            return None
+
+        if failures is None:
+            failures = self.schedule_failures
+
+        return compute_next_run_at(previous_iteration, schedule['interval'], schedule.get('time'),
+                                   schedule.get('day_of_week'), failures, self.schedule_offset)
+
+    @property
+    def schedule_offset(self):
+        return schedule_offset(self.id, settings.SCHEDULE_JITTER_WINDOW)
+
+    def update_next_run_at(self, previous_iteration=None):
+        self.next_run_at = self.get_next_run_at(previous_iteration)
+
     @classmethod
     def search(cls, term, group_ids, user_id=None, include_drafts=False,
                limit=None, include_archived=False, multi_byte_search=False):
@@ -709,6 +967,12 @@ class Query(ChangeTrackingMixin, TimestampMixin, BelongsToOrgMixin, db.Model):
 def gen_query_hash(target, val, oldval, initiator):
     target.query_hash = utils.gen_query_hash(val)
     target.schedule_failures = 0
+    target.next_run_at = utils.utcnow()
+
+
+@listens_for(Query.schedule, 'set')
+def reset_next_run_at(target, val, oldval, initiator):
+    target.next_run_at = utils.utcnow()
 
 
 @listens_for(Query.user_id, 'set')
@@ -788,9 +1052,10 @@ class Alert(TimestampMixin, BelongsToOrgMixin, db.Model):
         return super(Alert, cls).get_by_id_and_org(object_id, org, Query)
 
     def evaluate(self):
-        data = json_loads(self.query_rel.latest_query_data.data)
+        data = self.query_rel.latest_query_data.get_stored_data()
+        first_row = next(iter_rows(data), None)
 
-        if data['rows'] and self.options['column'] in data['rows'][0]:
+        if first_row and self.options['column'] in first_row:
             operators = {
                 '>': lambda v, t: v > t,
                 '>=': lambda v, t: v >= t,
@@ -806,7 +1071,7 @@ class Alert(TimestampMixin, BelongsToOrgMixin, db.Model):
             }
             should_trigger = operators.get(self.options['op'], lambda v, t: False)
 
-            value = data['rows'][0][self.options['column']]
+            value = first_row[self.options['column']]
             threshold = self.options['value']
 
             if should_trigger(value, threshold):
@@ -824,7 +1089,7 @@ class Alert(TimestampMixin, BelongsToOrgMixin, db.Model):
     def render_template(self):
         if not self.template:
             return ''
-        data = json_loads(self.query_rel.latest_query_data.data)
+        data = self.query_rel.latest_query_data.get_data()
         context = {'rows': data['rows'], 'cols': data['columns'], 'state': self.state}
         return mustache_render(self.template, context)
 
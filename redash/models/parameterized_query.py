@@ -1,7 +1,7 @@
 import pystache
 from functools import partial
 from numbers import Number
-from redash.utils import mustache_render, json_loads
+from redash.utils import mustache_render
 from redash.permissions import require_access, view_only
 from funcy import distinct
 from dateutil.parser import parse
@@ -26,7 +26,7 @@ def _load_result(query_id, org):
 
     if query.data_source:
         query_result = models.QueryResult.get_by_id_and_org(query.latest_query_data_id, org)
-        return json_loads(query_result.data)
+        return query_result.get_data()
     else:
         raise QueryDetachedFromDataSourceError(query_id)
 
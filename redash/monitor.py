@@ -1,8 +1,11 @@
+import datetime
 import itertools
 from sqlalchemy import union_all
-from redash import redis_connection, __version__, settings
-from redash.models import db, DataSource, Query, QueryResult, Dashboard, Widget
-from redash.utils import json_loads
+from sqlalchemy.orm import joinedload
+from redash import fair_share, redis_connection, __version__, settings
+from redash.models import (db, DataSource, Query, QueryResult, Dashboard, Widget, compute_next_run_at,
+                           schedule_offset, scheduled_queries_executions)
+from redash.utils import json_loads, utcnow
 from redash.worker import celery
 
 
@@ -22,6 +25,18 @@ def get_object_counts():
     return status
 
 
+def get_data_sources_status():
+    """In flight and waiting queries of the data sources with a max_concurrent_queries limit."""
+    data_sources = DataSource.query.filter(DataSource.max_concurrent_queries.isnot(None)).order_by(DataSource.id)
+    return [{
+        'id': ds.id,
+        'name': ds.name,
+        'max_concurrent_queries': ds.max_concurrent_queries,
+        'in_flight': ds.queries_in_flight,
+        'waiting': ds.queries_waiting
+    } for ds in data_sources]
+
+
 def get_queues():
     queue_names = db.session.query(DataSource.queue_name).distinct()
     scheduled_queue_names = db.session.query(DataSource.scheduled_queue_name).distinct()
@@ -54,6 +69,47 @@ def get_db_sizes():
     return database_metrics
 
 
+def get_schedule_load(minutes=120, jitter_window=None):
+    """Returns how many scheduled query runs are expected in each of the next `minutes` minutes, as a list of
+    (minute, count) tuples. Pass `jitter_window` to see the load with another settings.SCHEDULE_JITTER_WINDOW."""
+    if jitter_window is None:
+        jitter_window = settings.SCHEDULE_JITTER_WINDOW
+
+    now = utcnow().replace(second=0, microsecond=0)
+    end = now + datetime.timedelta(minutes=minutes)
+    counts = [0] * minutes
+
+    queries = (
+        Query.query
+        .options(joinedload(Query.latest_query_data).load_only('retrieved_at'))
+        .filter(Query.schedule.isnot(None))
+    ).all()
+    scheduled_queries_executions.refresh([query.id for query in queries])
+
+    for query in queries:
+        schedule = query.schedule
+        if schedule.get('interval') is None:
+            continue
+
+        previous_iteration = scheduled_queries_executions.get(query.id)
+        if previous_iteration is None:
+            previous_iteration = query.latest_query_data.retrieved_at if query.latest_query_data else now
+
+        offset = schedule_offset(query.id, jitter_window)
+        failures = query.schedule_failures
+        next_run_at = compute_next_run_at(previous_iteration, schedule['interval'], schedule.get('time'),
+                                          schedule.get('day_of_week'), failures, offset)
+
+        while next_run_at is not None and next_run_at < end:
+            # Overdue queries are enqueued right away.
+            next_run_at = max(next_run_at, now)
+            counts[int((next_run_at - now).total_seconds() // 60)] += 1
+            next_run_at = compute_next_run_at(next_run_at, schedule['interval'], schedule.get('time'),
+                                              schedule.get('day_of_week'), 0, offset)
+
+    return [(now + datetime.timedelta(minutes=i), count) for i, count in enumerate(counts)]
+
+
 def get_status():
     status = {
         'version': __version__,
@@ -63,6 +119,9 @@ def get_status():
     status.update(get_object_counts())
     status['manager'] = redis_connection.hgetall('redash:status')
     status['manager']['queues'] = get_queues_status()
+    status['data_sources'] = get_data_sources_status()
+    if settings.QUERY_FAIR_SHARE_ENABLED:
+        status['fair_share'] = fair_share.get_status()
     status['database_metrics'] = {}
     status['database_metrics']['metrics'] = get_db_sizes()
 
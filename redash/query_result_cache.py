@@ -0,0 +1,120 @@
+"""
+Read-through cache of serialized query results, in Redis.
+
+Query results never change once stored, so the JSON of their API representation is cached by result id (in a few
+variants, like the reduced one returned to API key users). The cache is limited to settings.QUERY_RESULTS_CACHE_SIZE
+bytes: every entry's size is accounted for, and the least recently used entries are evicted to make room for new ones.
+
+Keys (all under the `query_result_cache:` prefix):
+
+* `query_result_cache:entry:<id>:<variant>`: the cached JSON.
+* `query_result_cache:lru`: sorted set of the entries (`<id>:<variant>`), scored by their last access time.
+* `query_result_cache:sizes`: hash of the size of each entry.
+* `query_result_cache:size`: total size of the entries.
+"""
+import time
+
+from six import text_type
+
+from redash import redis_connection, settings, statsd_client
+
+KEY_PREFIX = 'query_result_cache:'
+ENTRY_KEY_PREFIX = KEY_PREFIX + 'entry:'
+LRU_KEY = KEY_PREFIX + 'lru'
+SIZES_KEY = KEY_PREFIX + 'sizes'
+SIZE_KEY = KEY_PREFIX + 'size'
+
+VARIANTS = ('full', 'public')
+
+# Shared by the scripts below. KEYS[1]: LRU; KEYS[2]: entry sizes; KEYS[3]: total size; ARGV[1]: entry key prefix.
+_REMOVE_ENTRY = """
+local function remove_entry(entry)
+    redis.call('INCRBY', KEYS[3], -tonumber(redis.call('HGET', KEYS[2], entry) or 0))
+    redis.call('HDEL', KEYS[2], entry)
+    redis.call('ZREM', KEYS[1], entry)
+    redis.call('DEL', ARGV[1] .. entry)
+end
+"""
+
+# ARGV[2]: entry; ARGV[3]: current time.
+#
+# Returns the cached value (marking it as used), or nil. Entries Redis evicted on its own get their accounting removed.
+GET_SCRIPT = _REMOVE_ENTRY + """
+local value = redis.call('GET', ARGV[1] .. ARGV[2])
+if value then
+    redis.call('ZADD', KEYS[1], ARGV[3], ARGV[2])
+elseif redis.call('ZSCORE', KEYS[1], ARGV[2]) then
+    remove_entry(ARGV[2])
+end
+return value
+"""
+
+# ARGV[2]: entry; ARGV[3]: value; ARGV[4]: current time; ARGV[5]: cache size (bytes).
+#
+# Stores the value, then evicts the least recently used entries until the cache fits its size.
+PUT_SCRIPT = _REMOVE_ENTRY + """
+remove_entry(ARGV[2])
+local size = string.len(ARGV[3])
+redis.call('SET', ARGV[1] .. ARGV[2], ARGV[3])
+redis.call('HSET', KEYS[2], ARGV[2], size)
+redis.call('ZADD', KEYS[1], ARGV[4], ARGV[2])
+redis.call('INCRBY', KEYS[3], size)
+while tonumber(redis.call('GET', KEYS[3])) > tonumber(ARGV[5]) do
+    local oldest = redis.call('ZRANGE', KEYS[1], 0, 0)[1]
+    if not oldest then
+        break
+    end
+    remove_entry(oldest)
+end
+"""
+
+# ARGV[2...]: entries.
+DELETE_SCRIPT = _REMOVE_ENTRY + """
+for i = 2, #ARGV do
+    remove_entry(ARGV[i])
+end
+"""
+
+_get_script = redis_connection.register_script(GET_SCRIPT)
+_put_script = redis_connection.register_script(PUT_SCRIPT)
+_delete_script = redis_connection.register_script(DELETE_SCRIPT)
+
+_KEYS = [LRU_KEY, SIZES_KEY, SIZE_KEY]
+
+
+def enabled():
+    return settings.QUERY_RESULTS_CACHE_SIZE > 0
+
+
+def _entry(query_result_id, variant):
+    return '{}:{}'.format(query_result_id, variant)
+
+
+def get(query_result_id, variant):
+    if not enabled():
+        return None
+
+    value = _get_script(keys=_KEYS, args=[ENTRY_KEY_PREFIX, _entry(query_result_id, variant), time.time()])
+    statsd_client.incr('query_result_cache.hit' if value is not None else 'query_result_cache.miss')
+    return value
+
+
+def put(query_result_id, variant, value):
+    if not enabled():
+        return
+
+    if isinstance(value, text_type):
+        value = value.encode('utf-8')
+
+    if len(value) > min(settings.QUERY_RESULTS_CACHE_MAX_ITEM_SIZE, settings.QUERY_RESULTS_CACHE_SIZE):
+        return
+
+    _put_script(keys=_KEYS, args=[ENTRY_KEY_PREFIX, _entry(query_result_id, variant), value, time.time(),
+                                  settings.QUERY_RESULTS_CACHE_SIZE])
+
+
+def delete(query_result_ids):
+    """Removes the cached entries of deleted query results."""
+    entries = [_entry(query_result_id, variant) for query_result_id in query_result_ids for variant in VARIANTS]
+    if entries:
+        _delete_script(keys=_KEYS, args=[ENTRY_KEY_PREFIX] + entries)
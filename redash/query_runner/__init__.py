@@ -3,10 +3,11 @@ import logging
 from dateutil import parser
 import requests
 
-from six import text_type
+from six import integer_types, string_types, text_type
 
 from redash import settings
 from redash.utils import json_loads
+from redash.utils.query_results import ResultWriter
 
 logger = logging.getLogger(__name__)
 
@@ -25,7 +26,10 @@ __all__ = [
     'register',
     'get_query_runner',
     'import_query_runners',
-    'guess_type'
+    'guess_type',
+    'ColumnTypeGuesser',
+    'fetch_batches',
+    'ResultBatches'
 ]
 
 # Valid types of columns returned in results:
@@ -57,7 +61,10 @@ class NotSupported(Exception):
 class BaseQueryRunner(object):
     deprecated = False
     should_annotate_query = True
+    supports_streaming = False
     noop_query = None
+    # Id of the data source the runner was created for (None for runners of unsaved configurations).
+    data_source_id = None
 
     def __init__(self, configuration):
         self.syntax = 'sql'
@@ -98,6 +105,31 @@ class BaseQueryRunner(object):
     def run_query(self, query, user):
         raise NotImplementedError()
 
+    def run_query_native(self, query, user):
+        """Like `run_query`, but returns the result as Python objects (the dict its JSON holds) instead of JSON.
+
+        This default decodes the JSON of `run_query`; runners override it to skip the round trip, returning the
+        values the JSON would hold (see `json_normalize`).
+        """
+        json_data, error = self.run_query(query, user)
+        if error is not None:
+            return None, error
+
+        return json_loads(json_data), None
+
+    def run_query_iter(self, query, user):
+        """Streaming counterpart of `run_query`, implemented by runners that set `supports_streaming`.
+
+        Returns a `(columns, batches)` tuple, where `batches` is a generator of lists of row dicts. Errors are raised
+        instead of being returned. Runners that infer column types from the data may keep updating `columns` until
+        `batches` is exhausted. Runners that add other keys to the result return `batches` as `ResultBatches`.
+        """
+        raise NotSupported()
+
+    def new_result_writer(self, columns):
+        """Returns the `ResultWriter` used to encode the batches yielded by `run_query_iter`."""
+        return ResultWriter(columns)
+
     def fetch_columns(self, columns):
         column_names = []
         duplicates_counter = 1
@@ -149,7 +181,7 @@ class BaseSQLQueryRunner(BaseQueryRunner):
 
     def _get_tables_stats(self, tables_dict):
         for t in tables_dict.keys():
-            if type(tables_dict[t]) == dict:
+            if isinstance(tables_dict[t], dict):
                 res = self._run_query_internal('select count(*) as cnt from %s' % t)
                 tables_dict[t]['size'] = res[0]['cnt']
 
@@ -259,12 +291,14 @@ def register(query_runner_class):
                      "dependencies.", query_runner_class.name())
 
 
-def get_query_runner(query_runner_type, configuration):
+def get_query_runner(query_runner_type, configuration, data_source_id=None):
     query_runner_class = query_runners.get(query_runner_type, None)
     if query_runner_class is None:
         return None
 
-    return query_runner_class(configuration)
+    query_runner = query_runner_class(configuration)
+    query_runner.data_source_id = data_source_id
+    return query_runner
 
 
 def get_configuration_schema_for_query_runner_type(query_runner_type):
@@ -280,6 +314,32 @@ def import_query_runners(query_runner_imports):
         __import__(runner_import)
 
 
+def fetch_batches(cursor, batch_size=None):
+    """Yields the rows of a DB-API cursor in lists of at most `batch_size` rows."""
+    batch_size = batch_size or settings.QUERY_RESULTS_STREAMING_BATCH_SIZE
+
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            break
+        yield rows
+
+
+class ResultBatches(object):
+    """The batches returned by `run_query_iter`, along with `metadata`: the keys (like `truncated`) the runner adds
+    to the result while the batches are iterated."""
+
+    def __init__(self, batches, metadata):
+        self._batches = batches
+        self.metadata = metadata
+
+    def __iter__(self):
+        return self._batches
+
+    def close(self):
+        self._batches.close()
+
+
 def guess_type(value):
     if isinstance(value, bool):
         return TYPE_BOOLEAN
@@ -317,3 +377,78 @@ def guess_type_from_string(string_value):
         pass
 
     return TYPE_STRING
+
+
+# Types of Python values, as guess_type would guess them.
+_VALUE_TYPES = {bool: TYPE_BOOLEAN, float: TYPE_FLOAT}
+_VALUE_TYPES.update((t, TYPE_INTEGER) for t in integer_types)
+
+
+def _guess_values_type(values, guess=None):
+    """Returns the type guess_type gives the values and the values `guess` is the type of, TYPE_STRING when they don't
+    agree, or None if they're all null (or empty)."""
+    for value_type in set(type(value) for value in values if value is not None):
+        if issubclass(value_type, string_types):
+            continue
+
+        if value_type in _VALUE_TYPES:
+            guesses = [_VALUE_TYPES[value_type]]
+        else:
+            guesses = (guess_type(value) for value in values if type(value) is value_type)
+
+        for value_guess in guesses:
+            if guess is None:
+                guess = value_guess
+            elif guess != value_guess:
+                return TYPE_STRING
+
+    for value in set(value for value in values if isinstance(value, string_types) and value != ''):
+        value_guess = guess_type_from_string(value)
+        if guess is None:
+            guess = value_guess
+        elif guess != value_guess:
+            return TYPE_STRING
+
+    return guess
+
+
+class ColumnTypeGuesser(object):
+    """Guesses the types of a result's columns from a sample of their values, given a batch of rows at a time.
+
+    A column's type is the one guess_type gives all of its values, or TYPE_STRING when they don't agree. Null and empty
+    values don't count (columns with nothing else are strings). Only the first `sample_size` rows are looked at, and a
+    column isn't checked anymore once it's a string. Values are checked by their Python type, so only strings go
+    through guess_type_from_string, once per distinct value of each batch.
+
+    :param keys: the keys of the columns in the rows: their indexes when the rows are sequences, names for dicts.
+    """
+
+    def __init__(self, keys, sample_size=None):
+        self.keys = list(keys)
+        self.sample_size = settings.TYPE_INFERENCE_SAMPLE_SIZE if sample_size is None else sample_size
+        self._guesses = [None] * len(self.keys)
+        self._unsettled = list(range(len(self.keys)))
+        self._sampled = 0
+
+    @property
+    def done(self):
+        return not self._unsettled or self._sampled >= self.sample_size
+
+    @property
+    def types(self):
+        return [guess or TYPE_STRING for guess in self._guesses]
+
+    def update(self, rows):
+        if self.done or not rows:
+            return
+
+        rows = rows[:self.sample_size - self._sampled]
+        self._sampled += len(rows)
+
+        is_dict = isinstance(rows[0], dict)
+        for i in list(self._unsettled):
+            key = self.keys[i]
+            values = [row.get(key) for row in rows] if is_dict else [row[key] for row in rows]
+            self._guesses[i] = _guess_values_type(values, self._guesses[i])
+            if self._guesses[i] == TYPE_STRING:
+                self._unsettled.remove(i)
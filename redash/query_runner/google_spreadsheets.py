@@ -96,8 +96,10 @@ def parse_worksheet(worksheet):
     columns, column_names = _get_columns_and_column_names(worksheet[HEADER_INDEX])
 
     if len(worksheet) > 1:
-        for j, value in enumerate(worksheet[HEADER_INDEX + 1]):
-            columns[j]['type'] = guess_type(value)
+        guesser = ColumnTypeGuesser(range(len(columns)))
+        guesser.update(worksheet[HEADER_INDEX + 1:])
+        for column, column_type in zip(columns, guesser.types):
+            column['type'] = column_type
 
     column_types = [c['type'] for c in columns]
     rows = [dict(zip(column_names, _value_eval_list(row, column_types))) for row in worksheet[HEADER_INDEX + 1:]]
@@ -2,12 +2,13 @@ import logging
 import os
 import threading
 
-from redash.query_runner import TYPE_FLOAT, TYPE_INTEGER, TYPE_DATETIME, TYPE_STRING, TYPE_DATE, BaseSQLQueryRunner, InterruptException, register
+from redash.query_runner import TYPE_FLOAT, TYPE_INTEGER, TYPE_DATETIME, TYPE_STRING, TYPE_DATE, BaseSQLQueryRunner, InterruptException, register, fetch_batches
 from redash.settings import parse_boolean
 from redash.utils import json_dumps, json_loads
 
 try:
     import MySQLdb
+    import MySQLdb.cursors
     enabled = True
 except ImportError:
     enabled = False
@@ -40,6 +41,7 @@ class Result(object):
 
 class Mysql(BaseSQLQueryRunner):
     noop_query = "SELECT 1"
+    supports_streaming = True
 
     @classmethod
     def configuration_schema(cls):
@@ -219,6 +221,53 @@ class Mysql(BaseSQLQueryRunner):
             if connection:
                 connection.close()
 
+    def run_query_iter(self, query, user):
+        # Unlike run_query, this reads the first result set that returns rows, through an unbuffered cursor so rows
+        # are only transferred from the server as batches are consumed. Cancellation takes effect between batches.
+        connection = self._connection()
+        thread_id = connection.thread_id()
+        cursor = connection.cursor(MySQLdb.cursors.SSCursor)
+
+        try:
+            logger.debug("MySQL running query: %s", query)
+            cursor.execute(query)
+
+            while cursor.description is None and cursor.nextset():
+                pass
+
+            if cursor.description is None:
+                raise Exception("No data was returned.")
+
+            columns = self.fetch_columns([(i[0], types_map.get(i[1], None))
+                                          for i in cursor.description])
+        except MySQLdb.Error as e:
+            connection.close()
+            raise Exception(e.args[1])
+        except (KeyboardInterrupt, InterruptException):
+            error = self._cancel(thread_id)
+            connection.close()
+            raise Exception(error or "Query cancelled by user.")
+        except Exception:
+            connection.close()
+            raise
+
+        return columns, self._iter_batches(connection, cursor, columns, thread_id)
+
+    def _iter_batches(self, connection, cursor, columns, thread_id):
+        column_names = [c['name'] for c in columns]
+
+        try:
+            for rows in fetch_batches(cursor):
+                yield [dict(zip(column_names, row)) for row in rows]
+        except MySQLdb.Error as e:
+            raise Exception(e.args[1])
+        except (KeyboardInterrupt, InterruptException):
+            error = self._cancel(thread_id)
+            raise Exception(error or "Query cancelled by user.")
+        finally:
+            cursor.close()
+            connection.close()
+
     def _get_ssl_parameters(self):
         if not self.configuration.get('use_ssl'):
             return None
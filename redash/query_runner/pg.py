@@ -6,8 +6,11 @@ import re
 import psycopg2
 from psycopg2.extras import Range
 
+from redash import settings
 from redash.query_runner import *
-from redash.utils import JSONEncoder, json_dumps, json_loads
+from redash.utils import JSONEncoder, json_dumps, json_normalize
+from redash.utils.connection_pool import ConnectionPool, get_pool
+from redash.utils.query_results import ResultWriter
 
 import pystache
 
@@ -31,6 +34,8 @@ types_map = {
     2951: TYPE_STRING
 }
 
+SERVER_SIDE_CURSOR_NAME = 'redash_result'
+
 
 class PostgreSQLJSONEncoder(JSONEncoder):
     def default(self, o):
@@ -66,8 +71,16 @@ def _wait(conn, timeout=None):
             raise psycopg2.OperationalError("select.error received")
 
 
+def _execute(conn, query):
+    cursor = conn.cursor()
+    cursor.execute(query)
+    _wait(conn)
+
+
 class PostgreSQL(BaseSQLQueryRunner):
     noop_query = "SELECT 1"
+    reset_session_query = "DISCARD ALL"
+    supports_streaming = True
 
     @classmethod
     def configuration_schema(cls):
@@ -96,6 +109,18 @@ class PostgreSQL(BaseSQLQueryRunner):
                     "type": "string",
                     "title": "SSL Mode",
                     "default": "prefer"
+                },
+                "server_side_cursor": {
+                    "type": "boolean",
+                    "title": "Fetch Results with a Server-Side Cursor"
+                },
+                "fetch_size": {
+                    "type": "number",
+                    "title": "Server-Side Cursor Fetch Size"
+                },
+                "max_rows": {
+                    "type": "number",
+                    "title": "Maximum Number of Rows"
                 }
             },
             "order": ['host', 'port', 'user', 'password'],
@@ -108,13 +133,12 @@ class PostgreSQL(BaseSQLQueryRunner):
         return "pg"
 
     def _get_definitions(self, schema, query):
-        results, error = self.run_query(query, None)
+        # Not through run_query: the schema isn't capped by max_rows (nor fetched through a server-side cursor).
+        results, error = self._fetch_result(query)
 
         if error is not None:
             raise Exception("Failed getting schema.")
 
-        results = json_loads(results)
-
         for row in results['rows']:
             if row['table_schema'] != 'public':
                 table_name = u'{}.{}'.format(row['table_schema'],
@@ -186,50 +210,87 @@ class PostgreSQL(BaseSQLQueryRunner):
 
         return connection
 
-    def run_secure_query(self, query, params, user):
+    def _connect(self):
         connection = self._get_connection()
         _wait(connection, timeout=10)
+        return connection
 
-        cursor = connection.cursor()
+    def _check_connection(self, connection):
+        if connection.closed:
+            return False
 
-        try:
-            regular_query = re.sub(r'([\']?){{(.*?)}}\1', r'{{\2}}', query)
-            place_holders = {}
-            for k in params.keys():
-                place_holders[k] = '%({0})s'.format(k)
-            secure_query = pystache.render(regular_query, place_holders)
+        _execute(connection, self.noop_query)
 
-            cursor.execute(secure_query, params)
-            _wait(connection)
+    def _reset_connection(self, connection):
+        _execute(connection, self.reset_session_query)
 
-            if cursor.description is not None:
-                columns = self.fetch_columns([(i[0], types_map.get(i[1], None)) for i in cursor.description])
-                rows = [dict(zip((c['name'] for c in columns), row)) for row in cursor]
+    def _get_pool(self):
+        # Pools are per data source, and replaced (closing the old one) when its options change. Runners of unsaved
+        # configurations (like connection tests) get a pool per configuration, closed once unused.
+        fingerprint = json_dumps(dict(self.configuration.iteritems()), sort_keys=True)
+        identity = (self.type(), self.data_source_id if self.data_source_id is not None else fingerprint)
 
-                data = {'columns': columns, 'rows': rows}
-                error = None
-                json_data = json_dumps(data)
-            else:
-                error = 'Query completed but it returned no data.'
-                json_data = None
-        except (select.error, OSError) as e:
-            error = "Query interrupted. Please retry."
-            json_data = None
-        except psycopg2.DatabaseError as e:
-            error = e.message
-            json_data = None
-        except (KeyboardInterrupt, InterruptException):
-            connection.cancel()
-            error = "Query cancelled by user."
-            json_data = None
-        finally:
+        return get_pool(identity, fingerprint, lambda: ConnectionPool(self._connect,
+                                                                      settings.PG_CONNECTION_POOL_MAX_SIZE,
+                                                                      settings.PG_CONNECTION_POOL_IDLE_TIMEOUT,
+                                                                      check=self._check_connection,
+                                                                      reset=self._reset_connection))
+
+    def _acquire_connection(self):
+        if settings.PG_CONNECTION_POOL_ENABLED:
+            return self._get_pool().acquire()
+
+        return self._connect()
+
+    def _release_connection(self, connection, discard=False):
+        """Returns the connection to the pool, or closes it. Connections of interrupted queries are always closed."""
+        if settings.PG_CONNECTION_POOL_ENABLED:
+            self._get_pool().release(connection, discard=discard)
+        else:
             connection.close()
 
-        return json_data, error
+    def run_secure_query(self, query, params, user):
+        regular_query = re.sub(r'([\']?){{(.*?)}}\1', r'{{\2}}', query)
+        place_holders = {}
+        for k in params.keys():
+            place_holders[k] = '%({0})s'.format(k)
+        secure_query = pystache.render(regular_query, place_holders)
+
+        data, error = self._fetch_result(secure_query, params, max_rows=self.configuration.get('max_rows'))
+        return (json_dumps(data) if data is not None else None), error
 
     def run_shared_query(self, query, params, user):
-        connection = self._get_connection()
-        _wait(connection, timeout=10)
+        data, error = self._fetch_result(query, params)
+        return (json_dumps(data) if data is not None else None), error
+
+    def run_shared_query_native(self, query, params, user):
+        """Like `run_shared_query`, returning the result as Python objects instead of JSON."""
+        data, error = self._fetch_result(query, params)
+        if data is not None:
+            data['rows'] = json_normalize(data['rows'])
+        return data, error
+
+    def run_query(self, query, user):
+        if self.configuration.get('server_side_cursor'):
+            return self._run_query_server_side(query, user)
+
+        data, error = self._fetch_result(query, max_rows=self.configuration.get('max_rows'))
+        json_data = json_dumps(data, ignore_nan=True, cls=PostgreSQLJSONEncoder) if data is not None else None
+        return json_data, error
+
+    def run_query_native(self, query, user):
+        if self.configuration.get('server_side_cursor'):
+            return super(PostgreSQL, self).run_query_native(query, user)
+
+        data, error = self._fetch_result(query, max_rows=self.configuration.get('max_rows'))
+        if data is not None:
+            data['rows'] = json_normalize(data['rows'], cls=PostgreSQLJSONEncoder, ignore_nan=True)
+        return data, error
+
+    def _fetch_result(self, query, params=None, max_rows=None):
+        """Runs the query, returning `(data, error)`, with the result as it comes from the database."""
+        connection = self._acquire_connection()
+        discard = False
 
         cursor = connection.cursor()
 
@@ -238,73 +299,179 @@ class PostgreSQL(BaseSQLQueryRunner):
             _wait(connection)
 
             if cursor.description is not None:
-                columns = self.fetch_columns([(i[0], types_map.get(i[1], None)) for i in cursor.description])
-                rows = [dict(zip((c['name'] for c in columns), row)) for row in cursor]
+                columns = self.fetch_columns([(i[0], types_map.get(i[1], None))
+                                              for i in cursor.description])
+                rows = [
+                    dict(zip((c['name'] for c in columns), row))
+                    for row in (cursor.fetchmany(int(max_rows)) if max_rows else cursor)
+                ]
 
                 data = {'columns': columns, 'rows': rows}
+                if max_rows and cursor.rowcount > max_rows:
+                    data['truncated'] = True
                 error = None
-                json_data = json_dumps(data)
             else:
                 error = 'Query completed but it returned no data.'
-                json_data = None
-        except (select.error, OSError) as e:
+                data = None
+        except (select.error, OSError):
+            discard = True
             error = "Query interrupted. Please retry."
-            json_data = None
+            data = None
         except psycopg2.DatabaseError as e:
             error = e.message
-            json_data = None
+            data = None
         except (KeyboardInterrupt, InterruptException):
+            discard = True
             connection.cancel()
             error = "Query cancelled by user."
-            json_data = None
+            data = None
         finally:
-            connection.close()
+            self._release_connection(connection, discard)
 
-        return json_data, error
+        return data, error
 
-    def run_query(self, query, user):
-        connection = self._get_connection()
-        _wait(connection, timeout=10)
+    def _run_query_server_side(self, query, user):
+        # run_query_iter raises plain exceptions for the errors the other path returns (like interruptions).
+        try:
+            columns, batches = self.run_query_iter(query, user)
+        except Exception as e:
+            return None, e.message
+
+        with self.new_result_writer(columns) as writer:
+            try:
+                for rows in batches:
+                    writer.write_rows(rows)
+            except Exception as e:
+                return None, e.message
+            finally:
+                batches.close()
+
+            writer.finish(columns, **batches.metadata)
+            return writer.getvalue(), None
+
+    def new_result_writer(self, columns):
+        return ResultWriter(columns, ignore_nan=True, cls=PostgreSQLJSONEncoder)
+
+    def run_query_iter(self, query, user):
+        server_side = self.configuration.get('server_side_cursor')
+        connection = self._acquire_connection()
 
         cursor = connection.cursor()
 
         try:
-            cursor.execute(query)
-            _wait(connection)
+            if server_side:
+                rows = self._declare_cursor(connection, cursor, query)
+            else:
+                cursor.execute(query)
+                _wait(connection)
 
-            if cursor.description is not None:
-                columns = self.fetch_columns([(i[0], types_map.get(i[1], None))
-                                              for i in cursor.description])
-                rows = [
-                    dict(zip((c['name'] for c in columns), row))
-                    for row in cursor
-                ]
+            if cursor.description is None:
+                raise Exception('Query completed but it returned no data.')
 
-                data = {'columns': columns, 'rows': rows}
-                error = None
-                json_data = json_dumps(data,
-                                       ignore_nan=True,
-                                       cls=PostgreSQLJSONEncoder)
-            else:
-                error = 'Query completed but it returned no data.'
-                json_data = None
-        except (select.error, OSError) as e:
-            error = "Query interrupted. Please retry."
-            json_data = None
-        except psycopg2.DatabaseError as e:
-            error = e.message
-            json_data = None
+            columns = self.fetch_columns([(i[0], types_map.get(i[1], None))
+                                          for i in cursor.description])
+        except (select.error, OSError):
+            self._release_connection(connection, discard=True)
+            raise Exception("Query interrupted. Please retry.")
         except (KeyboardInterrupt, InterruptException):
             connection.cancel()
-            error = "Query cancelled by user."
-            json_data = None
+            self._release_connection(connection, discard=True)
+            raise Exception("Query cancelled by user.")
+        except Exception:
+            self._release_connection(connection)
+            raise
+
+        metadata = {}
+        if server_side:
+            batches = self._iter_server_side_batches(connection, cursor, columns, rows, metadata)
+        else:
+            batches = self._iter_batches(connection, cursor, columns, metadata)
+
+        return columns, ResultBatches(batches, metadata)
+
+    def _limit_rows(self, rows, row_count, metadata):
+        """Drops the rows beyond the `max_rows` of the data source, marking the result as truncated."""
+        max_rows = self.configuration.get('max_rows')
+        if max_rows and row_count + len(rows) > max_rows:
+            metadata['truncated'] = True
+            return rows[:max(int(max_rows) - row_count, 0)]
+
+        return rows
+
+    def _iter_batches(self, connection, cursor, columns, metadata):
+        column_names = [c['name'] for c in columns]
+        row_count = 0
+        discard = True
+
+        try:
+            for rows in fetch_batches(cursor):
+                rows = self._limit_rows(rows, row_count, metadata)
+                if rows:
+                    yield [dict(zip(column_names, row)) for row in rows]
+                row_count += len(rows)
+                if metadata.get('truncated'):
+                    break
+            discard = False
         finally:
-            connection.close()
+            self._release_connection(connection, discard)
+
+    def _split_session_statements(self, query):
+        """Returns the statements to run before the query, which can't be part of the cursor declaration."""
+        return [], query
+
+    def _declare_cursor(self, connection, cursor, query):
+        """Runs the query through a server-side cursor (so it isn't buffered by libpq) and fetches the first batch."""
+        statements, query = self._split_session_statements(query)
+        # Async connections are in autocommit mode, while cursors only live within a transaction.
+        declare = u'DECLARE {} NO SCROLL CURSOR FOR {}'.format(SERVER_SIDE_CURSOR_NAME, query.strip().rstrip(';'))
+        statements += ['BEGIN', declare]
+        for statement in statements:
+            cursor.execute(statement)
+            _wait(connection)
 
-        return json_data, error
+        return self._fetch_forward(connection, cursor, 0)
+
+    def _fetch_forward(self, connection, cursor, row_count):
+        count = int(self.configuration.get('fetch_size') or settings.QUERY_RESULTS_STREAMING_BATCH_SIZE)
+        max_rows = self.configuration.get('max_rows')
+        if max_rows:
+            # Fetch up to one row past the cap, to tell whether the result is truncated.
+            count = min(count, int(max_rows) - row_count + 1)
+
+        cursor.execute('FETCH FORWARD {:d} FROM {}'.format(count, SERVER_SIDE_CURSOR_NAME))
+        _wait(connection)
+        return cursor.fetchall()
+
+    def _iter_server_side_batches(self, connection, cursor, columns, rows, metadata):
+        column_names = [c['name'] for c in columns]
+        row_count = 0
+        discard = True
+
+        try:
+            while rows:
+                rows = self._limit_rows(rows, row_count, metadata)
+                if rows:
+                    yield [dict(zip(column_names, row)) for row in rows]
+                row_count += len(rows)
+                if metadata.get('truncated'):
+                    break
+                rows = self._fetch_forward(connection, cursor, row_count)
+
+            _execute(connection, 'COMMIT')
+            discard = False
+        except (select.error, OSError):
+            raise Exception("Query interrupted. Please retry.")
+        except (KeyboardInterrupt, InterruptException):
+            connection.cancel()
+            raise Exception("Query cancelled by user.")
+        finally:
+            self._release_connection(connection, discard)
 
 
 class Redshift(PostgreSQL):
+    # Redshift doesn't support DISCARD.
+    reset_session_query = "RESET ALL"
+
     @classmethod
     def type(cls):
         return "redshift"
@@ -361,6 +528,18 @@ class Redshift(PostgreSQL):
                     "title": "Query Group for Scheduled Queries",
                     "default": "default"
                 },
+                "server_side_cursor": {
+                    "type": "boolean",
+                    "title": "Fetch Results with a Server-Side Cursor"
+                },
+                "fetch_size": {
+                    "type": "number",
+                    "title": "Server-Side Cursor Fetch Size"
+                },
+                "max_rows": {
+                    "type": "number",
+                    "title": "Maximum Number of Rows"
+                },
             },
             "order": ['host', 'port', 'user', 'password', 'dbname', 'sslmode', 'adhoc_query_group', 'scheduled_query_group'],
             "required": ["dbname", "user", "password", "host", "port"],
@@ -381,6 +560,13 @@ class Redshift(PostgreSQL):
         
         return annotated
 
+    def _split_session_statements(self, query):
+        if query.startswith('set query_group to '):
+            set_query_group, query = query.split('\n', 1)
+            return [set_query_group], query
+
+        return [], query
+
     def _get_tables(self, schema):
         # Use svv_columns to include internal & external (Spectrum) tables and views data for Redshift
         # https://docs.aws.amazon.com/redshift/latest/dg/r_SVV_COLUMNS.html
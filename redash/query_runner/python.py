@@ -3,12 +3,14 @@ import importlib
 import logging
 import sys
 import re
+import time
 
 import pystache
 
 from redash.query_runner import *
 from redash.utils import json_dumps, json_loads
-from redash import models
+from redash.utils.threads import map_in_threads
+from redash import models, settings
 from RestrictedPython import compile_restricted
 from RestrictedPython.Guards import safe_builtins
 
@@ -210,6 +212,21 @@ class Python(BaseQueryRunner):
             return False
         return ismethod(data_source.query_runner.run_shared_query)
 
+    @staticmethod
+    def _run_shared_query_native(query_runner, query, parameters, user):
+        """Runs a shared query, getting its result as Python objects directly when the runner supports it."""
+        if hasattr(query_runner, 'run_shared_query_native'):
+            data, error = query_runner.run_shared_query_native(query, parameters, user)
+        else:
+            data, error = query_runner.run_shared_query(query, parameters, user)
+            if error is None:
+                data = json_loads(data)
+
+        if error is not None:
+            raise Exception(error)
+
+        return data
+
     @staticmethod
     def execute_shared_query(tenant_id, query, user, parameters):
         """Run shared query from for a tenant.
@@ -221,6 +238,12 @@ class Python(BaseQueryRunner):
         :parameters array: parameter for query.
         """
 
+        data_source = Python.get_tenant_data_source(tenant_id, user)
+        return Python._run_shared_query_native(data_source.query_runner, query, parameters, user)
+
+    @staticmethod
+    def get_tenant_data_source(tenant_id, user):
+        """Returns the data source of a tenant, checking that the user can run shared queries on it."""
         tid = Python.to_tenant_id_int(tenant_id)
         data_source_name = "datasource_%d" % tid
 
@@ -233,12 +256,90 @@ class Python(BaseQueryRunner):
             raise Exception("Data source is not secure: %s." % data_source_name)
         if not Python.can_access(user, data_source):
             raise Exception("Can't access data source name: %s." % data_source_name)
-        data, error = data_source.query_runner.run_shared_query(query, parameters, user)
-        if error is not None:
-            raise Exception(error)
+        return data_source
+
+    @staticmethod
+    def execute_shared_query_for_tenants(tenant_ids, query, user, parameters, merge=False):
+        """Run shared query for many tenants at once, settings.PYTHON_FAN_OUT_CONCURRENCY at a time (see
+        `map_in_threads`). Each tenant is queried once, even when its ID is repeated.
+
+        Parameters:
+        :tenant_ids list: tenant IDs
+        :query string: Query to run
+        :user models.User: user to execute query
+        :parameters array: parameter for query.
+        :merge bool: whether to merge the results of the tenants into one, with a `tenant_id` column first.
+        :return: dict with `results` (the result of each tenant by tenant ID, or the merged result), `errors` (the
+                 error of each tenant that couldn't be queried or whose query failed) and `timings` (the seconds the
+                 query of each tenant took).
+        """
+        errors = {}
+        jobs = []
+        seen = set()
+        for tenant_id in tenant_ids:
+            tid = Python.to_tenant_id_int(tenant_id)
+            if tid in seen:
+                continue
+            seen.add(tid)
+
+            # Data sources are checked here, as the database session can't be shared with the threads running the
+            # queries.
+            try:
+                jobs.append((tid, Python.get_tenant_data_source(tid, user).query_runner))
+            except Exception as e:
+                errors[tid] = Python.error_message(e)
+
+        def run(job):
+            tid, query_runner = job
+            started_at = time.time()
+            try:
+                data = Python._run_shared_query_native(query_runner, query, parameters, user)
+                return tid, data, None, time.time() - started_at
+            except Exception as e:
+                return tid, None, Python.error_message(e), time.time() - started_at
+
+        outcomes = map_in_threads(run, jobs, settings.PYTHON_FAN_OUT_CONCURRENCY)
+
+        results = {}
+        timings = {}
+        for tid, data, error, timing in outcomes:
+            logger.info("Shared query of tenant %d took %.3fs%s", tid, timing, " (failed)" if error is not None else "")
+            timings[tid] = timing
+            if error is not None:
+                errors[tid] = error
+            else:
+                results[tid] = data
+
+        if merge:
+            results = Python.merge_tenant_results([(tid, results[tid]) for tid, _ in jobs if tid in results])
 
-        # TODO: allow avoiding the json.dumps/loads in same process
-        return json_loads(data)
+        return {'results': results, 'errors': errors, 'timings': timings}
+
+    @staticmethod
+    def error_message(e):
+        """Returns the message of an exception as unicode (messages of database errors can be non-ASCII bytes)."""
+        message = e.args[0] if len(e.args) == 1 else e
+        if isinstance(message, str):
+            return message.decode('utf-8', 'replace')
+        return unicode(message)
+
+    @staticmethod
+    def merge_tenant_results(tenant_results):
+        """Merges the results of tenants (a list of (tenant ID, result)) into one, with a `tenant_id` column first."""
+        columns = [{'name': 'tenant_id', 'friendly_name': 'tenant_id', 'type': TYPE_INTEGER}]
+        column_names = set(['tenant_id'])
+        rows = []
+        for tid, data in tenant_results:
+            for column in data['columns']:
+                if column['name'] not in column_names:
+                    column_names.add(column['name'])
+                    columns.append(column)
+            for row in data['rows']:
+                row = dict(row)
+                row['tenant_id'] = tid
+                rows.append(row)
+
+        return {'columns': columns, 'rows': rows}
 
 
     @staticmethod
@@ -264,12 +365,7 @@ class Python(BaseQueryRunner):
             raise Exception("Data source is not secure: %s." % data_source.name)
         if not Python.can_access(user, data_source):
             raise Exception("Can't access data source name: %s." % data_source.name)
-        data, error = data_source.query_runner.run_shared_query(query, parameters, user)
-        if error is not None:
-            raise Exception(error)
-
-        # TODO: allow avoiding the json.dumps/loads in same process
-        return json_loads(data)
+        return Python._run_shared_query_native(data_source.query_runner, query, parameters, user)
 
 
     @staticmethod
@@ -289,12 +385,11 @@ class Python(BaseQueryRunner):
         if not Python.can_access(user, data_source):
             raise Exception("Can't access data source name: %s." % data_source_name)
 
-        data, error = data_source.query_runner.run_query(query, None)
+        data, error = data_source.query_runner.run_query_native(query, None)
         if error is not None:
             raise Exception(error)
 
-        # TODO: allow avoiding the json.dumps/loads in same process
-        return json_loads(data)
+        return data
 
     @staticmethod
     def execute_query(data_source_name_or_id, query):
@@ -313,12 +408,11 @@ class Python(BaseQueryRunner):
             raise Exception("Wrong data source name/id: %s." % data_source_name_or_id)
 
         # TODO: pass the user here...
-        data, error = data_source.query_runner.run_query(query, None)
+        data, error = data_source.query_runner.run_query_native(query, None)
         if error is not None:
             raise Exception(error)
 
-        # TODO: allow avoiding the JSON dumps/loads in same process
-        return json_loads(data)
+        return data
 
     @staticmethod
     def get_source_schema(data_source_name_or_id):
@@ -352,10 +446,10 @@ class Python(BaseQueryRunner):
         if query.latest_query_data is None:
             raise Exception("Query does not have results yet.")
 
-        if query.latest_query_data.data is None:
+        if not query.latest_query_data.has_data:
             raise Exception("Query does not have results yet.")
 
-        return json_loads(query.latest_query_data.data)
+        return query.latest_query_data.get_data()
 
     def get_current_user(self):
         return self._current_user.to_dict()
@@ -403,6 +497,7 @@ class Python(BaseQueryRunner):
             restricted_globals["execute_query"] = self.execute_query
             restricted_globals["execute_restricted_query"] = lambda data_source_name, query: self.execute_restricted_query(data_source_name, query, user)
             restricted_globals["execute_shared_query"] = lambda tenant_id, query: self.execute_shared_query(tenant_id, query, user, params)
+            restricted_globals["execute_shared_query_for_tenants"] = lambda tenant_ids, query, merge=False: self.execute_shared_query_for_tenants(tenant_ids, query, user, params, merge)
             restricted_globals["execute_parameterized_query"] = lambda data_source_name, query, parameters: self.execute_parameterized_query(data_source_name, query, parameters, user)
             restricted_globals["tenant_id2name"] = self.tenant_id2name
             restricted_globals["add_result_column"] = self.add_result_column
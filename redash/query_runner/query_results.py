@@ -1,14 +1,40 @@
+import atexit
+import errno
 import logging
+import os
 import re
+import shutil
+import socket
 import sqlite3
+import tempfile
+import threading
+import time
+from collections import OrderedDict
 
-from redash import models
+from redash import models, settings
 from redash.permissions import has_access, view_only
-from redash.query_runner import BaseQueryRunner, TYPE_STRING, guess_type, register
+from redash.query_runner import (BaseQueryRunner, ColumnTypeGuesser, TYPE_BOOLEAN, TYPE_FLOAT, TYPE_INTEGER,
+                                 fetch_batches, register)
 from redash.utils import json_dumps, json_loads
+from redash.utils.threads import map_in_threads
 
 logger = logging.getLogger(__name__)
 
+# SQLite column affinities of the column types of the loaded results. Other columns get none: guessed string (or date)
+# types are often wrong for mixed or numeric looking columns, and a TEXT affinity would turn their numbers into text,
+# changing how they compare.
+SQLITE_AFFINITIES = {
+    TYPE_INTEGER: 'INTEGER',
+    TYPE_FLOAT: 'REAL',
+    TYPE_BOOLEAN: 'INTEGER',
+}
+
+# Directories of the MaterializedResults of each process start with this (followed by host name and pid).
+CACHE_DIRECTORY_PREFIX = 'redash-query-results-'
+
+# SQLite's (default) limit of databases attached to a connection.
+MAX_ATTACHED_DATABASES = 10
+
 
 class PermissionError(Exception):
     pass
@@ -29,6 +55,22 @@ def extract_cached_query_ids(query):
     return [int(q) for q in queries]
 
 
+def extract_condition_columns(query):
+    """Returns the (lowercased) names used in the ON, USING and WHERE clauses of the query.
+
+    This is a heuristic: besides column names it returns aliases, keywords and such, which is fine as the names are
+    only matched against the columns of the loaded tables.
+    """
+    clauses = re.findall(r'\b(?:on|using|where)\b(.*?)(?=\b(?:join|where|group|order|having|limit|union)\b|$)', query,
+                         re.IGNORECASE | re.DOTALL)
+    names = set()
+    for clause in clauses:
+        for name in re.findall(r'"([^"]+)"|(\w+)', clause, re.UNICODE):
+            names.add((name[0] or name[1]).lower())
+
+    return names
+
+
 def _load_query(user, query_id):
     query = models.Query.get_by_id(query_id)
 
@@ -47,34 +89,233 @@ def _load_query(user, query_id):
 def get_query_results(user, query_id, bring_from_cache):
     query = _load_query(user, query_id)
     if bring_from_cache:
-        if query.latest_query_data_id is not None:
-            results = query.latest_query_data.data
-        else:
-            raise Exception("No cached result available for query {}.".format(
-                query.id))
+        _check_cached_results(query)
+        return query.latest_query_data.get_data()
     else:
-        results, error = query.data_source.query_runner.run_query(
-            query.query_text, user)
-        if error:
-            raise Exception("Failed loading results for query id {}.".format(
-                query.id))
+        return _run_query(query.id, query.data_source.query_runner, query.query_text, user)
 
+
+def _check_cached_results(query):
+    if query.latest_query_data_id is None:
+        raise Exception("No cached result available for query {}.".format(
+            query.id))
+
+
+def _run_query(query_id, query_runner, query_text, user):
+    started_at = time.time()
+    results, error = query_runner.run_query(query_text, user)
+    if error:
+        raise Exception("Failed loading results for query id {}.".format(
+            query_id))
+
+    logger.info("Ran query %d in %.3fs", query_id, time.time() - started_at)
     return json_loads(results)
 
 
+def run_queries(user, queries):
+    """Runs the queries, settings.QUERY_RESULTS_RUNNER_CONCURRENCY at a time (see `map_in_threads`), and returns their
+    results."""
+    jobs = [(query.id, query.data_source.query_runner, query.query_text) for query in queries]
+    return map_in_threads(lambda job: _run_query(job[0], job[1], job[2], user), jobs,
+                          settings.QUERY_RESULTS_RUNNER_CONCURRENCY)
+
+
 def create_tables_from_query_ids(user,
                                  connection,
                                  query_ids,
-                                 cached_query_ids=[]):
+                                 cached_query_ids=[],
+                                 indexed_columns=()):
+    materialized_results = get_materialized_results()
+    attached = 0
+
+    tables = []
     for query_id in set(cached_query_ids):
-        results = get_query_results(user, query_id, True)
+        started_at = time.time()
+        query = _load_query(user, query_id)
+        _check_cached_results(query)
         table_name = 'cached_query_{query_id}'.format(query_id=query_id)
-        create_table(connection, table_name, results)
 
-    for query_id in set(query_ids):
-        results = get_query_results(user, query_id, False)
-        table_name = 'query_{query_id}'.format(query_id=query_id)
-        create_table(connection, table_name, results)
+        if materialized_results is not None and attached < MAX_ATTACHED_DATABASES:
+            materialized_results.attach(connection, table_name, query.latest_query_data_id,
+                                        query.latest_query_data.get_data, indexed_columns)
+            attached += 1
+            logger.info("Attached cached results of query %d in %.3fs", query_id, time.time() - started_at)
+        else:
+            tables.append((table_name, query.latest_query_data.get_data()))
+            logger.info("Loaded cached results of query %d in %.3fs", query_id, time.time() - started_at)
+
+    # Access to all the queries is checked before running any of them.
+    queries = [_load_query(user, query_id) for query_id in set(query_ids)]
+    for query, results in zip(queries, run_queries(user, queries)):
+        tables.append(('query_{query_id}'.format(query_id=query.id), results))
+
+    # All the tables are loaded in one transaction (sqlite3 would otherwise commit before each CREATE TABLE).
+    isolation_level = connection.isolation_level
+    connection.isolation_level = None
+    connection.execute('BEGIN')
+    try:
+        for table_name, results in tables:
+            create_table(connection, table_name, results, indexed_columns)
+
+        connection.execute('COMMIT')
+    except Exception:
+        connection.execute('ROLLBACK')
+        raise
+    finally:
+        connection.isolation_level = isolation_level
+
+
+class MaterializedResults(object):
+    """Tables of query results, in SQLite files, for reuse across runs of the worker process.
+
+    Each query result gets a file (named by its id) with its rows in the `result` table, and the indexes of every
+    query that attached it so far. The files are limited to `max_size` bytes overall: the least recently used ones
+    are removed to make room. Connections that have a file attached keep reading it even after it's removed.
+    """
+
+    def __init__(self, directory, max_size):
+        directory = directory or tempfile.gettempdir()
+        _remove_stale_directories(directory)
+
+        self.directory = os.path.join(directory, _directory_name(os.getpid()))
+        shutil.rmtree(self.directory, True)
+        os.makedirs(self.directory, 0o700)
+        self.max_size = max_size
+        self.pid = os.getpid()
+        self._files = OrderedDict()
+        self._lock = threading.Lock()
+        atexit.register(self.remove)
+
+    def remove(self):
+        """Removes the files. Forked processes inherit the exit handlers of their parent, but not its cache."""
+        if os.getpid() == self.pid:
+            shutil.rmtree(self.directory, True)
+
+    def attach(self, connection, table_name, query_result_id, load_results, indexed_columns=()):
+        """Makes the result available to the connection as `table_name`, calling `load_results()` for its data when
+        it isn't materialized yet."""
+        indexed_columns = frozenset(indexed_columns)
+        with self._lock:
+            attached = self._attach(connection, table_name, query_result_id, indexed_columns)
+            self._evict()
+
+        if not attached:
+            path, size = self._materialize(query_result_id, load_results(), indexed_columns)
+            with self._lock:
+                self._files.pop(query_result_id, None)
+                self._files[query_result_id] = (path, size, indexed_columns)
+                self._attach(connection, table_name, query_result_id, indexed_columns)
+                self._evict()
+
+    def _attach(self, connection, table_name, query_result_id, indexed_columns):
+        entry = self._files.pop(query_result_id, None)
+        if entry is None:
+            return False
+
+        path, size, file_indexed_columns = entry
+        if not indexed_columns <= file_indexed_columns:
+            # The file was materialized for queries that filtered on other columns.
+            try:
+                size = self._add_indexes(path, indexed_columns)
+            except Exception:
+                os.remove(path)
+                raise
+            file_indexed_columns = file_indexed_columns | indexed_columns
+
+        self._files[query_result_id] = (path, size, file_indexed_columns)
+        database = u'{}_db'.format(table_name)
+        connection.execute(u'ATTACH DATABASE ? AS "{}"'.format(database), (path,))
+        connection.execute(u'PRAGMA "{}".mmap_size = {}'.format(database, size))
+        connection.execute(u'CREATE TEMP VIEW {} AS SELECT * FROM "{}".result'.format(table_name, database))
+        return True
+
+    def _materialize(self, query_result_id, results, indexed_columns):
+        fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=self.directory)
+        os.close(fd)
+
+        try:
+            file_connection = sqlite3.connect(tmp_path)
+            try:
+                file_connection.execute('PRAGMA journal_mode = OFF')
+                file_connection.execute('PRAGMA synchronous = OFF')
+                create_table(file_connection, 'result', results, indexed_columns)
+                file_connection.commit()
+            finally:
+                file_connection.close()
+
+            path = os.path.join(self.directory, '{}.sqlite'.format(query_result_id))
+            os.rename(tmp_path, path)
+        except Exception:
+            os.remove(tmp_path)
+            raise
+
+        return path, os.path.getsize(path)
+
+    def _add_indexes(self, path, indexed_columns):
+        file_connection = sqlite3.connect(path)
+        try:
+            columns = [fix_column_name(column[1]) for column in file_connection.execute('PRAGMA table_info(result)')]
+            create_indexes(file_connection, 'result', columns, indexed_columns)
+            file_connection.commit()
+        finally:
+            file_connection.close()
+
+        return os.path.getsize(path)
+
+    def _evict(self):
+        size = sum(size for _, size, _ in self._files.values())
+        while size > self.max_size and self._files:
+            _, (path, file_size, _) = self._files.popitem(last=False)
+            os.remove(path)
+            size -= file_size
+
+
+def _directory_name(pid):
+    # The host name keeps apart the processes of different hosts (or containers) sharing the directory.
+    return '{}{}-{}'.format(CACHE_DIRECTORY_PREFIX, socket.gethostname(), pid)
+
+
+def _is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+def _remove_stale_directories(directory):
+    """Removes the directories of processes of this host that are gone without removing theirs (like killed workers,
+    or pool processes, which exit without running exit handlers)."""
+    prefix = _directory_name('')
+    for name in os.listdir(directory):
+        pid = name[len(prefix):]
+        if name.startswith(prefix) and pid.isdigit() and not _is_running(int(pid)):
+            shutil.rmtree(os.path.join(directory, name), True)
+
+
+_materialized_results = None
+_materialized_results_lock = threading.Lock()
+
+
+def get_materialized_results():
+    """Returns the MaterializedResults of this process, or None when disabled."""
+    global _materialized_results
+
+    if settings.QUERY_RESULTS_RUNNER_CACHE_SIZE <= 0:
+        return None
+
+    with _materialized_results_lock:
+        if _materialized_results is None or _materialized_results.pid != os.getpid():
+            _materialized_results = MaterializedResults(settings.QUERY_RESULTS_RUNNER_CACHE_DIR or None,
+                                                        settings.QUERY_RESULTS_RUNNER_CACHE_SIZE)
+        return _materialized_results
+
+
+def remove_materialized_results():
+    """Removes the files of this process' MaterializedResults, if any."""
+    with _materialized_results_lock:
+        if _materialized_results is not None:
+            _materialized_results.remove()
 
 
 def fix_column_name(name):
@@ -88,14 +329,22 @@ def flatten(value):
         return value
 
 
-def create_table(connection, table_name, query_results):
+def create_table(connection, table_name, query_results, indexed_columns=()):
+    """Creates the table of a result and loads its rows.
+
+    Columns get the SQLite affinity of their type, and the columns named in `indexed_columns` (lowercased) are indexed
+    once the rows are loaded.
+    """
     try:
         columns = [column['name'] for column in query_results['columns']]
         safe_columns = [fix_column_name(column) for column in columns]
 
         column_list = ", ".join(safe_columns)
-        create_table = u"CREATE TABLE {table_name} ({column_list})".format(
-            table_name=table_name, column_list=column_list)
+        column_definitions = ", ".join(
+            u"{} {}".format(safe_column, SQLITE_AFFINITIES.get(column.get('type'), '')).strip()
+            for (safe_column, column) in zip(safe_columns, query_results['columns']))
+        create_table = u"CREATE TABLE {table_name} ({column_definitions})".format(
+            table_name=table_name, column_definitions=column_definitions)
         logger.debug("CREATE TABLE query: %s", create_table)
         connection.execute(create_table)
     except sqlite3.OperationalError as exc:
@@ -107,18 +356,44 @@ def create_table(connection, table_name, query_results):
         column_list=column_list,
         place_holders=','.join(['?'] * len(columns)))
 
-    for row in query_results['rows']:
-        values = [flatten(row.get(column)) for column in columns]
-        connection.execute(insert_template, values)
+    # Every value is flattened, whatever the declared type of its column: types aren't enforced.
+    connection.executemany(insert_template, (
+        [flatten(row.get(column)) for column in columns]
+        for row in query_results['rows']))
+
+    create_indexes(connection, table_name, safe_columns, indexed_columns)
+
+
+def create_indexes(connection, table_name, safe_columns, indexed_columns):
+    """Indexes the columns of the table named in `indexed_columns` (lowercased), unless they already are."""
+    for (i, safe_column) in enumerate(safe_columns):
+        if safe_column.strip('"').lower() in indexed_columns:
+            connection.execute(u"CREATE INDEX IF NOT EXISTS {table_name}_{i} ON {table_name} ({column})".format(
+                table_name=table_name, i=i, column=safe_column))
+
+
+def update_column_types(columns, guesser, rows):
+    guesser.update(rows)
+    for column, column_type in zip(columns, guesser.types):
+        column['type'] = column_type
 
 
 class Results(BaseQueryRunner):
     should_annotate_query = False
+    supports_streaming = True
     noop_query = 'SELECT 1'
 
     @classmethod
     def configuration_schema(cls):
-        return {"type": "object", "properties": {}}
+        return {
+            "type": "object",
+            "properties": {
+                "index_condition_columns": {
+                    "type": "boolean",
+                    "title": "Index columns used in JOIN and WHERE conditions"
+                }
+            }
+        }
 
     @classmethod
     def name(cls):
@@ -127,10 +402,7 @@ class Results(BaseQueryRunner):
     def run_query(self, query, user):
         connection = sqlite3.connect(':memory:')
 
-        query_ids = extract_query_ids(query)
-        cached_query_ids = extract_cached_query_ids(query)
-        create_tables_from_query_ids(user, connection, query_ids,
-                                     cached_query_ids)
+        self._create_tables(connection, query, user)
 
         cursor = connection.cursor()
 
@@ -143,17 +415,11 @@ class Results(BaseQueryRunner):
 
                 rows = []
                 column_names = [c['name'] for c in columns]
+                guesser = ColumnTypeGuesser(range(len(columns)))
 
-                for i, row in enumerate(cursor):
-                    for j, col in enumerate(row):
-                        guess = guess_type(col)
-
-                        if columns[j]['type'] is None:
-                            columns[j]['type'] = guess
-                        elif columns[j]['type'] != guess:
-                            columns[j]['type'] = TYPE_STRING
-
-                    rows.append(dict(zip(column_names, row)))
+                for batch in fetch_batches(cursor):
+                    update_column_types(columns, guesser, batch)
+                    rows.extend(dict(zip(column_names, row)) for row in batch)
 
                 data = {'columns': columns, 'rows': rows}
                 error = None
@@ -169,5 +435,44 @@ class Results(BaseQueryRunner):
             connection.close()
         return json_data, error
 
+    def run_query_iter(self, query, user):
+        connection = sqlite3.connect(':memory:')
+
+        try:
+            self._create_tables(connection, query, user)
+
+            cursor = connection.cursor()
+            cursor.execute(query)
+
+            if cursor.description is None:
+                raise Exception('Query completed but it returned no data.')
+        except Exception:
+            connection.close()
+            raise
+
+        columns = self.fetch_columns([(i[0], None) for i in cursor.description])
+
+        return columns, self._iter_batches(connection, cursor, columns)
+
+    def _create_tables(self, connection, query, user):
+        indexed_columns = ()
+        if self.configuration.get('index_condition_columns', False):
+            indexed_columns = extract_condition_columns(query)
+
+        create_tables_from_query_ids(user, connection, extract_query_ids(query), extract_cached_query_ids(query),
+                                     indexed_columns)
+
+    def _iter_batches(self, connection, cursor, columns):
+        # Column types are guessed from the data, so they are only final once the sampled batches were consumed.
+        column_names = [c['name'] for c in columns]
+        guesser = ColumnTypeGuesser(range(len(columns)))
+
+        try:
+            for rows in fetch_batches(cursor):
+                update_column_types(columns, guesser, rows)
+                yield [dict(zip(column_names, row)) for row in rows]
+        finally:
+            connection.close()
+
 
 register(Results)
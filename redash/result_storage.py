@@ -0,0 +1,182 @@
+"""
+External storage for large query results.
+
+Query results above settings.QUERY_RESULTS_STORAGE_THRESHOLD bytes are kept in the storage configured with
+settings.QUERY_RESULTS_STORAGE_URL instead of the `query_results.data` column, which keeps multi megabyte blobs out of
+the WAL, the replicas and vacuum. The `query_results` row keeps the key of the blob, its SHA-256 hash and its size.
+
+The storage is selected by the scheme of the URL (e.g. `file:///var/lib/redash/query_results`). Additional storages
+can be added by subclassing `BaseResultStorage` and registering them.
+"""
+import errno
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+import uuid
+
+from six.moves.urllib.parse import urlparse
+
+from redash import settings
+
+logger = logging.getLogger(__name__)
+
+
+class ResultStorageError(Exception):
+    pass
+
+
+class BaseResultStorage(object):
+    scheme = None
+
+    def __init__(self, url):
+        self.url = url
+
+    def put(self, key, content):
+        """Stores `content` (bytes, or a file object to read until its end) under `key`."""
+        raise NotImplementedError()
+
+    def get(self, key):
+        """Returns the bytes stored under `key`."""
+        raise NotImplementedError()
+
+    def delete(self, key):
+        """Deletes the blob stored under `key`. Deleting a missing blob is not an error."""
+        raise NotImplementedError()
+
+
+class FileSystemResultStorage(BaseResultStorage):
+    scheme = 'file'
+
+    def __init__(self, url):
+        super(FileSystemResultStorage, self).__init__(url)
+        self.root = urlparse(url).path
+
+    def _path(self, key):
+        return os.path.join(self.root, *key.split('/'))
+
+    def put(self, key, content):
+        path = self._path(key)
+        directory = os.path.dirname(path)
+
+        try:
+            os.makedirs(directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+        # Write to a temporary file first, so a blob is never visible half written.
+        fd, tmp_path = tempfile.mkstemp(dir=directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                if isinstance(content, bytes):
+                    f.write(content)
+                else:
+                    shutil.copyfileobj(content, f)
+            os.rename(tmp_path, path)
+        except Exception:
+            os.remove(tmp_path)
+            raise
+
+    def get(self, key):
+        with open(self._path(key), 'rb') as f:
+            return f.read()
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+
+storages = {}
+
+
+def register(storage_class):
+    storages[storage_class.scheme] = storage_class
+
+
+_storage = None
+
+
+def get_result_storage():
+    """Returns the configured result storage, or None if external storage isn't configured."""
+    global _storage
+
+    if not settings.QUERY_RESULTS_STORAGE_URL:
+        return None
+
+    if _storage is None or _storage.url != settings.QUERY_RESULTS_STORAGE_URL:
+        scheme = urlparse(settings.QUERY_RESULTS_STORAGE_URL).scheme
+        if scheme not in storages:
+            raise ResultStorageError("Unsupported query results storage: {}".format(scheme))
+        _storage = storages[scheme](settings.QUERY_RESULTS_STORAGE_URL)
+
+    return _storage
+
+
+def content_hash(content):
+    return hashlib.sha256(content).hexdigest()
+
+
+class _HashingReader(object):
+    """Wraps a file object to hash and count the bytes read from it, so a file is stored in a single pass."""
+
+    def __init__(self, f):
+        self._file = f
+        self._hash = hashlib.sha256()
+        self.size = 0
+
+    def read(self, size=-1):
+        chunk = self._file.read(size)
+        self._hash.update(chunk)
+        self.size += len(chunk)
+        return chunk
+
+    def hexdigest(self):
+        return self._hash.hexdigest()
+
+
+def put_result(org_id, content):
+    """Stores an encoded result (bytes, or a file object, which is streamed to the storage) and returns its (key,
+    hash, size)."""
+    storage = get_result_storage()
+    key = '{}/{}'.format(org_id, uuid.uuid4().hex)
+
+    if isinstance(content, bytes):
+        storage.put(key, content)
+        return key, content_hash(content), len(content)
+
+    reader = _HashingReader(content)
+    storage.put(key, reader)
+    return key, reader.hexdigest(), reader.size
+
+
+def get_result(key, expected_hash=None):
+    storage = get_result_storage()
+    if storage is None:
+        raise ResultStorageError("Query result {} is in external storage, but no storage is configured.".format(key))
+
+    content = storage.get(key)
+    if expected_hash is not None and content_hash(content) != expected_hash:
+        raise ResultStorageError("Content hash mismatch for query result {}.".format(key))
+
+    return content
+
+
+def delete_results(keys):
+    """Deletes the blobs of deleted query results. Failures are logged, as the rows are already gone."""
+    storage = get_result_storage()
+    if storage is None:
+        return
+
+    for key in keys:
+        try:
+            storage.delete(key)
+        except Exception:
+            logger.exception("Failed deleting query result %s from external storage.", key)
+
+
+register(FileSystemResultStorage)
@@ -12,7 +12,9 @@ from redash.permissions import has_access, view_only
 from redash.utils import json_loads
 from redash.models.parameterized_query import ParameterizedQuery
 
-from .query_result import serialize_query_result, serialize_query_result_to_csv, serialize_query_result_to_xlsx
+from .query_result import (arrow_enabled, serialize_query_result, serialize_query_result_to_csv,
+                           serialize_query_result_to_json, serialize_query_result_to_xlsx, stream_query_result_to_arrow,
+                           stream_query_result_to_csv, write_query_result_to_xlsx)
 
 
 def public_widget(widget):
@@ -1,12 +1,43 @@
 import cStringIO
-import csv
+import datetime
+import re
+from itertools import islice
+
 import xlsxwriter
 from funcy import rpartial, project
+from dateutil import tz
 from dateutil.parser import isoparse as parse_date
-from redash.utils import json_loads, UnicodeWriter
-from redash.query_runner import (TYPE_BOOLEAN, TYPE_DATE, TYPE_DATETIME)
+from six import text_type
+from redash import query_result_cache
+from redash.utils import UnicodeWriter, json_dumps
+from redash.utils.query_results import iter_rows
+from redash.query_runner import (TYPE_BOOLEAN, TYPE_DATE, TYPE_DATETIME, TYPE_FLOAT, TYPE_INTEGER, TYPE_STRING)
 from redash.authentication.org_resolving import current_org
 
+try:
+    import pyarrow
+    import pyarrow.parquet
+    arrow_enabled = True
+except ImportError:
+    arrow_enabled = False
+
+# Rows converted and encoded at a time when streaming CSV responses.
+CSV_BATCH_SIZE = 1000
+
+# Rows in each record batch (Parquet row group) of Arrow and Parquet responses.
+ARROW_BATCH_SIZE = 10000
+
+# Rows in an Excel sheet.
+XLSX_MAX_ROWS = 1048576
+
+
+# The ISO 8601 layouts query runners usually return: a date, optionally followed by a time (with seconds and fraction
+# optional) and a UTC offset. Values in other layouts are parsed by dateutil.
+_ISO_DATETIME_RE = re.compile(r'(\d{4})-(\d{2})-(\d{2})'
+                              r'(?:[T ](\d{2}):(\d{2})(?::(\d{2})(?:\.(\d{1,6}))?)?'
+                              r'(Z|[+-](?:[01]\d|2[0-3])(?::?[0-5]\d)?)?)?\Z')
+_UTC = tz.tzutc()
+
 
 def _convert_format(fmt):
     return fmt.replace('DD', '%d').replace('MM', '%m').replace('YYYY', '%Y').replace('YY', '%y').replace('HH', '%H').replace('mm', '%M').replace('ss', '%s')
@@ -21,12 +52,35 @@ def _convert_bool(value):
     return value
 
 
+def _parse_datetime(value):
+    """Parses an ISO 8601 date or datetime, like dateutil's isoparse (which is used for the less common layouts)."""
+    match = _ISO_DATETIME_RE.match(value)
+    if match is None:
+        return parse_date(value)
+
+    year, month, day, hour, minute, second, fraction, zone = match.groups()
+
+    tzinfo = None
+    if zone == 'Z':
+        tzinfo = _UTC
+    elif zone:
+        offset = int(zone[1:3]) * 3600 + int(zone[-2:] if len(zone) > 3 else 0) * 60
+        tzinfo = tz.tzoffset(None, -offset if zone[0] == '-' else offset)
+
+    try:
+        return datetime.datetime(int(year), int(month), int(day), int(hour or 0), int(minute or 0), int(second or 0),
+                                 int((fraction or '0').ljust(6, '0')), tzinfo)
+    except ValueError:
+        # Out of range fields, like 24:00 (which isoparse takes as midnight of the next day).
+        return parse_date(value)
+
+
 def _convert_datetime(value, fmt):
     if not value:
         return value
 
     try:
-        parsed = parse_date(value)
+        parsed = _parse_datetime(value)
         ret = parsed.strftime(fmt)
     except Exception:
         return value
@@ -34,14 +88,54 @@ def _convert_datetime(value, fmt):
     return ret
 
 
+def _format_template(fmt):
+    """Returns a str.format template equivalent to the strftime format `fmt`, or None if it has other directives than
+    the ones _convert_format outputs for dates and times (besides seconds)."""
+    template = fmt.replace('{', '{{').replace('}', '}}')
+    for directive in ('Y', 'y', 'm', 'd', 'H', 'M'):
+        template = template.replace('%' + directive, '{' + directive + '}')
+
+    return None if '%' in template else template
+
+
+def _datetime_converter(fmt):
+    """Returns the converter of a date or datetime column's values to `fmt`.
+
+    ISO 8601 values are reformatted from the digits of their fields, without building datetimes out of them. Other
+    values go through _convert_datetime.
+    """
+    template = _format_template(fmt)
+    if template is None:
+        return rpartial(_convert_datetime, fmt)
+
+    def converter(value):
+        match = _ISO_DATETIME_RE.match(value) if isinstance(value, basestring) else None
+        if match is None:
+            return _convert_datetime(value, fmt)
+
+        year, month, day, hour, minute, second = match.group(1, 2, 3, 4, 5, 6)
+        hour, minute, second = hour or '00', minute or '00', second or '00'
+        if hour > '23' or minute > '59' or second > '59':
+            return _convert_datetime(value, fmt)
+
+        try:
+            datetime.date(int(year), int(month), int(day))
+        except ValueError:
+            return value
+
+        return template.format(Y=year, y=year[2:], m=month, d=day, H=hour, M=minute)
+
+    return converter
+
+
 def _get_column_lists(columns):
-    date_format = _convert_format(current_org.get_setting('date_format'))
-    datetime_format = _convert_format('{} {}'.format(current_org.get_setting('date_format'), current_org.get_setting('time_format')))
+    date_format = current_org.get_setting('date_format')
+    time_format = current_org.get_setting('time_format')
 
     special_types = {
         TYPE_BOOLEAN: _convert_bool,
-        TYPE_DATE: rpartial(_convert_datetime, date_format),
-        TYPE_DATETIME: rpartial(_convert_datetime, datetime_format)
+        TYPE_DATE: _datetime_converter(_convert_format(date_format)),
+        TYPE_DATETIME: _datetime_converter(_convert_format('{} {}'.format(date_format, time_format)))
     }
 
     fieldnames = []
@@ -50,9 +144,8 @@ def _get_column_lists(columns):
     for col in columns:
         fieldnames.append(col['name'])
 
-        for col_type in special_types.keys():
-            if col['type'] == col_type:
-                special_columns[col['name']] = special_types[col_type]
+        if col.get('type') in special_types:
+            special_columns[col['name']] = special_types[col['type']]
 
     return fieldnames, special_columns
 
@@ -65,46 +158,292 @@ def serialize_query_result(query_result, is_api_user):
         return query_result.to_dict()
 
 
+def serialize_query_result_to_json(query_result, is_api_user=False):
+    """Returns the JSON of the `{"query_result": ...}` API response, from the query results cache when possible."""
+    variant = 'public' if is_api_user else 'full'
+    body = query_result_cache.get(query_result.id, variant)
+    if body is None:
+        body = json_dumps({'query_result': serialize_query_result(query_result, is_api_user)})
+        query_result_cache.put(query_result.id, variant, body)
+
+    return body
+
+
 def serialize_query_result_to_csv(query_result):
-    s = cStringIO.StringIO()
+    return ''.join(stream_query_result_to_csv(query_result))
 
-    query_data = json_loads(query_result.data)
 
+def stream_query_result_to_csv(query_result, batch_size=CSV_BATCH_SIZE):
+    """Returns an iterator over the CSV of the result, in chunks of `batch_size` rows.
+
+    The columns are decoded (and the organization's formats are read) right away, so most errors surface before
+    anything is sent. Rows are decoded, converted and encoded as the chunks are consumed, unless the stored result
+    doesn't start with its rows (see `load_result_lazily`), in which case it's parsed in full upfront.
+    """
+    query_data = query_result.get_stored_data(lazy_rows=True)
     fieldnames, special_columns = _get_column_lists(query_data['columns'] or [])
 
-    writer = csv.DictWriter(s, extrasaction="ignore", fieldnames=fieldnames)
-    writer.writer = UnicodeWriter(s)
-    writer.writeheader()
+    return _iter_csv_chunks(query_data, fieldnames, special_columns, batch_size)
+
+
+def _iter_csv_chunks(query_data, fieldnames, special_columns, batch_size):
+    s = cStringIO.StringIO()
+    writer = UnicodeWriter(s)
+
+    writer.writerow(fieldnames)
+    yield _flush(s)
+
+    rows = iter_rows(query_data)
+    while True:
+        batch = list(islice(rows, batch_size))
+        if not batch:
+            break
 
-    for row in query_data['rows']:
         for col_name, converter in special_columns.iteritems():
-            if col_name in row:
-                row[col_name] = converter(row[col_name])
+            for row in batch:
+                if col_name in row:
+                    row[col_name] = converter(row[col_name])
 
-        writer.writerow(row)
+        writer.writerows([row.get(name, '') for name in fieldnames] for row in batch)
+        yield _flush(s)
 
-    return s.getvalue()
+
+def _flush(s):
+    chunk = s.getvalue()
+    s.seek(0)
+    s.truncate()
+    return chunk
 
 
 def serialize_query_result_to_xlsx(query_result):
     s = cStringIO.StringIO()
+    write_query_result_to_xlsx(query_result, s)
+    return s.getvalue()
+
+
+def write_query_result_to_xlsx(query_result, f):
+    """Writes the workbook of the result to the (binary) file `f`.
+
+    Excel sheets are limited to XLSX_MAX_ROWS rows: when the result has more, the last row of the sheet says how many
+    of them were left out.
+    """
+    query_data = query_result.get_stored_data()
+    columns = query_data['columns'] or []
+    rows = query_data['rows'] or []
 
-    query_data = json_loads(query_result.data)
-    book = xlsxwriter.Workbook(s, {'constant_memory': True})
+    book = xlsxwriter.Workbook(f, {'constant_memory': True})
     sheet = book.add_worksheet("result")
 
-    column_names = []
-    for (c, col) in enumerate(query_data['columns']):
-        sheet.write(0, c, col['name'])
-        column_names.append(col['name'])
+    for (c, col) in enumerate(columns):
+        sheet.write_string(0, c, col['name'])
 
-    for (r, row) in enumerate(query_data['rows']):
-        for (c, name) in enumerate(column_names):
+    writers = [(c, col['name'], _get_xlsx_writer(book, sheet, col.get('type'))) for (c, col) in enumerate(columns)]
+
+    # One row goes to the column names.
+    max_rows = XLSX_MAX_ROWS - 1
+    truncated = len(rows) > max_rows
+    if truncated:
+        max_rows -= 1
+
+    r = 0
+    for (r, row) in enumerate(islice(iter_rows(query_data), max_rows), 1):
+        for (c, name, writer) in writers:
             v = row.get(name)
-            if isinstance(v, list) or isinstance(v, dict):
-                v = str(v).encode('utf-8')
-            sheet.write(r + 1, c, v)
+            if v is not None:
+                writer(r, c, v)
+
+    if truncated:
+        sheet.write_string(r + 1, 0, u"Truncated: showing the first {} of {} rows (Excel's row limit).".format(
+            max_rows, len(rows)))
 
     book.close()
 
-    return s.getvalue()
+
+def _get_xlsx_writer(book, sheet, col_type):
+    """Returns a function writing a (non null) value of a column of type `col_type`.
+
+    Values that don't match the column type are written as they come.
+    """
+    def write_value(r, c, v):
+        if isinstance(v, (list, dict)):
+            v = json_dumps(v)
+        sheet.write(r, c, v)
+
+    if col_type in (TYPE_INTEGER, TYPE_FLOAT):
+        def write_number(r, c, v):
+            if isinstance(v, (int, long, float)) and not isinstance(v, bool):
+                sheet.write_number(r, c, v)
+            else:
+                write_value(r, c, v)
+        return write_number
+
+    if col_type == TYPE_BOOLEAN:
+        def write_boolean(r, c, v):
+            if isinstance(v, bool):
+                sheet.write_boolean(r, c, v)
+            else:
+                write_value(r, c, v)
+        return write_boolean
+
+    if col_type in (TYPE_DATE, TYPE_DATETIME):
+        fmt = current_org.get_setting('date_format')
+        if col_type == TYPE_DATETIME:
+            fmt = '{} {}'.format(fmt, current_org.get_setting('time_format'))
+        cell_format = book.add_format({'num_format': fmt.lower()})
+
+        def write_date(r, c, v):
+            if isinstance(v, basestring) and v:
+                try:
+                    parsed = _parse_datetime(v)
+                except ValueError:
+                    sheet.write_string(r, c, v)
+                    return
+                sheet.write_datetime(r, c, parsed.replace(tzinfo=None), cell_format)
+            else:
+                write_value(r, c, v)
+        return write_date
+
+    if col_type == TYPE_STRING:
+        def write_string(r, c, v):
+            if isinstance(v, basestring):
+                sheet.write_string(r, c, v)
+            else:
+                write_value(r, c, v)
+        return write_string
+
+    return write_value
+
+
+def _to_bool(value):
+    if isinstance(value, bool):
+        return value
+    return {'true': True, 'false': False}[value.lower()]
+
+
+def _to_int(value):
+    # int() would truncate fractions.
+    if isinstance(value, float) and not value.is_integer():
+        raise ValueError(u"{} is not an integer".format(value))
+    return int(value)
+
+
+def _to_datetime(value):
+    """Naive UTC datetime of an ISO 8601 string; naive values are taken as UTC already."""
+    if not isinstance(value, datetime.datetime):
+        value = _parse_datetime(value)
+    if value.tzinfo is not None:
+        value = value.astimezone(tz.tzutc()).replace(tzinfo=None)
+    return value
+
+
+def _to_date(value):
+    if isinstance(value, datetime.date) and not isinstance(value, datetime.datetime):
+        return value
+    return _to_datetime(value).date()
+
+
+def _to_text(value):
+    if isinstance(value, (list, dict)):
+        return json_dumps(value)
+    if isinstance(value, basestring):
+        return value
+    return text_type(value)
+
+
+def _nullable(convert):
+    """Wraps a converter so it maps null and unconvertible values to null."""
+    def converter(value):
+        if value is None:
+            return None
+        try:
+            return convert(value)
+        except Exception:
+            return None
+
+    return converter
+
+
+def _get_arrow_columns(columns):
+    """Returns the Arrow schema of the result's columns and the converter of each column's values."""
+    types = {
+        TYPE_INTEGER: (pyarrow.int64(), _to_int),
+        TYPE_FLOAT: (pyarrow.float64(), float),
+        TYPE_BOOLEAN: (pyarrow.bool_(), _to_bool),
+        TYPE_DATETIME: (pyarrow.timestamp('us'), _to_datetime),
+        TYPE_DATE: (pyarrow.date32(), _to_date),
+    }
+
+    fields = []
+    converters = []
+    for col in columns:
+        arrow_type, convert = types.get(col.get('type'), (pyarrow.string(), _to_text))
+        fields.append(pyarrow.field(col['name'], arrow_type))
+        converters.append(_nullable(convert))
+
+    return pyarrow.schema(fields), converters
+
+
+def stream_query_result_to_arrow(query_result, file_format='arrow', batch_size=ARROW_BATCH_SIZE):
+    """Returns an iterator over the result in the Arrow IPC stream format (or Parquet), one record batch at a time.
+
+    Columns are typed from the types the query runner declared; values that don't convert to their column's type
+    (e.g. a string or a fraction in an integer column) become nulls. Datetimes are in UTC.
+    """
+    query_data = query_result.get_stored_data()
+    schema, converters = _get_arrow_columns(query_data['columns'] or [])
+
+    return _iter_arrow_chunks(query_data, schema, converters, file_format, batch_size)
+
+
+def _iter_arrow_chunks(query_data, schema, converters, file_format, batch_size):
+    sink = _ChunkSink()
+    if file_format == 'parquet':
+        writer = pyarrow.parquet.ParquetWriter(pyarrow.PythonFile(sink, mode='w'), schema)
+
+        def write_batch(batch):
+            writer.write_table(pyarrow.Table.from_batches([batch]))
+    else:
+        writer = pyarrow.RecordBatchStreamWriter(pyarrow.PythonFile(sink, mode='w'), schema)
+        write_batch = writer.write_batch
+
+    columns = list(zip(schema.names, schema.types, converters))
+    rows = iter_rows(query_data)
+    while True:
+        batch = list(islice(rows, batch_size))
+        if not batch:
+            break
+
+        arrays = [pyarrow.array([convert(row.get(name)) for row in batch], type=arrow_type)
+                  for (name, arrow_type, convert) in columns]
+        write_batch(pyarrow.RecordBatch.from_arrays(arrays, schema.names))
+        yield sink.take()
+
+    writer.close()
+    yield sink.take()
+
+
+class _ChunkSink(object):
+    """Write-only file keeping what's written to it until taken."""
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data):
+        self.chunks.append(data)
+        self.position += len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def take(self):
+        chunk = b''.join(self.chunks)
+        self.chunks = []
+        return chunk
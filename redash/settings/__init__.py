@@ -51,6 +51,57 @@ QUERY_RESULTS_CLEANUP_ENABLED = parse_boolean(os.environ.get("REDASH_QUERY_RESUL
 QUERY_RESULTS_CLEANUP_COUNT = int(os.environ.get("REDASH_QUERY_RESULTS_CLEANUP_COUNT", "100"))
 QUERY_RESULTS_CLEANUP_MAX_AGE = int(os.environ.get("REDASH_QUERY_RESULTS_CLEANUP_MAX_AGE", "7"))
 
+# Stream rows from query runners that support it (see BaseQueryRunner.run_query_iter) in batches, encoding them into
+# a temporary file as they arrive instead of building the whole result in memory. Results smaller than the spool size
+# never touch the disk.
+QUERY_RESULTS_STREAMING_ENABLED = parse_boolean(os.environ.get("REDASH_QUERY_RESULTS_STREAMING_ENABLED", "false"))
+QUERY_RESULTS_STREAMING_BATCH_SIZE = int(os.environ.get("REDASH_QUERY_RESULTS_STREAMING_BATCH_SIZE", "5000"))
+QUERY_RESULTS_STREAMING_SPOOL_SIZE = int(os.environ.get("REDASH_QUERY_RESULTS_STREAMING_SPOOL_SIZE", 10 * 1024 * 1024))
+
+# Store new query results in the compact format (rows as arrays instead of objects keyed by column name). Results
+# in the legacy format stay readable; when enabled, a periodic job also converts existing results in batches.
+QUERY_RESULTS_COMPACT_FORMAT = parse_boolean(os.environ.get("REDASH_QUERY_RESULTS_COMPACT_FORMAT", "false"))
+QUERY_RESULTS_COMPACT_BATCH_SIZE = int(os.environ.get("REDASH_QUERY_RESULTS_COMPACT_BATCH_SIZE", "100"))
+
+# Compress stored query results larger than the threshold (in bytes) with zlib. Compressed results are always readable,
+# regardless of this setting. Use `manage.py database compress_query_results` to compress existing results.
+QUERY_RESULTS_COMPRESSION_ENABLED = parse_boolean(os.environ.get("REDASH_QUERY_RESULTS_COMPRESSION_ENABLED", "false"))
+QUERY_RESULTS_COMPRESSION_THRESHOLD = int(os.environ.get("REDASH_QUERY_RESULTS_COMPRESSION_THRESHOLD", 32 * 1024))
+QUERY_RESULTS_COMPRESSION_LEVEL = int(os.environ.get("REDASH_QUERY_RESULTS_COMPRESSION_LEVEL", "6"))
+
+# Keep results larger than the threshold (in bytes, after encoding) outside of the database, in the storage at this URL
+# (e.g. file:///var/lib/redash/query_results). Disabled when empty.
+QUERY_RESULTS_STORAGE_URL = os.environ.get("REDASH_QUERY_RESULTS_STORAGE_URL", "")
+QUERY_RESULTS_STORAGE_THRESHOLD = int(os.environ.get("REDASH_QUERY_RESULTS_STORAGE_THRESHOLD", 1024 * 1024))
+
+# Cache the JSON of query results served by the API in Redis, up to this many bytes overall (least recently used
+# results are evicted first). Results larger than the item size aren't cached. Disabled when 0.
+QUERY_RESULTS_CACHE_SIZE = int(os.environ.get("REDASH_QUERY_RESULTS_CACHE_SIZE", "0"))
+QUERY_RESULTS_CACHE_MAX_ITEM_SIZE = int(os.environ.get("REDASH_QUERY_RESULTS_CACHE_MAX_ITEM_SIZE", 5 * 1024 * 1024))
+
+# How many of the queries referenced by a Query Results data source query (as `query_<id>`) run at the same time.
+QUERY_RESULTS_RUNNER_CONCURRENCY = int(os.environ.get("REDASH_QUERY_RESULTS_RUNNER_CONCURRENCY", "4"))
+
+# Keep the tables the Query Results data source loads from cached results (`cached_query_<id>`) in SQLite files, in a
+# directory of each worker process under this one (the system's temporary directory when empty), for reuse while the
+# cached result doesn't change. Up to this many bytes per worker (least recently used first evicted). Disabled when 0.
+# The cache lives as long as the worker process: workers recycled often (--max-tasks-per-child) rarely reuse it. The
+# directory of a worker is removed when it exits, or (if it was killed) when another worker of the host starts a cache.
+QUERY_RESULTS_RUNNER_CACHE_SIZE = int(os.environ.get("REDASH_QUERY_RESULTS_RUNNER_CACHE_SIZE", "0"))
+QUERY_RESULTS_RUNNER_CACHE_DIR = os.environ.get("REDASH_QUERY_RESULTS_RUNNER_CACHE_DIR", "")
+
+# How many rows of a result are looked at to guess the types of its columns, by query runners that guess them (like the
+# Query Results data source).
+TYPE_INFERENCE_SAMPLE_SIZE = int(os.environ.get("REDASH_TYPE_INFERENCE_SAMPLE_SIZE", "1000"))
+
+# How many tenants the Python data source's execute_shared_query_for_tenants queries at the same time.
+PYTHON_FAN_OUT_CONCURRENCY = int(os.environ.get("REDASH_PYTHON_FAN_OUT_CONCURRENCY", "8"))
+
+# Spread scheduled queries that would otherwise run together: each query gets a fixed offset (derived from its id)
+# within this window, in seconds. Interval based schedules run at that phase of their interval (capped to the
+# interval), schedules at a specific time run that long after it. Disabled when 0.
+SCHEDULE_JITTER_WINDOW = int(os.environ.get("REDASH_SCHEDULE_JITTER_WINDOW", "0"))
+
 SCHEMAS_REFRESH_SCHEDULE = int(os.environ.get("REDASH_SCHEMAS_REFRESH_SCHEDULE", 30))
 SCHEMAS_REFRESH_QUEUE = os.environ.get("REDASH_SCHEMAS_REFRESH_QUEUE", "celery")
 
@@ -194,6 +245,18 @@ STATIC_ASSETS_PATH = fix_assets_path(os.environ.get("REDASH_STATIC_ASSETS_PATH",
 
 JOB_EXPIRY_TIME = int(os.environ.get("REDASH_JOB_EXPIRY_TIME", 3600 * 12))
 
+# Dispatch adhoc queries to the Celery queues through per organization queues, served round robin, so an organization
+# submitting many queries can't starve the others. Each organization can have a limited number of its queries queued
+# or running at once (see query_fair_share_quota in the dynamic settings); with QUERY_FAIR_SHARE_MAX_DISPATCHED set,
+# queries are held back until there are less than that many dispatched queries overall. Scheduled queries aren't
+# affected.
+QUERY_FAIR_SHARE_ENABLED = parse_boolean(os.environ.get("REDASH_QUERY_FAIR_SHARE_ENABLED", "false"))
+QUERY_FAIR_SHARE_MAX_DISPATCHED = int(os.environ.get("REDASH_QUERY_FAIR_SHARE_MAX_DISPATCHED", "0"))
+
+# Queries of data sources with a max_concurrent_queries limit that find all of its slots taken are retried after this
+# many seconds, instead of holding a worker while they wait.
+DATA_SOURCE_SLOT_RETRY_DELAY = int(os.environ.get("REDASH_DATA_SOURCE_SLOT_RETRY_DELAY", "10"))
+
 LOG_LEVEL = os.environ.get("REDASH_LOG_LEVEL", "INFO")
 LOG_STDOUT = parse_boolean(os.environ.get('REDASH_LOG_STDOUT', 'false'))
 LOG_PREFIX = os.environ.get('REDASH_LOG_PREFIX', '')
@@ -345,6 +408,12 @@ FEATURE_EXTENDED_ALERT_OPTIONS = parse_boolean(os.environ.get("REDASH_FEATURE_EX
 # BigQuery
 BIGQUERY_HTTP_TIMEOUT = int(os.environ.get("REDASH_BIGQUERY_HTTP_TIMEOUT", "600"))
 
+# PostgreSQL/Redshift: keep connections open between queries, in a pool per worker process and data source. Connections
+# are health checked when taken from the pool and their session is reset when returned to it.
+PG_CONNECTION_POOL_ENABLED = parse_boolean(os.environ.get("REDASH_PG_CONNECTION_POOL_ENABLED", "false"))
+PG_CONNECTION_POOL_MAX_SIZE = int(os.environ.get("REDASH_PG_CONNECTION_POOL_MAX_SIZE", "5"))
+PG_CONNECTION_POOL_IDLE_TIMEOUT = int(os.environ.get("REDASH_PG_CONNECTION_POOL_IDLE_TIMEOUT", "300"))
+
 # Allow Parameters in Embeds
 # WARNING: Deprecated!
 # See https://discuss.redash.io/t/support-for-parameters-in-embedded-visualizations/3337 for more details.
@@ -10,6 +10,18 @@ def query_time_limit(is_scheduled, user_id, org_id):
     return scheduled_time_limit if is_scheduled else adhoc_time_limit
 
 
+# Replace this method with your own implementation in case you want different fair share quotas for some organizations
+# (see QUERY_FAIR_SHARE_ENABLED). Returns how many adhoc queries of the organization can be queued or running at once
+# (0 for no limit).
+def query_fair_share_quota(org_id):
+    quotas = dict(
+        (int(org), int(quota)) for org, quota in
+        (item.split(':') for item in os.environ.get('REDASH_QUERY_FAIR_SHARE_ORG_QUOTAS', '').split(',') if item)
+    )
+
+    return quotas.get(org_id, int(os.environ.get('REDASH_QUERY_FAIR_SHARE_QUOTA', 10)))
+
+
 # Provide any custom tasks you'd like to run periodically
 def custom_tasks():
     return {
@@ -1,4 +1,4 @@
 from .general import record_event, version_check, send_mail, sync_user_details
-from .queries import QueryTask, refresh_queries, refresh_schemas, cleanup_query_results, execute_query, empty_schedules
+from .queries import QueryTask, refresh_queries, refresh_schemas, cleanup_query_results, compact_query_results, execute_query, empty_schedules, dispatch_queries
 from .alerts import check_alerts_for_query
 from .failure_report import notify_of_failure
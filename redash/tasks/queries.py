@@ -1,18 +1,21 @@
 import logging
 import signal
 import time
-import redis
 from celery.exceptions import SoftTimeLimitExceeded, TimeLimitExceeded
 from celery.result import AsyncResult
+from celery.signals import task_revoked
+from celery.utils import uuid
 from celery.utils.log import get_task_logger
 from six import text_type
 
-from redash import models, redis_connection, settings, statsd_client
+from redash import (fair_share, models, query_result_cache, redis_connection, result_storage, settings,
+                    statsd_client)
 from redash.models.parameterized_query import InvalidParameterError, QueryDetachedFromDataSourceError
 from redash.query_runner import InterruptException
 from redash.tasks.alerts import check_alerts_for_query
 from redash.tasks.failure_report import notify_of_failure
-from redash.utils import gen_query_hash, json_dumps, utcnow, mustache_render
+from redash.utils import gen_query_hash, json_dumps, json_loads, utcnow, mustache_render
+from redash.utils.query_results import COMPACT_PREFIX, ResultWriter, compact_result, decompress_result
 from redash.worker import celery
 
 from redash.varanus import can_query_securely
@@ -33,6 +36,7 @@ class QueryTask(object):
     # TODO: this is mapping to the old Job class statuses. Need to update the client side and remove this
     STATUSES = {
         'PENDING': 1,
+        'RETRY': 1,
         'STARTED': 2,
         'SUCCESS': 3,
         'FAILURE': 4,
@@ -59,7 +63,10 @@ class QueryTask(object):
 
         status = self.STATUSES[task_status]
 
-        if isinstance(result, (TimeLimitExceeded, SoftTimeLimitExceeded)):
+        if task_status == 'RETRY':
+            # Deferred until a slot of its data source is free.
+            error = ''
+        elif isinstance(result, (TimeLimitExceeded, SoftTimeLimitExceeded)):
             error = TIMEOUT_MESSAGE
             status = 4
         elif isinstance(result, Exception):
@@ -98,67 +105,116 @@ class QueryTask(object):
         return self._async_result.revoke(terminate=True, signal='SIGINT')
 
 
+# Returns the job holding the lock of a query, or takes the lock for the new job when there is none (or the job holding
+# it is done), in a single round trip:
+#
+# KEYS[1]: the job lock.
+# ARGV[1]: the id of the new job; ARGV[2]: lock expiry (seconds).
+# ARGV[3]: Celery's result key prefix, to tell whether the job holding the lock is done (empty to skip the check).
+# ARGV[4]: the id of a job known to be done, whose lock can be replaced (or empty).
+#
+# Returns {1, new job id} when the lock was taken, or {0, existing job id}.
+ENQUEUE_JOB_SCRIPT = """
+local job_id = redis.call('GET', KEYS[1])
+if job_id and job_id ~= ARGV[4] then
+    local ready = false
+    if ARGV[3] ~= '' then
+        local meta = redis.call('GET', ARGV[3] .. job_id)
+        if meta then
+            local ok, result = pcall(cjson.decode, meta)
+            local status = ok and result['status']
+            ready = status == 'SUCCESS' or status == 'FAILURE' or status == 'REVOKED'
+        end
+    end
+    if not ready then
+        return {0, job_id}
+    end
+end
+redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[2])
+return {1, ARGV[1]}
+"""
+
+_enqueue_job_script = redis_connection.register_script(ENQUEUE_JOB_SCRIPT)
+
+
+def _result_key_prefix():
+    """Celery's result key prefix, if the script can read task results (they're stored as JSON in the same Redis)."""
+    if settings.CELERY_RESULT_BACKEND != settings.REDIS_URL or settings.CELERY_RESULT_SERIALIZER != 'json':
+        return ''
+
+    return getattr(celery.backend, 'task_keyprefix', '')
+
+
+def _lock_job(query_hash, data_source_id, job_id, ready_job_id=''):
+    created, locked_job_id = _enqueue_job_script(keys=[_job_lock_id(query_hash, data_source_id)],
+                                                 args=[job_id, settings.JOB_EXPIRY_TIME, _result_key_prefix(),
+                                                       ready_job_id])
+    return bool(created), locked_job_id
+
+
 def enqueue_query(query, data_source, user_id, is_api_key=False, scheduled_query=None, metadata={}, raw_query_text=None, query_params=None):
     query_hash = gen_query_hash(query)
     logging.info("Inserting job for %s with metadata=%s", query_hash, metadata)
-    try_count = 0
-    job = None
 
-    while try_count < 5:
-        try_count += 1
+    created, job_id = _lock_job(query_hash, data_source.id, uuid())
+    if not created and not _result_key_prefix():
+        # The script can't tell whether the job is done, so check it here and replace its lock if it still holds it.
+        if QueryTask(job_id=job_id).ready():
+            logging.info("[%s] job found is ready (%s), removing lock", query_hash, job_id)
+            created, job_id = _lock_job(query_hash, data_source.id, uuid(), ready_job_id=job_id)
+
+    if not created:
+        logging.info("[%s] Found existing job: %s", query_hash, job_id)
+        statsd_client.incr('enqueue_query.dedup_hit')
+        return QueryTask(job_id=job_id)
+
+    if scheduled_query:
+        queue_name = data_source.scheduled_queue_name
+        scheduled_query_id = scheduled_query.id
+    else:
+        queue_name = data_source.queue_name
+        scheduled_query_id = None
+
+    args = (query, data_source.id, metadata, user_id, scheduled_query_id, is_api_key, raw_query_text, query_params)
+    argsrepr = json_dumps({
+        'org_id': data_source.org_id,
+        'data_source_id': data_source.id,
+        'enqueue_time': time.time(),
+        'scheduled': scheduled_query_id is not None,
+        'query_id': metadata.get('Query ID'),
+        'user_id': user_id
+    })
+
+    time_limit = settings.dynamic_settings.query_time_limit(scheduled_query, user_id, data_source.org_id)
 
-        pipe = redis_connection.pipeline()
+    if settings.QUERY_FAIR_SHARE_ENABLED and not scheduled_query:
         try:
-            pipe.watch(_job_lock_id(query_hash, data_source.id))
-            job_id = pipe.get(_job_lock_id(query_hash, data_source.id))
-            if job_id:
-                logging.info("[%s] Found existing job: %s", query_hash, job_id)
-
-                job = QueryTask(job_id=job_id)
-
-                if job.ready():
-                    logging.info("[%s] job found is ready (%s), removing lock", query_hash, job.celery_status)
-                    redis_connection.delete(_job_lock_id(query_hash, data_source.id))
-                    job = None
-
-            if not job:
-                pipe.multi()
-
-                if scheduled_query:
-                    queue_name = data_source.scheduled_queue_name
-                    scheduled_query_id = scheduled_query.id
-                else:
-                    queue_name = data_source.queue_name
-                    scheduled_query_id = None
-
-                args = (query, data_source.id, metadata, user_id, scheduled_query_id, is_api_key, raw_query_text, query_params)
-                argsrepr = json_dumps({
-                    'org_id': data_source.org_id,
-                    'data_source_id': data_source.id,
-                    'enqueue_time': time.time(),
-                    'scheduled': scheduled_query_id is not None,
-                    'query_id': metadata.get('Query ID'),
-                    'user_id': user_id
-                })
-
-                time_limit = settings.dynamic_settings.query_time_limit(scheduled_query, user_id, data_source.org_id)
-
-                result = execute_query.apply_async(args=args,
-                                                   argsrepr=argsrepr,
-                                                   queue=queue_name,
-                                                   soft_time_limit=time_limit)
-
-                job = QueryTask(async_result=result)
-                logging.info("[%s] Created new job: %s", query_hash, job.id)
-                pipe.set(_job_lock_id(query_hash, data_source.id), job.id, settings.JOB_EXPIRY_TIME)
-                pipe.execute()
-            break
-
-        except redis.WatchError:
-            continue
-
-    if not job:
-        logging.error("[Manager][%s] Failed adding job for query.", query_hash)
+            fair_share.push_job(data_source.org_id, job_id,
+                                settings.dynamic_settings.query_fair_share_quota(data_source.org_id),
+                                args=args, argsrepr=argsrepr, queue=queue_name, soft_time_limit=time_limit)
+        except Exception:
+            _unlock(query_hash, data_source.id)
+            raise
+
+        dispatch_queries()
+        job = QueryTask(job_id=job_id)
+        logging.info("[%s] Created new fair share job: %s", query_hash, job.id)
+        statsd_client.incr('enqueue_query.new_job')
+        return job
+
+    try:
+        result = execute_query.apply_async(args=args,
+                                           argsrepr=argsrepr,
+                                           queue=queue_name,
+                                           soft_time_limit=time_limit,
+                                           task_id=job_id)
+    except Exception:
+        _unlock(query_hash, data_source.id)
+        raise
+
+    job = QueryTask(async_result=result)
+    logging.info("[%s] Created new job: %s", query_hash, job.id)
+    statsd_client.incr('enqueue_query.new_job')
 
     return job
 
@@ -218,6 +274,9 @@ def refresh_queries():
                 query_ids.append(query.id)
                 outdated_queries_count += 1
 
+    # Keeps the next_run_at that outdated_queries updated.
+    models.db.session.commit()
+
     statsd_client.gauge('manager.outdated_queries', outdated_queries_count)
 
     logger.info("Done refreshing queries. Found %d outdated queries: %s" % (outdated_queries_count, query_ids))
@@ -248,11 +307,56 @@ def cleanup_query_results():
                  settings.QUERY_RESULTS_CLEANUP_COUNT, settings.QUERY_RESULTS_CLEANUP_MAX_AGE)
 
     unused_query_results = models.QueryResult.unused(settings.QUERY_RESULTS_CLEANUP_MAX_AGE).limit(settings.QUERY_RESULTS_CLEANUP_COUNT)
+    unused_ids = [query_result.id for query_result in unused_query_results]
+    if not unused_ids:
+        logger.info("Deleted 0 unused query results.")
+        return
+
+    data_keys = models.QueryResult.external_data_keys(models.QueryResult.id.in_(unused_ids))
     deleted_count = models.QueryResult.query.filter(
-        models.QueryResult.id.in_(unused_query_results.subquery())
+        models.QueryResult.id.in_(unused_ids)
     ).delete(synchronize_session=False)
     models.db.session.commit()
-    logger.info("Deleted %d unused query results.", deleted_count)
+    # Blobs are only deleted once the rows are gone, so a failed transaction can't leave rows pointing to nothing.
+    result_storage.delete_results(data_keys)
+    query_result_cache.delete(unused_ids)
+    logger.info("Deleted %d unused query results (%d from external storage).", deleted_count, len(data_keys))
+
+
+COMPACT_QUERY_RESULTS_LAST_ID_KEY = 'query_results:compact:last_id'
+
+
+@celery.task(name="redash.tasks.compact_query_results")
+def compact_query_results():
+    """
+    Job to convert query results stored in the legacy format to the compact one (see redash.utils.query_results).
+
+    Each time the job converts settings.QUERY_RESULTS_COMPACT_BATCH_SIZE query results, continuing from the last
+    query result it looked at, so the whole table is converted over several runs.
+    """
+    last_id = int(redis_connection.get(COMPACT_QUERY_RESULTS_LAST_ID_KEY) or 0)
+    query_result_ids = [row[0] for row in models.db.session.query(models.QueryResult.id).filter(
+        models.QueryResult.id > last_id,
+        ~models.QueryResult.data.startswith(COMPACT_PREFIX)
+    ).order_by(models.QueryResult.id).limit(settings.QUERY_RESULTS_COMPACT_BATCH_SIZE)]
+
+    if not query_result_ids:
+        logger.info("No query results left to convert to the compact format.")
+        return
+
+    converted_count = 0
+    for query_result_id in query_result_ids:
+        # Converting one result at a time keeps only a single result in memory.
+        query_result = models.QueryResult.query.get(query_result_id)
+        text = decompress_result(query_result.data)
+        data = compact_result(text)
+        if data is not text:
+            query_result.set_encoded_data(models.QueryResult.encode_data(data))
+            converted_count += 1
+        models.db.session.commit()
+
+    redis_connection.set(COMPACT_QUERY_RESULTS_LAST_ID_KEY, query_result_ids[-1])
+    logger.info("Converted %d query results to the compact format (up to id %d).", converted_count, query_result_ids[-1])
 
 
 @celery.task(name="redash.tasks.refresh_schema", time_limit=90, soft_time_limit=60)
@@ -296,6 +400,46 @@ def refresh_schemas():
     logger.info(u"task=refresh_schemas state=finish total_runtime=%.2f", time.time() - global_start_time)
 
 
+@celery.task(name="redash.tasks.dispatch_queries")
+def dispatch_queries():
+    """
+    Sends the adhoc queries waiting in their organization's fair share queue to Celery, for as long as their quotas
+    allow it.
+    """
+    while True:
+        job = fair_share.take_job()
+        if job is None:
+            return
+
+        try:
+            execute_query.apply_async(args=job['args'],
+                                      argsrepr=job['argsrepr'],
+                                      queue=job['queue'],
+                                      soft_time_limit=job['soft_time_limit'],
+                                      task_id=job['job_id'])
+        except Exception:
+            logger.exception("Failed dispatching job %s, returning it to the fair share queue.", job['job_id'])
+            fair_share.return_job(job)
+            return
+
+        logger.info("task=dispatch_queries state=dispatched job_id=%s org_id=%s", job['job_id'], job['org_id'])
+
+
+@task_revoked.connect
+def release_revoked_job(sender=None, request=None, **kwargs):
+    # Cancelled jobs that were dispatched but never started don't get to release their fair share slot otherwise.
+    if not settings.QUERY_FAIR_SHARE_ENABLED or sender is None or sender.name != execute_query.name:
+        return
+
+    try:
+        task_args = json_loads(request.argsrepr)
+    except (AttributeError, TypeError, ValueError):
+        return
+
+    if not task_args.get('scheduled'):
+        fair_share.release_job(task_args['org_id'], request.id)
+
+
 def signal_handler(*args):
     raise InterruptException
 
@@ -320,10 +464,11 @@ def _resolve_user(user_id, is_api_key, query_id):
         return None
 
 
-def track_failure(query, error):
+def track_failure(query, error, executed_at=None):
     logging.debug(error)
 
     query.schedule_failures += 1
+    query.update_next_run_at(executed_at)
     models.db.session.add(query)
     models.db.session.commit()
 
@@ -350,11 +495,40 @@ class QueryExecutor(object):
         models.db.session.close()
         self.query_hash = gen_query_hash(self.query)
         self.scheduled_query = scheduled_query
-        # Load existing tracker or create a new one if the job was created before code update:
-        if scheduled_query:
-            models.scheduled_queries_executions.update(scheduled_query.id)
+        self.executed_at = None
 
     def run(self):
+        job_id = self.task.request.id
+        if settings.QUERY_FAIR_SHARE_ENABLED and self.scheduled_query is None:
+            fair_share.renew_job(self.data_source.org_id, job_id, self._slot_lease())
+
+        waiting_lease = settings.DATA_SOURCE_SLOT_RETRY_DELAY * 3
+        if not self.data_source.acquire_query_slot(job_id, self._slot_lease(), waiting_lease):
+            self._log_progress('waiting_for_slot')
+            statsd_client.incr('execute_query.deferred')
+            raise self.task.retry(countdown=settings.DATA_SOURCE_SLOT_RETRY_DELAY, max_retries=None)
+
+        try:
+            return self._run()
+        finally:
+            self.data_source.release_query_slot(job_id)
+            if settings.QUERY_FAIR_SHARE_ENABLED and self.scheduled_query is None:
+                fair_share.release_job(self.data_source.org_id, job_id)
+                dispatch_queries()
+
+    def _slot_lease(self):
+        # Slots (of the data source and the fair share quota) are held for as long as the query can run, so the ones
+        # of a job that died are eventually freed.
+        soft_time_limit = (self.task.request.timelimit or (None, None))[1]
+        if soft_time_limit:
+            return soft_time_limit + 60
+
+        return settings.JOB_EXPIRY_TIME
+
+    def _run(self):
+        if self.scheduled_query:
+            self.executed_at = models.scheduled_queries_executions.update(self.scheduled_query.id)
+
         signal.signal(signal.SIGINT, signal_handler)
         started_at = time.time()
 
@@ -367,6 +541,8 @@ class QueryExecutor(object):
         try:
             if can_query_securely(self.data_source):
                 data, error = query_runner.run_secure_query(self.raw_query_text, self.query_params, self.user)
+            elif settings.QUERY_RESULTS_STREAMING_ENABLED and query_runner.supports_streaming:
+                data, error = self._run_query_streaming(query_runner, annotated_query), None
             else:
                 data, error = query_runner.run_query(annotated_query, self.user)
         except Exception as e:
@@ -388,17 +564,27 @@ class QueryExecutor(object):
             result = QueryExecutionError(error)
             if self.scheduled_query is not None:
                 self.scheduled_query = models.db.session.merge(self.scheduled_query, load=False)
-                track_failure(self.scheduled_query, error)
+                track_failure(self.scheduled_query, error, self.executed_at)
             raise result
         else:
-            if (self.scheduled_query and self.scheduled_query.schedule_failures > 0):
-                self.scheduled_query = models.db.session.merge(self.scheduled_query, load=False)
-                self.scheduled_query.schedule_failures = 0
-                models.db.session.add(self.scheduled_query)
-            query_result, updated_query_ids = models.QueryResult.store_result(
-                self.data_source.org_id, self.data_source,
-                self.query_hash, self.query, data,
-                run_time, utcnow())
+            if self.scheduled_query:
+                # A plain UPDATE (which doesn't touch updated_at), that skips queries saved while this one was running,
+                # as their schedule might have changed.
+                models.Query.query.filter(
+                    models.Query.id == self.scheduled_query.id,
+                    models.Query.version == self.scheduled_query.version
+                ).update({
+                    'schedule_failures': 0,
+                    'next_run_at': self.scheduled_query.get_next_run_at(self.executed_at, failures=0)
+                }, synchronize_session=False)
+            try:
+                query_result, updated_query_ids = models.QueryResult.store_result(
+                    self.data_source.org_id, self.data_source,
+                    self.query_hash, self.query, data,
+                    run_time, utcnow())
+            finally:
+                if isinstance(data, ResultWriter):
+                    data.close()
             models.db.session.commit()  # make sure that alert sees the latest query result
             self._log_progress('checking_alerts')
             for query_id in updated_query_ids:
@@ -409,6 +595,27 @@ class QueryExecutor(object):
             models.db.session.commit()
             return result
 
+    def _run_query_streaming(self, query_runner, annotated_query):
+        """Returns the finished `ResultWriter`, which is stored without reading the result into a string (unless it
+        goes into the database column) and closed by the caller."""
+        columns, batches = query_runner.run_query_iter(annotated_query, self.user)
+
+        writer = query_runner.new_result_writer(columns)
+        try:
+            try:
+                for rows in batches:
+                    writer.write_rows(rows)
+            finally:
+                batches.close()
+
+            writer.finish(columns, **getattr(batches, 'metadata', {}))
+        except BaseException:
+            writer.close()
+            raise
+
+        logger.info(u"task=execute_query state=streamed query_hash=%s rows=%d", self.query_hash, writer.row_count)
+        return writer
+
     def _annotate_query(self, query_runner):
         self.metadata['Task ID'] = self.task.request.id
         self.metadata['Query Hash'] = self.query_hash
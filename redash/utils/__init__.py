@@ -4,13 +4,14 @@ import csv
 import datetime
 import decimal
 import hashlib
+import math
 import os
 import random
 import re
 import uuid
 import binascii
 
-from six import string_types
+from six import binary_type, integer_types, string_types, text_type
 
 import pystache
 import pytz
@@ -121,6 +122,43 @@ def json_dumps(data, *args, **kwargs):
     return simplejson.dumps(data, *args, **kwargs)
 
 
+# Values that come back from JSON as they are.
+_JSON_NATIVE_TYPES = frozenset((text_type, bool, type(None)) + integer_types)
+
+
+def _json_key(key):
+    # Keys are turned into strings like the encoder does.
+    if isinstance(key, text_type):
+        return key
+    if isinstance(key, binary_type):
+        return key.decode('utf-8')
+    if key is None or isinstance(key, (bool, float) + integer_types):
+        return text_type(json_dumps(key))
+    return text_type(key)
+
+
+def json_normalize(value, cls=JSONEncoder, ignore_nan=False, _encoder=None):
+    """Returns the value as `json_loads(json_dumps(value, cls=cls, ignore_nan=ignore_nan))` would, without encoding
+    it."""
+    value_type = type(value)
+    if value_type in _JSON_NATIVE_TYPES:
+        return value
+
+    if value_type is binary_type:
+        return value.decode('utf-8')
+
+    if value_type is float:
+        return None if ignore_nan and (math.isnan(value) or math.isinf(value)) else value
+
+    encoder = _encoder or cls()
+    if isinstance(value, dict):
+        return {_json_key(key): json_normalize(item, cls, ignore_nan, encoder) for key, item in value.iteritems()}
+    if isinstance(value, (list, tuple)):
+        return [json_normalize(item, cls, ignore_nan, encoder) for item in value]
+
+    return json_normalize(encoder.default(value), cls, ignore_nan, encoder)
+
+
 def mustache_render(template, context=None, **kwargs):
     renderer = pystache.Renderer(escape=lambda u: u)
     return renderer.render(template, context, **kwargs)
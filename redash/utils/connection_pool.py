@@ -0,0 +1,173 @@
+"""
+Per-process connection pools for query runners.
+
+Pools are kept per data source configuration: `get_pool` is called with an identity (what the connections are to)
+and a fingerprint of the full configuration. When the fingerprint of an identity changes the old pool is closed and a
+new one is created. Pools that had no connection in use for their idle timeout (like the pools of deleted data
+sources) are closed as well. Pools are also never shared
+across processes, so a pool created before a worker forks is not reused by its children.
+"""
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class ConnectionPool(object):
+    """Keeps up to `max_size` idle connections for reuse.
+
+    :param connect: creates a new connection.
+    :param check: called on checkout with an idle connection; it should raise (or return False) if the connection
+                  isn't usable anymore, in which case it is closed and another one is used.
+    :param reset: called when a connection is released, to reset its session state; if it raises the connection
+                  is closed instead of being kept.
+
+    Connections idle for more than `idle_timeout` seconds are closed. Checkouts never block: when there is no idle
+    connection a new one is opened, and connections released while the pool is full are closed.
+    """
+
+    def __init__(self, connect, max_size, idle_timeout, check=None, reset=None):
+        self._connect = connect
+        self._check = check
+        self._reset = reset
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.pid = os.getpid()
+        self.closed = False
+        self.last_used = time.time()
+        self._in_use = 0
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                self._close_expired()
+                if not self._idle:
+                    break
+                connection, _ = self._idle.pop()
+
+            if self._is_usable(connection):
+                self._checked_out(1)
+                return connection
+
+            _close(connection)
+
+        connection = self._connect()
+        self._checked_out(1)
+        return connection
+
+    def release(self, connection, discard=False):
+        self._checked_out(-1)
+        if discard or self.closed or not self._reset_session(connection):
+            _close(connection)
+            return
+
+        with self._lock:
+            if len(self._idle) < self.max_size:
+                self._idle.append((connection, time.time()))
+                return
+
+        _close(connection)
+
+    def close(self):
+        with self._lock:
+            self.closed = True
+            idle, self._idle = self._idle, []
+
+        for connection, _ in idle:
+            _close(connection)
+
+    def __len__(self):
+        return len(self._idle)
+
+    def is_unused(self):
+        """Whether no connection of the pool is in use, nor was for `idle_timeout` seconds."""
+        with self._lock:
+            return self._in_use <= 0 and self.last_used < time.time() - self.idle_timeout
+
+    def _checked_out(self, count):
+        with self._lock:
+            self._in_use += count
+            self.last_used = time.time()
+
+    def _is_usable(self, connection):
+        if self._check is None:
+            return True
+
+        try:
+            return self._check(connection) is not False
+        except Exception as e:
+            logger.info("Discarding pooled connection that failed the health check: %s", e)
+            return False
+
+    def _reset_session(self, connection):
+        if self._reset is None:
+            return True
+
+        try:
+            self._reset(connection)
+            return True
+        except Exception as e:
+            logger.info("Discarding pooled connection that failed to reset: %s", e)
+            return False
+
+    def _close_expired(self):
+        threshold = time.time() - self.idle_timeout
+        expired = [connection for connection, released_at in self._idle if released_at < threshold]
+        if expired:
+            self._idle = [(connection, released_at) for connection, released_at in self._idle
+                          if released_at >= threshold]
+            for connection in expired:
+                _close(connection)
+
+
+def _close(connection):
+    try:
+        connection.close()
+    except Exception:
+        logger.exception("Failed closing pooled connection.")
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(identity, fingerprint, create):
+    """Returns the pool for `identity`, calling `create()` to make one when there's no current pool for it."""
+    with _pools_lock:
+        _close_unused_pools(identity)
+
+        current = _pools.get(identity)
+        if current is not None:
+            pool_fingerprint, pool = current
+            if pool.pid != os.getpid():
+                # Inherited from the parent process: its connections belong to the parent, so don't close them.
+                current = None
+            elif pool_fingerprint != fingerprint:
+                pool.close()
+                current = None
+
+        if current is None:
+            current = (fingerprint, create())
+            _pools[identity] = current
+
+        return current[1]
+
+
+def _close_unused_pools(identity):
+    for other_identity, (_, pool) in list(_pools.items()):
+        if other_identity != identity and pool.pid == os.getpid() and pool.is_unused():
+            pool.close()
+            del _pools[other_identity]
+
+
+def close_pools():
+    with _pools_lock:
+        pools = [pool for _, pool in _pools.values() if pool.pid == os.getpid()]
+        _pools.clear()
+
+    for pool in pools:
+        pool.close()
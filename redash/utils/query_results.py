@@ -0,0 +1,316 @@
+"""
+Encoding of the query result payload stored in `QueryResult.data`.
+
+Two formats are supported:
+
+* The legacy format (version 1), which is also what the API returns:
+  `{"columns": [...], "rows": [{"column": value, ...}, ...]}`.
+* The compact format (version 2), where each row is an array of values in the order of `columns`:
+  `{"version": 2, "rows": [[value, ...], ...], "columns": [...]}`. Rows that don't have exactly the keys of the
+  declared columns are kept as objects, so the conversion is lossless.
+
+Any other top level keys (like the `log` of the Python query runner) are kept as is in both formats.
+
+Encoded results can additionally be compressed, in which case they are stored as `COMPRESSED_PREFIX` followed by the
+base64 encoded zlib stream (the column is TEXT).
+"""
+import base64
+import re
+import tempfile
+import zlib
+from itertools import islice
+
+import simplejson
+from six import string_types, text_type
+
+from redash import settings
+from redash.utils import json_dumps, json_loads
+
+COMPACT_FORMAT_VERSION = 2
+COMPACT_PREFIX = '{"version": %d, ' % COMPACT_FORMAT_VERSION
+COMPRESSED_PREFIX = 'zlib:'
+
+# How results start when their rows come first, like the ones of `ResultWriter` (and, as "rows" sorts first in Python
+# 2 dicts, most encoded by the query runners).
+_ROWS_STARTS = (COMPACT_PREFIX + '"rows": [', '{"rows": [')
+_COLUMNS_KEY = '], "columns": '
+_ROW_SEPARATOR = re.compile(r'[\s,]*')
+
+
+def is_compact(data):
+    return isinstance(data, dict) and data.get('version') == COMPACT_FORMAT_VERSION
+
+
+def _compact_row(row, column_names):
+    if len(row) == len(column_names) and all(name in row for name in column_names):
+        return [row[name] for name in column_names]
+
+    return row
+
+
+def iter_rows(data):
+    """Yields the rows of a parsed result (in either format) as dicts, decoding one row at a time."""
+    if not is_compact(data):
+        for row in data['rows']:
+            yield row
+        return
+
+    column_names = [c['name'] for c in data['columns']]
+    for row in data['rows']:
+        if isinstance(row, list):
+            yield dict(zip(column_names, row))
+        else:
+            yield row
+
+
+def decode_result(data):
+    """Returns a parsed result (in either format) in the legacy format."""
+    if not is_compact(data):
+        return data
+
+    result = dict((k, v) for k, v in data.items() if k != 'version')
+    result['rows'] = list(iter_rows(data))
+    return result
+
+
+def _count(iterator):
+    return sum(1 for _ in iterator)
+
+
+class ColumnNotFound(Exception):
+    pass
+
+
+def slice_result(data, offset=0, limit=None, columns=None):
+    """Returns `limit` rows from `offset` of a parsed result (in either format), in the legacy format, along with the
+    total number of rows (`total_rows`). Only the returned rows are decoded.
+
+    The rows can also be an iterator (see `load_result_lazily`): only the returned ones are kept, the others are just
+    counted.
+
+    `columns` (a list of names) limits the result to those columns, in that order.
+    """
+    rows = iter(data['rows'])
+    skipped = _count(islice(rows, offset))
+    page_rows = list(islice(rows, limit))
+    total_rows = skipped + len(page_rows) + _count(rows)
+
+    # Keys that come after lazily loaded rows are only there once they've all been iterated.
+    page = dict((k, v) for k, v in data.items() if k != 'version')
+    page['rows'] = list(iter_rows(dict(data, rows=page_rows)))
+    page['total_rows'] = total_rows
+
+    if columns is not None:
+        columns_by_name = dict((column['name'], column) for column in data['columns'])
+        for name in columns:
+            if name not in columns_by_name:
+                raise ColumnNotFound(u"Column {} not found.".format(name))
+
+        page['columns'] = [columns_by_name[name] for name in columns]
+        page['rows'] = [dict((name, row[name]) for name in columns if name in row) for row in page['rows']]
+
+    return page
+
+
+def compact_result(text, batch_size=5000):
+    """Converts an encoded result in the legacy format to the compact one.
+
+    Anything else (results that are already compact or aren't a legacy payload at all) is returned unchanged.
+    """
+    if not isinstance(text, string_types) or text.startswith(COMPACT_PREFIX):
+        return text
+
+    try:
+        data = json_loads(text)
+    except ValueError:
+        return text
+
+    if not isinstance(data, dict) or not isinstance(data.get('columns'), list) or not isinstance(data.get('rows'), list):
+        return text
+
+    rows = data.pop('rows')
+    columns = data.pop('columns')
+
+    with ResultWriter(columns, compact=True) as writer:
+        for i in range(0, len(rows), batch_size):
+            writer.write_rows(rows[i:i + batch_size])
+        writer.finish(columns, **data)
+        return writer.getvalue()
+
+
+def is_compressed(text):
+    return isinstance(text, string_types) and text.startswith(COMPRESSED_PREFIX)
+
+
+def compress_result(content, level=6):
+    """Compresses an encoded result, given as text or as a finished `ResultWriter` (which is read in chunks)."""
+    chunks = content.iter_chunks() if isinstance(content, ResultWriter) else [content.encode('utf-8')]
+    compressor = zlib.compressobj(level)
+    compressed = b''.join([compressor.compress(chunk) for chunk in chunks] + [compressor.flush()])
+    return COMPRESSED_PREFIX + base64.b64encode(compressed).decode('ascii')
+
+
+def decompress_result(text):
+    """Returns the encoded result, decompressing it if needed."""
+    if not is_compressed(text):
+        return text
+
+    compressed = base64.b64decode(text[len(COMPRESSED_PREFIX):])
+    return zlib.decompress(compressed).decode('utf-8')
+
+
+def load_result_lazily(text):
+    """Parses an encoded (uncompressed) result like `json_loads`, except that when the rows come first (see
+    `_ROWS_STARTS`), they're an iterator that decodes them one at a time, so the whole result is never held as Python
+    objects. Other results are parsed in full.
+
+    Only the columns and the other top level keys are parsed right away; a malformed row is only noticed once the
+    iteration reaches it. Keys between the rows and the columns (like the `log` of the Python query runner) are only
+    added once the rows are iterated.
+    """
+    rows_start = next((len(start) for start in _ROWS_STARTS if text.startswith(start)), None)
+    if rows_start is None:
+        return json_loads(text)
+
+    # The columns are in the (small) rest of the object, after the last "columns" key that is followed by members
+    # that parse up to the end of the object: the ones in nested objects are followed by the end of their object
+    # instead. Quotes in strings are escaped, so the key can't match in them.
+    decoder = simplejson.JSONDecoder()
+    object_end = len(text.rstrip()) - 1
+    if text[object_end] != '}':
+        return json_loads(text)
+
+    position = len(text)
+    while True:
+        position = text.rfind(_COLUMNS_KEY, rows_start, position)
+        if position == -1:
+            return json_loads(text)
+
+        data = _parse_members(decoder, text, position + len('], '), object_end)
+        if data is not None and isinstance(data['columns'], list):
+            break
+
+    if text.startswith(COMPACT_PREFIX):
+        data['version'] = COMPACT_FORMAT_VERSION
+    data['rows'] = _iter_encoded_rows(decoder, text, rows_start, position, data)
+    return data
+
+
+def _parse_members(decoder, text, position, end):
+    """Returns the members of an object from `position` (the quote of a key) up to `end` (right after the last value)
+    as a dict, or None if they don't parse up to there."""
+    members = {}
+    try:
+        while True:
+            key, position = decoder.raw_decode(text, position)
+            if not isinstance(key, string_types) or text[position:position + 2] != ': ':
+                return None
+
+            members[key], position = decoder.raw_decode(text, position + 2)
+            if position == end:
+                return members
+            if position > end or text[position:position + 2] != ', ':
+                return None
+            position += 2
+    except ValueError:
+        return None
+
+
+def _iter_encoded_rows(decoder, text, start, columns_start, data):
+    position = _ROW_SEPARATOR.match(text, start).end()
+    while text[position] != ']':
+        row, position = decoder.raw_decode(text, position)
+        yield row
+        position = _ROW_SEPARATOR.match(text, position).end()
+
+    # Other keys came between the rows and the columns.
+    if position != columns_start:
+        members = _parse_members(decoder, text, position + len('], '), columns_start + 1)
+        if members is None:
+            raise ValueError("Invalid query result at {}.".format(position))
+        data.update(members)
+
+
+class ResultWriter(object):
+    """Incrementally encodes a query result as it is streamed from a query runner.
+
+    Batches of rows are JSON encoded as they arrive and appended to a spooled temporary file, so neither the full list
+    of row dicts nor a second copy of the encoded result has to be kept in memory. Columns are written last, which
+    allows runners that infer column types from the data to finish doing so while the rows are being written (column
+    names and their order must be known upfront though).
+    """
+
+    def __init__(self, columns, compact=None, **json_kwargs):
+        if compact is None:
+            compact = settings.QUERY_RESULTS_COMPACT_FORMAT
+
+        self._file = tempfile.SpooledTemporaryFile(max_size=settings.QUERY_RESULTS_STREAMING_SPOOL_SIZE)
+        self._json_kwargs = json_kwargs
+        self._column_names = [c['name'] for c in columns] if compact else None
+        self._size = 0
+        self.row_count = 0
+        self.finished = False
+
+        self._write((COMPACT_PREFIX if compact else '{') + '"rows": [')
+
+    def _write(self, chunk):
+        if isinstance(chunk, text_type):
+            chunk = chunk.encode('utf-8')
+        self._file.write(chunk)
+        self._size += len(chunk)
+
+    def write_rows(self, rows):
+        if not rows:
+            return
+
+        if self._column_names is not None:
+            rows = [_compact_row(row, self._column_names) for row in rows]
+
+        # Encode the batch as a list and strip the brackets, so batches can simply be joined with commas.
+        encoded = json_dumps(rows, **self._json_kwargs)[1:-1]
+        if self.row_count:
+            self._write(',')
+        self._write(encoded)
+        self.row_count += len(rows)
+
+    def finish(self, columns, **extra):
+        self._write('], "columns": ')
+        self._write(json_dumps(columns, **self._json_kwargs))
+        for key, value in extra.items():
+            self._write(', {}: {}'.format(json_dumps(key), json_dumps(value, **self._json_kwargs)))
+        self._write('}')
+        self.finished = True
+
+    def getfile(self):
+        """Returns the file holding the encoded result (UTF-8), positioned at its start."""
+        if not self.finished:
+            raise ValueError("Can't read a result before it was finished.")
+
+        self._file.seek(0)
+        return self._file
+
+    def iter_chunks(self, chunk_size=64 * 1024):
+        """Yields the encoded result (UTF-8) in chunks of `chunk_size` bytes."""
+        f = self.getfile()
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+    def getvalue(self):
+        """Returns the encoded result as text. This reads it all into memory, so only use it when a string is needed
+        (the `data` column); the storage and compression read the file instead."""
+        return self.getfile().read().decode('utf-8')
+
+    def close(self):
+        self._file.close()
+
+    def __len__(self):
+        return self._size
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,39 @@
+"""
+Bounded fan-out of calls to threads, for query runners that run several queries for one query (like the Query Results
+data source running the queries it references).
+"""
+from multiprocessing.pool import ThreadPool
+
+from flask import current_app
+
+# Waiting with a timeout keeps the wait interruptible (e.g. when the query is cancelled).
+WAIT_TIMEOUT = 365 * 24 * 3600
+
+
+def map_in_threads(func, items, concurrency):
+    """Returns `[func(item) for item in items]`, making up to `concurrency` of the calls at a time, each in a thread
+    with its own app context (and so its own database session).
+
+    The first exception of a call (or an interruption of the wait, like a cancelled query) is raised right away. Calls
+    that are already running are not stopped: their queries keep running on their data sources, and their results are
+    ignored.
+    """
+    items = list(items)
+    if len(items) <= 1:
+        return [func(item) for item in items]
+
+    app = current_app._get_current_object()
+
+    def run(item):
+        with app.app_context():
+            return func(item)
+
+    pool = ThreadPool(min(len(items), concurrency))
+    try:
+        results = pool.map_async(run, items).get(WAIT_TIMEOUT)
+    except BaseException:
+        pool.terminate()
+        raise
+
+    pool.close()
+    return results
@@ -6,7 +6,7 @@ from flask import current_app
 
 from celery import Celery
 from celery.schedules import crontab
-from celery.signals import worker_process_init
+from celery.signals import worker_process_init, worker_process_shutdown
 from celery.utils.log import get_logger
 
 from redash import create_app, extensions, settings
@@ -59,6 +59,19 @@ if settings.QUERY_RESULTS_CLEANUP_ENABLED:
         'schedule': timedelta(minutes=5)
     }
 
+if settings.QUERY_RESULTS_COMPACT_FORMAT:
+    celery_schedule['compact_query_results'] = {
+        'task': 'redash.tasks.compact_query_results',
+        'schedule': timedelta(minutes=5)
+    }
+
+if settings.QUERY_FAIR_SHARE_ENABLED:
+    # Jobs are dispatched as they're enqueued and as others finish; this catches up when a dispatched job is lost.
+    celery_schedule['dispatch_queries'] = {
+        'task': 'redash.tasks.dispatch_queries',
+        'schedule': timedelta(seconds=10)
+    }
+
 celery_schedule.update(settings.dynamic_settings.custom_tasks())
 
 celery.conf.update(result_backend=settings.CELERY_RESULT_BACKEND,
@@ -97,6 +110,16 @@ def init_celery_flask_app(**kwargs):
     app.app_context().push()
 
 
+@worker_process_shutdown.connect
+def remove_query_results_cache(**kwargs):
+    """Remove the files of the Query Results data source's cache of the worker.
+
+    Pool processes exit without running exit handlers (so recycled workers would leave them behind).
+    """
+    from redash.query_runner.query_results import remove_materialized_results
+    remove_materialized_results()
+
+
 @celery.on_after_configure.connect
 def add_periodic_tasks(sender, **kwargs):
     """Load all periodic tasks from extensions and add them to Celery."""
@@ -79,6 +79,26 @@ class TestDataSourceResourcePost(BaseTestCase):
         self.assertEqual(data_source.name, new_name)
         self.assertEqual(data_source.options.to_dict(), new_options)
 
+    def test_updates_max_concurrent_queries(self):
+        admin = self.factory.create_admin()
+        rv = self.make_request('post', self.path,
+                               data={'name': 'DS', 'type': 'pg', 'options': {"dbname": "db"},
+                                     'max_concurrent_queries': 3},
+                               user=admin)
+
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(rv.json['max_concurrent_queries'], 3)
+        self.assertEqual(DataSource.query.get(self.factory.data_source.id).max_concurrent_queries, 3)
+
+    def test_returns_400_when_max_concurrent_queries_invalid(self):
+        admin = self.factory.create_admin()
+        rv = self.make_request('post', self.path,
+                               data={'name': 'DS', 'type': 'pg', 'options': {"dbname": "db"},
+                                     'max_concurrent_queries': 'many'},
+                               user=admin)
+
+        self.assertEqual(rv.status_code, 400)
+
 
 class TestDataSourceResourceDelete(BaseTestCase):
     def test_deletes_the_data_source(self):
@@ -1,8 +1,13 @@
-from tests import BaseTestCase
+from unittest import skipUnless
+
+import mock
+
+from tests import BaseTestCase, authenticate_request
 
 from redash.models import db
 from redash.utils import json_dumps
 from redash.handlers.query_results import error_messages
+from redash.serializers.query_result import arrow_enabled
 
 
 class TestQueryResultsCacheHeaders(BaseTestCase):
@@ -27,6 +32,67 @@ class TestQueryResultsCacheHeaders(BaseTestCase):
         self.assertEqual(404, rv.status_code)
 
 
+class TestQueryResultsETags(BaseTestCase):
+    def test_sets_etag_per_result_and_format(self):
+        query_result = self.factory.create_query_result()
+        query = self.factory.create_query(latest_query_data=query_result)
+
+        json_rv = self.make_request('get', '/api/queries/{}/results.json'.format(query.id))
+        csv_rv = self.make_request('get', '/api/queries/{}/results.csv'.format(query.id), is_json=False)
+
+        self.assertEqual('"{}.json"'.format(query_result.id), json_rv.headers['ETag'])
+        self.assertEqual('"{}.csv"'.format(query_result.id), csv_rv.headers['ETag'])
+
+    def test_returns_304_when_result_didnt_change(self):
+        query_result = self.factory.create_query_result()
+        query = self.factory.create_query(latest_query_data=query_result)
+        authenticate_request(self.client, self.factory.user)
+
+        for filetype in ('json', 'csv', 'xlsx'):
+            rv = self.get_request('/api/queries/{}/results.{}'.format(query.id, filetype), org=self.factory.org,
+                                  headers={'If-None-Match': '"{}.{}"'.format(query_result.id, filetype)})
+            self.assertEqual(304, rv.status_code)
+            self.assertEqual(b'', rv.data)
+
+    def test_returns_result_when_etag_is_outdated(self):
+        old_result = self.factory.create_query_result()
+        query_result = self.factory.create_query_result()
+        query = self.factory.create_query(latest_query_data=query_result)
+        authenticate_request(self.client, self.factory.user)
+
+        rv = self.get_request('/api/queries/{}/results.json'.format(query.id), org=self.factory.org,
+                              headers={'If-None-Match': '"{}.json"'.format(old_result.id)})
+        self.assertEqual(200, rv.status_code)
+        self.assertEqual('"{}.json"'.format(query_result.id), rv.headers['ETag'])
+
+
+class TestQueryResultPages(BaseTestCase):
+    def setUp(self):
+        super(TestQueryResultPages, self).setUp()
+        data = {'columns': [{'name': 'a'}, {'name': 'b'}], 'rows': [{'a': i, 'b': -i} for i in range(10)]}
+        self.query_result = self.factory.create_query_result(data=json_dumps(data))
+
+    def test_returns_page_and_total_rows(self):
+        rv = self.make_request('get', '/api/query_results/{}?offset=2&limit=3&columns=b'.format(self.query_result.id))
+
+        self.assertEqual(200, rv.status_code)
+        data = rv.json['query_result']['data']
+        self.assertEqual([{'b': -2}, {'b': -3}, {'b': -4}], data['rows'])
+        self.assertEqual([{'name': 'b'}], data['columns'])
+        self.assertEqual(10, data['total_rows'])
+
+    def test_pages_have_their_own_etag(self):
+        full = self.make_request('get', '/api/query_results/{}'.format(self.query_result.id))
+        page = self.make_request('get', '/api/query_results/{}?limit=3'.format(self.query_result.id))
+
+        self.assertNotEqual(full.headers['ETag'], page.headers['ETag'])
+
+    def test_returns_400_for_invalid_parameters(self):
+        for params in ('offset=-1', 'limit=many', 'columns=c'):
+            rv = self.make_request('get', '/api/query_results/{}?{}'.format(self.query_result.id, params))
+            self.assertEqual(400, rv.status_code)
+
+
 class TestQueryResultListAPI(BaseTestCase):
     def test_get_existing_result(self):
         query_result = self.factory.create_query_result()
@@ -137,6 +203,21 @@ class TestQueryResultAPI(BaseTestCase):
         rv = self.make_request('get', '/api/query_results/{}'.format(query_result.id))
         self.assertEquals(rv.status_code, 200)
 
+    @mock.patch('redash.settings.QUERY_RESULTS_CACHE_SIZE', 1024 * 1024)
+    def test_serves_cached_result(self):
+        query_result = self.factory.create_query_result(data=json_dumps({'columns': [], 'rows': [{'a': 1}]}))
+
+        rv = self.make_request('get', '/api/query_results/{}'.format(query_result.id))
+        self.assertEqual([{'a': 1}], rv.json['query_result']['data']['rows'])
+
+        # Results never change, so a changed row means the response came from the cache.
+        query_result.data = json_dumps({'columns': [], 'rows': []})
+        db.session.commit()
+
+        rv = self.make_request('get', '/api/query_results/{}'.format(query_result.id))
+        self.assertEqual(200, rv.status_code)
+        self.assertEqual([{'a': 1}], rv.json['query_result']['data']['rows'])
+
     def test_execute_new_query(self):
         query = self.factory.create_query()
 
@@ -328,3 +409,24 @@ class TestQueryResultExcelResponse(BaseTestCase):
         rv = self.make_request('get', '/api/queries/{}/results/{}.xlsx'.format(query.id, query_result.id), is_json=False)
         self.assertEquals(rv.status_code, 200)
 
+
+class TestQueryResultArrowResponse(BaseTestCase):
+    def test_fails_without_pyarrow(self):
+        query = self.factory.create_query()
+        query_result = self.factory.create_query_result()
+
+        with mock.patch('redash.handlers.query_results.arrow_enabled', False):
+            rv = self.make_request('get', '/api/queries/{}/results/{}.parquet'.format(query.id, query_result.id),
+                                   is_json=False)
+        self.assertEquals(rv.status_code, 400)
+
+    @skipUnless(arrow_enabled, "pyarrow is not installed")
+    def test_returns_parquet_file(self):
+        query = self.factory.create_query()
+        data = {'columns': [{'name': 'a', 'type': 'integer'}], 'rows': [{'a': 1}]}
+        query_result = self.factory.create_query_result(data=json_dumps(data))
+
+        rv = self.make_request('get', '/api/queries/{}/results/{}.parquet'.format(query.id, query_result.id),
+                               is_json=False)
+        self.assertEquals(rv.status_code, 200)
+        self.assertEquals('PAR1', rv.data[:4])
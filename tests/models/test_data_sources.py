@@ -74,6 +74,43 @@ class TestDataSourceIsPaused(BaseTestCase):
         self.assertEqual(self.factory.data_source.pause_reason, None)
 
 
+class TestDataSourceQuerySlots(BaseTestCase):
+    def test_unlimited_by_default(self):
+        data_source = self.factory.data_source
+        for i in range(10):
+            self.assertTrue(data_source.acquire_query_slot('job-{}'.format(i), 60, 30))
+        self.assertEqual(0, data_source.queries_in_flight)
+
+    def test_limits_in_flight_queries(self):
+        data_source = self.factory.create_data_source(max_concurrent_queries=2)
+
+        self.assertTrue(data_source.acquire_query_slot('a', 60, 30))
+        self.assertTrue(data_source.acquire_query_slot('b', 60, 30))
+        self.assertFalse(data_source.acquire_query_slot('c', 60, 30))
+        self.assertEqual(2, data_source.queries_in_flight)
+        self.assertEqual(1, data_source.queries_waiting)
+
+        data_source.release_query_slot('a')
+        self.assertTrue(data_source.acquire_query_slot('c', 60, 30))
+        self.assertEqual(2, data_source.queries_in_flight)
+        self.assertEqual(0, data_source.queries_waiting)
+
+    def test_reacquiring_a_held_slot(self):
+        data_source = self.factory.create_data_source(max_concurrent_queries=1)
+
+        self.assertTrue(data_source.acquire_query_slot('a', 60, 30))
+        self.assertTrue(data_source.acquire_query_slot('a', 60, 30))
+        self.assertEqual(1, data_source.queries_in_flight)
+
+    def test_reclaims_expired_slots(self):
+        data_source = self.factory.create_data_source(max_concurrent_queries=1)
+
+        with patch('time.time', return_value=1000):
+            self.assertTrue(data_source.acquire_query_slot('a', 60, 30))
+        with patch('time.time', return_value=1061):
+            self.assertTrue(data_source.acquire_query_slot('b', 60, 30))
+
+
 class TestDataSourceDelete(BaseTestCase):
     def test_deletes_the_data_source(self):
         data_source = self.factory.create_data_source()
@@ -1,10 +1,20 @@
 #encoding: utf8
 import datetime
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+import mock
+from sqlalchemy import event
 
 from tests import BaseTestCase
 
 from redash import models
-from redash.utils import utcnow, json_dumps
+from redash.result_storage import ResultStorageError
+from redash.utils import utcnow, json_dumps, json_loads
+from redash.utils.query_results import COMPACT_PREFIX, COMPRESSED_PREFIX, ResultWriter
 
 
 class QueryResultTest(BaseTestCase):
@@ -66,4 +76,155 @@ class QueryResultTest(BaseTestCase):
 
         models.QueryResult.store_result(query.org_id, query.data_source, query.query_hash, query.query_text, "", 0, utcnow())
 
-        self.assertEqual(original_updated_at, query.updated_at)
\ No newline at end of file
+        self.assertEqual(original_updated_at, query.updated_at)
+
+    def test_store_result_updates_matching_queries_in_one_statement(self):
+        # Benchmark: a query forked 1,000 times gets all of its copies updated without loading any of them.
+        query = self.factory.create_query()
+        models.db.session.add_all([
+            models.Query(name=u'Fork {}'.format(i), description=u'', query_text=query.query_text, org_id=query.org_id,
+                         user_id=query.user_id, data_source_id=query.data_source_id, is_archived=False,
+                         is_draft=False, schedule=None)
+            for i in range(999)
+        ])
+        models.db.session.commit()
+        org_id, data_source, query_hash, query_text = query.org_id, query.data_source, query.query_hash, query.query_text
+
+        statements = []
+
+        def record_statement(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(models.db.engine, 'before_cursor_execute', record_statement)
+        self.addCleanup(event.remove, models.db.engine, 'before_cursor_execute', record_statement)
+
+        started_at = time.time()
+        query_result, query_ids = models.QueryResult.store_result(org_id, data_source, query_hash, query_text, "", 0,
+                                                                  utcnow())
+        logging.info("store_result updated %d queries in %.3fs", len(query_ids), time.time() - started_at)
+
+        self.assertEqual(1000, len(query_ids))
+        self.assertEqual(1, len([statement for statement in statements if statement.startswith('UPDATE queries')]))
+        self.assertEqual([], [statement for statement in statements if 'FROM queries' in statement])
+        self.assertEqual(query_result, query.latest_query_data)
+        self.assertEqual(1, query.version)
+
+    @mock.patch('redash.settings.QUERY_RESULTS_COMPACT_FORMAT', True)
+    def test_store_result_in_compact_format(self):
+        query = self.factory.create_query()
+        data = {'columns': [{'name': 'a', 'type': 'integer'}], 'rows': [{'a': 1}, {'a': 2}]}
+
+        query_result, _ = models.QueryResult.store_result(query.org_id, query.data_source, query.query_hash,
+                                                          query.query_text, json_dumps(data), 0, utcnow())
+
+        self.assertTrue(query_result.data.startswith(COMPACT_PREFIX))
+        self.assertEqual(data, query_result.to_dict()['data'])
+
+    @mock.patch('redash.settings.QUERY_RESULTS_COMPACT_FORMAT', True)
+    def test_get_data_page_decodes_rows_lazily(self):
+        query = self.factory.create_query()
+        data = {'columns': [{'name': 'a', 'type': 'integer'}], 'rows': [{'a': 1}, {'a': 2}, {'a': 3}]}
+        query_result, _ = models.QueryResult.store_result(query.org_id, query.data_source, query.query_hash,
+                                                          query.query_text, json_dumps(data), 0, utcnow())
+
+        with mock.patch('redash.models.json_loads') as json_loads_mock:
+            page = query_result.get_data_page(offset=1, limit=1)
+
+        json_loads_mock.assert_not_called()
+        self.assertEqual([{'a': 2}], page['rows'])
+        self.assertEqual(3, page['total_rows'])
+
+    @mock.patch('redash.settings.QUERY_RESULTS_COMPRESSION_ENABLED', True)
+    @mock.patch('redash.settings.QUERY_RESULTS_COMPRESSION_THRESHOLD', 10)
+    def test_store_result_compresses_large_results(self):
+        query = self.factory.create_query()
+        data = {'columns': [{'name': 'a', 'type': 'integer'}], 'rows': [{'a': 1}, {'a': 2}]}
+
+        query_result, _ = models.QueryResult.store_result(query.org_id, query.data_source, query.query_hash,
+                                                          query.query_text, json_dumps(data), 0, utcnow())
+
+        self.assertTrue(query_result.data.startswith(COMPRESSED_PREFIX))
+        self.assertEqual(data, query_result.to_dict()['data'])
+
+    def test_store_result_in_external_storage(self):
+        query = self.factory.create_query()
+        data = {'columns': [{'name': 'a', 'type': 'integer'}], 'rows': [{'a': 1}, {'a': 2}]}
+        storage_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, storage_dir)
+
+        with mock.patch('redash.settings.QUERY_RESULTS_STORAGE_URL', 'file://' + storage_dir), \
+                mock.patch('redash.settings.QUERY_RESULTS_STORAGE_THRESHOLD', 10):
+            query_result, _ = models.QueryResult.store_result(query.org_id, query.data_source, query.query_hash,
+                                                              query.query_text, json_dumps(data), 0, utcnow())
+
+            self.assertIsNone(query_result.data)
+            self.assertTrue(query_result.data_key.startswith('{}/'.format(query.org_id)))
+            self.assertEqual(len(json_dumps(data)), query_result.data_size)
+            self.assertEqual(data, query_result.to_dict()['data'])
+
+            query_result.data_hash = '0' * 64
+            self.assertRaises(ResultStorageError, query_result.get_data)
+
+    def test_store_streamed_result_passes_its_file_to_external_storage(self):
+        query = self.factory.create_query()
+        columns = [{'name': 'a', 'type': 'integer'}]
+        storage_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, storage_dir)
+
+        with ResultWriter(columns, compact=False) as writer, \
+                mock.patch('redash.settings.QUERY_RESULTS_STORAGE_URL', 'file://' + storage_dir), \
+                mock.patch('redash.settings.QUERY_RESULTS_STORAGE_THRESHOLD', 10), \
+                mock.patch('redash.models.result_storage.put_result',
+                           wraps=models.result_storage.put_result) as put_result, \
+                mock.patch.object(ResultWriter, 'getvalue', side_effect=AssertionError("read into a string")):
+            writer.write_rows([{'a': 1}, {'a': 2}])
+            writer.finish(columns)
+            query_result, _ = models.QueryResult.store_result(query.org_id, query.data_source, query.query_hash,
+                                                              query.query_text, writer, 0, utcnow())
+
+            self.assertIs(writer.getfile(), put_result.call_args[0][1])
+            self.assertEqual(len(writer), query_result.data_size)
+            self.assertEqual([{'a': 1}, {'a': 2}], query_result.get_data()['rows'])
+
+    def test_store_streamed_result_in_database(self):
+        query = self.factory.create_query()
+        columns = [{'name': 'a', 'type': 'integer'}]
+
+        with ResultWriter(columns, compact=False) as writer:
+            writer.write_rows([{'a': 1}])
+            writer.finish(columns)
+            query_result, _ = models.QueryResult.store_result(query.org_id, query.data_source, query.query_hash,
+                                                              query.query_text, writer, 0, utcnow())
+
+        self.assertEqual({'rows': [{'a': 1}], 'columns': columns}, json_loads(query_result.data))
+
+    def test_store_result_deletes_blob_when_rolled_back(self):
+        query = self.factory.create_query()
+        data = {'columns': [{'name': 'a', 'type': 'integer'}], 'rows': [{'a': 1}, {'a': 2}]}
+        storage_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, storage_dir)
+
+        with mock.patch('redash.settings.QUERY_RESULTS_STORAGE_URL', 'file://' + storage_dir), \
+                mock.patch('redash.settings.QUERY_RESULTS_STORAGE_THRESHOLD', 10):
+            committed, _ = models.QueryResult.store_result(query.org_id, query.data_source, query.query_hash,
+                                                           query.query_text, json_dumps(data), 0, utcnow())
+            models.db.session.commit()
+            rolled_back, _ = models.QueryResult.store_result(query.org_id, query.data_source, query.query_hash,
+                                                             query.query_text, json_dumps(data), 0, utcnow())
+            committed_path = os.path.join(storage_dir, *committed.data_key.split('/'))
+            rolled_back_path = os.path.join(storage_dir, *rolled_back.data_key.split('/'))
+            models.db.session.rollback()
+
+        self.assertTrue(os.path.exists(committed_path))
+        self.assertFalse(os.path.exists(rolled_back_path))
+
+    def test_store_result_below_storage_threshold_stays_in_database(self):
+        query = self.factory.create_query()
+        data = json_dumps({'columns': [], 'rows': []})
+
+        with mock.patch('redash.settings.QUERY_RESULTS_STORAGE_URL', 'file://' + tempfile.gettempdir()):
+            query_result, _ = models.QueryResult.store_result(query.org_id, query.data_source, query.query_hash,
+                                                              query.query_text, data, 0, utcnow())
+
+        self.assertEqual(data, query_result.data)
+        self.assertIsNone(query_result.data_key)
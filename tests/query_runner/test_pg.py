@@ -0,0 +1,177 @@
+import datetime
+import decimal
+from unittest import TestCase
+
+import mock
+
+from redash.query_runner import get_query_runner
+from redash.query_runner.pg import PostgreSQL, Redshift
+from redash.utils import json_loads
+from redash.utils.connection_pool import close_pools
+
+
+class FakeCursor(object):
+    def __init__(self, rows):
+        self.rows = rows
+        self.description = [('a', 23)]
+        self.statements = []
+        self._result = []
+
+    def execute(self, statement):
+        self.statements.append(statement)
+        if statement.startswith('FETCH FORWARD '):
+            count = int(statement.split()[2])
+            self._result, self.rows = self.rows[:count], self.rows[count:]
+
+    def fetchall(self):
+        return self._result
+
+
+@mock.patch('redash.query_runner.pg._wait')
+class TestServerSideCursor(TestCase):
+    def run_query_iter(self, cursor, configuration):
+        connection = mock.Mock()
+        connection.cursor.return_value = cursor
+        runner = PostgreSQL(dict(configuration, server_side_cursor=True))
+
+        with mock.patch.object(runner, '_connect', return_value=connection):
+            columns, batches = runner.run_query_iter('SELECT a FROM t;', None)
+            rows = [row for batch in batches for row in batch]
+
+        return rows, batches.metadata
+
+    def test_fetches_in_batches(self, _):
+        cursor = FakeCursor([(i,) for i in range(5)])
+        rows, metadata = self.run_query_iter(cursor, {'fetch_size': 2})
+
+        self.assertEqual([{'a': i} for i in range(5)], rows)
+        self.assertEqual({}, metadata)
+        self.assertEqual('DECLARE redash_result NO SCROLL CURSOR FOR SELECT a FROM t', cursor.statements[1])
+        self.assertEqual(['FETCH FORWARD 2 FROM redash_result'] * 4 + ['COMMIT'], cursor.statements[2:])
+
+    def test_stops_fetching_at_max_rows(self, _):
+        cursor = FakeCursor([(i,) for i in range(10)])
+        rows, metadata = self.run_query_iter(cursor, {'fetch_size': 2, 'max_rows': 3})
+
+        self.assertEqual([{'a': i} for i in range(3)], rows)
+        self.assertEqual({'truncated': True}, metadata)
+        self.assertEqual(6, len(cursor.rows))
+
+    def test_result_of_max_rows_isnt_truncated(self, _):
+        cursor = FakeCursor([(i,) for i in range(3)])
+        rows, metadata = self.run_query_iter(cursor, {'fetch_size': 2, 'max_rows': 3})
+
+        self.assertEqual(3, len(rows))
+        self.assertEqual({}, metadata)
+
+    def test_run_query_returns_errors(self, _):
+        cursor = FakeCursor([])
+        cursor.description = None
+        connection = mock.Mock()
+        connection.cursor.return_value = cursor
+        runner = PostgreSQL({'server_side_cursor': True})
+
+        with mock.patch.object(runner, '_connect', return_value=connection):
+            self.assertEqual((None, 'Query completed but it returned no data.'), runner.run_query('SET x = 1', None))
+
+
+@mock.patch('redash.query_runner.pg._wait')
+class TestGetDefinitions(TestCase):
+    def test_schema_isnt_capped(self, _):
+        cursor = mock.MagicMock(description=[('table_schema', 1043), ('table_name', 1043), ('column_name', 1043)],
+                                rowcount=3)
+        cursor.__iter__.side_effect = lambda: iter([('public', 'a', 'id'), ('public', 'b', 'id'), ('s', 'c', 'id')])
+        connection = mock.Mock()
+        connection.cursor.return_value = cursor
+        runner = PostgreSQL({'max_rows': 1, 'server_side_cursor': True})
+
+        schema = {}
+        with mock.patch.object(runner, '_connect', return_value=connection):
+            runner._get_definitions(schema, 'SELECT ...')
+
+        self.assertEqual(['a', 'b', 's.c'], sorted(schema.keys()))
+
+
+@mock.patch('redash.query_runner.pg._wait')
+class TestNativeResult(TestCase):
+    def make_runner(self):
+        cursor = mock.MagicMock(description=[('a', 1114), ('b', 1700)], rowcount=2)
+        cursor.__iter__.side_effect = lambda: iter([(datetime.datetime(2019, 5, 26, 12, 39), decimal.Decimal('1.5')),
+                                                    (None, float('nan'))])
+        connection = mock.Mock()
+        connection.cursor.return_value = cursor
+        runner = PostgreSQL({})
+        return runner, mock.patch.object(runner, '_connect', return_value=connection)
+
+    def test_returns_result_of_run_query(self, _):
+        runner, connect = self.make_runner()
+        with connect:
+            json_data, _ = runner.run_query('SELECT a, b FROM t', None)
+            data, error = runner.run_query_native('SELECT a, b FROM t', None)
+
+        self.assertIsNone(error)
+        self.assertEqual(json_loads(json_data), data)
+        self.assertEqual([{'a': '2019-05-26T12:39:00', 'b': 1.5}, {'a': None, 'b': None}], data['rows'])
+
+    def test_returns_result_of_run_shared_query(self, _):
+        runner, connect = self.make_runner()
+        with connect:
+            data, error = runner.run_shared_query_native('SELECT a, b FROM t WHERE c = %s', [1], None)
+
+        self.assertIsNone(error)
+        self.assertEqual({'a': '2019-05-26T12:39:00', 'b': 1.5}, data['rows'][0])
+
+
+@mock.patch('redash.query_runner.pg._wait')
+class TestSecureQuery(TestCase):
+    def test_caps_rows_at_max_rows(self, _):
+        cursor = mock.MagicMock(description=[('a', 23)], rowcount=3)
+        cursor.fetchmany.side_effect = lambda count: [(i,) for i in range(count)]
+        connection = mock.Mock()
+        connection.cursor.return_value = cursor
+        runner = PostgreSQL({'max_rows': 2})
+
+        with mock.patch.object(runner, '_connect', return_value=connection):
+            json_data, error = runner.run_secure_query('SELECT a FROM t WHERE b = {{b}}', {'b': 1}, None)
+
+        self.assertIsNone(error)
+        self.assertEqual([{'a': 0}, {'a': 1}], json_loads(json_data)['rows'])
+        self.assertTrue(json_loads(json_data)['truncated'])
+        cursor.execute.assert_called_once_with('SELECT a FROM t WHERE b = %(b)s', {'b': 1})
+
+
+class TestConnectionPool(TestCase):
+    def tearDown(self):
+        close_pools()
+
+    def test_data_sources_differing_in_options_get_their_own_pool(self):
+        runner = PostgreSQL({'host': 'db', 'dbname': 'redash', 'user': 'redash'})
+        other_runner = PostgreSQL({'host': 'db', 'dbname': 'redash', 'user': 'redash', 'sslmode': 'require'})
+
+        pool = runner._get_pool()
+        self.assertIsNot(pool, other_runner._get_pool())
+        self.assertIs(pool, runner._get_pool())
+        self.assertFalse(pool.closed)
+
+    def test_closes_pool_of_edited_data_source(self):
+        configuration = {'host': 'db', 'dbname': 'redash', 'password': 'old'}
+        pool = get_query_runner('pg', configuration, 1)._get_pool()
+
+        edited_configuration = dict(configuration, password='new')
+        new_pool = get_query_runner('pg', edited_configuration, 1)._get_pool()
+
+        self.assertIsNot(pool, new_pool)
+        self.assertTrue(pool.closed)
+        self.assertIs(new_pool, get_query_runner('pg', edited_configuration, 1)._get_pool())
+        self.assertIsNot(new_pool, get_query_runner('pg', edited_configuration, 2)._get_pool())
+
+
+class TestRedshiftSessionStatements(TestCase):
+    def test_splits_query_group(self):
+        runner = Redshift({'adhoc_query_group': 'adhoc'})
+        query = runner.annotate_query('SELECT 1', {})
+
+        statements, query = runner._split_session_statements(query)
+
+        self.assertEqual(['set query_group to adhoc;'], statements)
+        self.assertTrue(query.endswith('SELECT 1'))
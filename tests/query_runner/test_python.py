@@ -0,0 +1,66 @@
+import time
+
+import mock
+
+from redash.query_runner.python import Python
+from tests import BaseTestCase
+
+
+class TestExecuteSharedQueryForTenants(BaseTestCase):
+    def setUp(self):
+        super(TestExecuteSharedQueryForTenants, self).setUp()
+        patcher = mock.patch.object(Python, 'get_tenant_data_source', side_effect=self.get_tenant_data_source)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def get_tenant_data_source(self, tenant_id, user):
+        if tenant_id == 3:
+            raise Exception("Can't access data source name: datasource_3.")
+        return mock.Mock(query_runner=tenant_id)
+
+    def run_shared_query(self, query_runner, query, parameters, user):
+        time.sleep(0.5)
+        if query_runner == 2:
+            raise Exception('Query failed.')
+        return {'columns': [{'name': 'value', 'type': 'integer'}], 'rows': [{'value': query_runner * 10}]}
+
+    def test_runs_tenant_queries_at_the_same_time(self):
+        started_at = time.time()
+        with mock.patch.object(Python, '_run_shared_query_native', side_effect=self.run_shared_query):
+            result = Python.execute_shared_query_for_tenants([1, 4, 5], 'SELECT 1', None, {})
+
+        self.assertLess(time.time() - started_at, 1.5)
+        self.assertEqual([1, 4, 5], sorted(result['results'].keys()))
+        self.assertEqual([{'value': 40}], result['results'][4]['rows'])
+        self.assertEqual({}, result['errors'])
+        self.assertEqual([1, 4, 5], sorted(result['timings'].keys()))
+
+    def test_reports_errors_per_tenant(self):
+        with mock.patch.object(Python, '_run_shared_query_native', side_effect=self.run_shared_query):
+            result = Python.execute_shared_query_for_tenants([1, 2, 3], 'SELECT 1', None, {})
+
+        self.assertEqual([1], list(result['results'].keys()))
+        self.assertEqual({2: 'Query failed.', 3: "Can't access data source name: datasource_3."}, result['errors'])
+        self.assertEqual([1, 2], sorted(result['timings'].keys()))
+
+    def test_reports_non_ascii_errors(self):
+        error = u'relation "t" n\u2019existe pas'.encode('utf-8')
+        with mock.patch.object(Python, '_run_shared_query_native', side_effect=Exception(error)):
+            result = Python.execute_shared_query_for_tenants([1, 4], 'SELECT 1', None, {})
+
+        self.assertEqual({1: error.decode('utf-8'), 4: error.decode('utf-8')}, result['errors'])
+
+    def test_queries_repeated_tenants_once(self):
+        with mock.patch.object(Python, '_run_shared_query_native', side_effect=self.run_shared_query) as run:
+            result = Python.execute_shared_query_for_tenants([1, '1', 4, 1], 'SELECT 1', None, {}, merge=True)
+
+        self.assertEqual(2, run.call_count)
+        self.assertEqual([{'tenant_id': 1, 'value': 10}, {'tenant_id': 4, 'value': 40}], result['results']['rows'])
+
+    def test_merges_results(self):
+        with mock.patch.object(Python, '_run_shared_query_native', side_effect=self.run_shared_query):
+            result = Python.execute_shared_query_for_tenants([5, 1, 2], 'SELECT 1', None, {}, merge=True)
+
+        self.assertEqual(['tenant_id', 'value'], [c['name'] for c in result['results']['columns']])
+        self.assertEqual([{'tenant_id': 5, 'value': 50}, {'tenant_id': 1, 'value': 10}], result['results']['rows'])
+        self.assertEqual(['Query failed.'], list(result['errors'].values()))
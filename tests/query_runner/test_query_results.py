@@ -1,11 +1,18 @@
+import os
+import shutil
 import sqlite3
+import tempfile
+import time
 from unittest import TestCase
 
+import mock
 import pytest
 
 from redash.query_runner.query_results import (
-    CreateTableError, PermissionError, _load_query, create_table,
-    extract_cached_query_ids, extract_query_ids, fix_column_name)
+    CACHE_DIRECTORY_PREFIX, CreateTableError, PermissionError, Results, _directory_name, _load_query, create_table,
+    MaterializedResults, extract_cached_query_ids, extract_condition_columns, extract_query_ids, fix_column_name,
+    run_queries)
+from redash.utils import json_dumps
 from tests import BaseTestCase
 
 
@@ -188,6 +195,172 @@ class TestCreateTable(TestCase):
         self.assertEquals(
             len(list(connection.execute('SELECT * FROM query_123'))), 2)
 
+    def test_declares_column_affinities(self):
+        connection = sqlite3.connect(':memory:')
+        results = {
+            'columns': [{
+                'name': 'test1', 'type': 'integer'
+            }, {
+                'name': 'test2', 'type': 'string'
+            }, {
+                'name': 'test3'
+            }],
+            'rows': [{'test1': '1', 'test2': 2, 'test3': '3'}]
+        }
+        table_name = 'query_123'
+        create_table(connection, table_name, results)
+        self.assertEquals(
+            [('integer', 'integer', 'text')],
+            list(connection.execute('SELECT typeof(test1), typeof(test2), typeof(test3) FROM query_123')))
+
+    def test_compares_numbers_of_string_columns_as_numbers(self):
+        rows = [{'id': 2, 'x': 9}, {'id': 10, 'x': 11}, {'id': '10', 'x': 'text'}]
+        untyped = sqlite3.connect(':memory:')
+        create_table(untyped, 'query_1', {'columns': [{'name': 'id'}, {'name': 'x'}], 'rows': rows})
+        typed = sqlite3.connect(':memory:')
+        create_table(typed, 'query_1', {
+            'columns': [{'name': 'id', 'type': 'string'}, {'name': 'x', 'type': 'string'}],
+            'rows': rows,
+        })
+
+        for query in ('SELECT id FROM query_1 WHERE x > 10 ORDER BY id',
+                      'SELECT a.id FROM query_1 a JOIN query_1 b ON a.id = b.id AND a.x < b.x'):
+            self.assertEquals(list(untyped.execute(query)), list(typed.execute(query)))
+
+        self.assertEquals([(10,), ('10',)], list(typed.execute('SELECT id FROM query_1 WHERE x > 10')))
+
+    def test_loads_list_and_dict_values_of_numeric_columns(self):
+        connection = sqlite3.connect(':memory:')
+        results = {
+            'columns': [{'name': 'test1', 'type': 'integer'}, {'name': 'test2', 'type': 'boolean'}],
+            'rows': [{'test1': [1, 2], 'test2': {'a': 'b'}}, {'test1': 1, 'test2': True}]
+        }
+        create_table(connection, 'query_123', results)
+        self.assertEquals([('[1, 2]', '{"a": "b"}'), (1, 1)], list(connection.execute('SELECT * FROM query_123')))
+
+    def test_indexes_columns(self):
+        connection = sqlite3.connect(':memory:')
+        results = {
+            'columns': [{
+                'name': 'parent id'
+            }, {
+                'name': 'test2'
+            }],
+            'rows': [{'parent id': 1, 'test2': 2}]
+        }
+        table_name = 'query_123'
+        create_table(connection, table_name, results, indexed_columns={'parent_id'})
+        indexes = connection.execute("SELECT sql FROM sqlite_master WHERE type = 'index'")
+        self.assertEquals([('CREATE INDEX query_123_0 ON query_123 ("parent_id")',)], list(indexes))
+
+
+class TestExtractConditionColumns(TestCase):
+    def test_finds_columns_in_conditions(self):
+        query = 'SELECT a.name FROM query_1 a JOIN query_2 b ON a.id = b."Parent_Id" WHERE b.status = 1 ORDER BY a.name'
+        names = extract_condition_columns(query)
+        self.assertTrue({'id', 'parent_id', 'status'} <= names)
+        self.assertNotIn('name', names)
+
+    def test_finds_columns_in_using(self):
+        query = 'SELECT * FROM query_1 JOIN query_2 USING (id)'
+        self.assertIn('id', extract_condition_columns(query))
+
+
+class TestRunQueries(BaseTestCase):
+    def make_query(self, query_id, run_query):
+        query_runner = mock.Mock(run_query=run_query)
+        return mock.Mock(id=query_id, query_text='SELECT {}'.format(query_id),
+                         data_source=mock.Mock(query_runner=query_runner))
+
+    def test_runs_queries_at_the_same_time(self):
+        def run_query(query_text, user):
+            time.sleep(0.5)
+            return json_dumps({'columns': [], 'rows': [{'query': query_text}]}), None
+
+        started_at = time.time()
+        results = run_queries(None, [self.make_query(1, run_query), self.make_query(2, run_query)])
+
+        self.assertEqual([[{'query': 'SELECT 1'}], [{'query': 'SELECT 2'}]], [r['rows'] for r in results])
+        self.assertLess(time.time() - started_at, 1)
+
+    def test_raises_when_a_query_fails(self):
+        def run_query(query_text, user):
+            if query_text == 'SELECT 2':
+                return None, 'Error'
+            return json_dumps({'columns': [], 'rows': []}), None
+
+        with pytest.raises(Exception):
+            run_queries(None, [self.make_query(1, run_query), self.make_query(2, run_query)])
+
+
+class TestMaterializedResults(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory, True)
+        self.materialized_results = MaterializedResults(self.directory, 10 * 1024 * 1024)
+        self.loaded = []
+
+    def loader(self, rows):
+        def load_results():
+            self.loaded.append(rows)
+            return {
+                'columns': [{'name': 'id', 'type': 'integer'}, {'name': 'value', 'type': 'string'}],
+                'rows': [{'id': i, 'value': 'x' * 50} for i in range(rows)]
+            }
+
+        return load_results
+
+    def test_reuses_materialized_results(self):
+        for _ in range(2):
+            connection = sqlite3.connect(':memory:')
+            self.materialized_results.attach(connection, 'cached_query_1', 101, self.loader(100))
+            self.materialized_results.attach(connection, 'cached_query_2', 102, self.loader(50))
+            self.assertEquals([(50,)], list(connection.execute(
+                'SELECT COUNT(*) FROM cached_query_1 a JOIN cached_query_2 b ON a.id = b.id')))
+            connection.close()
+
+        self.assertEquals([100, 50], self.loaded)
+
+    def test_adds_indexes_to_reused_results(self):
+        for indexed_columns in ((), ('value',), ('id',)):
+            connection = sqlite3.connect(':memory:')
+            self.materialized_results.attach(connection, 'cached_query_1', 101, self.loader(100), indexed_columns)
+            connection.close()
+
+        connection = sqlite3.connect(os.path.join(self.materialized_results.directory, '101.sqlite'))
+        self.assertEquals([(100,)], list(connection.execute('SELECT COUNT(*) FROM result')))
+        self.assertEquals(['result_0', 'result_1'],
+                          sorted(row[1] for row in connection.execute('PRAGMA index_list(result)')))
+        connection.close()
+        self.assertEquals([100], self.loaded)
+
+    def test_evicts_least_recently_used_results(self):
+        connection = sqlite3.connect(':memory:')
+        self.materialized_results.attach(connection, 'cached_query_1', 101, self.loader(200))
+        # Room for two results of the same size.
+        size = os.path.getsize(os.path.join(self.materialized_results.directory, '101.sqlite'))
+        self.materialized_results.max_size = size * 2
+        self.materialized_results.attach(connection, 'cached_query_2', 102, self.loader(200))
+        self.materialized_results.attach(connection, 'cached_query_3', 103, self.loader(200))
+
+        self.assertEquals(['102.sqlite', '103.sqlite'], sorted(os.listdir(self.materialized_results.directory)))
+        # Evicted results stay readable by the connections they're attached to.
+        self.assertEquals([(200,)], list(connection.execute('SELECT COUNT(*) FROM cached_query_1')))
+
+    def test_removes_directories_of_processes_that_are_gone(self):
+        gone = os.path.join(self.directory, _directory_name(99999999))
+        running = os.path.join(self.directory, _directory_name(os.getppid()))
+        other_host = os.path.join(self.directory, CACHE_DIRECTORY_PREFIX + 'other-host-99999999')
+        for directory in (gone, running, other_host):
+            os.mkdir(directory)
+
+        materialized_results = MaterializedResults(self.directory, 1024)
+        self.assertEquals(sorted([materialized_results.directory, running, other_host]),
+                          sorted(os.path.join(self.directory, name) for name in os.listdir(self.directory)))
+
+        materialized_results.remove()
+        self.assertFalse(os.path.exists(materialized_results.directory))
+
 
 class TestGetQuery(BaseTestCase):
     # test query from different account
@@ -242,3 +415,16 @@ class TestExtractCachedQueryIds(TestCase):
 class TestFixColumnName(TestCase):
     def test_fix_column_name(self):
         self.assertEquals(u'"a_b_c_d"', fix_column_name("a:b.c d"))
+
+
+class TestRunQueryIter(TestCase):
+    def test_streams_rows_and_guesses_types(self):
+        columns, batches = Results({}).run_query_iter("SELECT 1 AS a, 'x' AS b UNION ALL SELECT 2, 'y'", None)
+        rows = [row for batch in batches for row in batch]
+
+        self.assertEqual([{'a': 1, 'b': 'x'}, {'a': 2, 'b': 'y'}], rows)
+        self.assertEqual(['integer', 'string'], [c['type'] for c in columns])
+
+    def test_raises_when_query_returns_no_data(self):
+        with pytest.raises(Exception):
+            Results({}).run_query_iter("CREATE TABLE t (a)", None)
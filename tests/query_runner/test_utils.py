@@ -1,7 +1,10 @@
 # -*- coding: utf-8 -*-
 from unittest import TestCase
 
-from redash.query_runner import TYPE_DATETIME, TYPE_FLOAT, TYPE_INTEGER, TYPE_BOOLEAN, TYPE_STRING, guess_type
+import mock
+
+from redash.query_runner import (TYPE_DATETIME, TYPE_FLOAT, TYPE_INTEGER, TYPE_BOOLEAN, TYPE_STRING, ColumnTypeGuesser,
+                                 guess_type)
 
 
 class TestGuessType(TestCase):
@@ -32,3 +35,47 @@ class TestGuessType(TestCase):
 
     def test_detects_date(self):
         self.assertEqual(guess_type('2018-10-31'), TYPE_DATETIME)
+
+
+class TestColumnTypeGuesser(TestCase):
+    def test_guesses_types_of_columns(self):
+        guesser = ColumnTypeGuesser(range(5))
+        guesser.update([(1, 1.5, '2018-10-31', 'true', 'redash'), (2, 2.5, '2018-11-01', 'false', '42')])
+
+        self.assertEqual([TYPE_INTEGER, TYPE_FLOAT, TYPE_DATETIME, TYPE_BOOLEAN, TYPE_STRING], guesser.types)
+
+    def test_guesses_types_of_dict_rows(self):
+        guesser = ColumnTypeGuesser(['a', 'b'])
+        guesser.update([{'a': '1', 'b': 'x'}, {'a': 2}])
+
+        self.assertEqual([TYPE_INTEGER, TYPE_STRING], guesser.types)
+
+    def test_ignores_nulls(self):
+        guesser = ColumnTypeGuesser(range(2))
+        guesser.update([(1, None), (None, ''), (3, None)])
+
+        self.assertEqual([TYPE_INTEGER, TYPE_STRING], guesser.types)
+
+    def test_falls_back_to_string_across_batches(self):
+        guesser = ColumnTypeGuesser(range(1))
+        guesser.update([(1,), (2,)])
+        guesser.update([(3.5,)])
+
+        self.assertEqual([TYPE_STRING], guesser.types)
+        self.assertTrue(guesser.done)
+
+    def test_samples_rows(self):
+        guesser = ColumnTypeGuesser(range(1), sample_size=2)
+        guesser.update([(1,), (2,), ('redash',)])
+        guesser.update([('redash',)])
+
+        self.assertEqual([TYPE_INTEGER], guesser.types)
+        self.assertTrue(guesser.done)
+
+    def test_parses_each_distinct_string_once(self):
+        guesser = ColumnTypeGuesser(range(1))
+        with mock.patch('redash.query_runner.guess_type_from_string', return_value=TYPE_DATETIME) as guess:
+            guesser.update([('2018-10-31',)] * 100)
+
+        self.assertEqual(1, guess.call_count)
+        self.assertEqual([TYPE_DATETIME], guesser.types)
@@ -1,13 +1,21 @@
 from unittest import TestCase
 from collections import namedtuple
+import datetime
+import shutil
+import tempfile
 import uuid
 
 import mock
+from celery.exceptions import Retry
 
 from tests import BaseTestCase
-from redash import redis_connection, models
+from redash import fair_share, query_result_cache, redis_connection, models
+from redash.result_storage import get_result_storage
+from redash.utils import json_dumps, json_loads, utcnow
+from redash.utils.query_results import COMPACT_PREFIX
 from redash.query_runner.pg import PostgreSQL
-from redash.tasks.queries import QueryExecutionError, enqueue_query, execute_query
+from redash.tasks.queries import (COMPACT_QUERY_RESULTS_LAST_ID_KEY, QueryExecutionError, cleanup_query_results,
+                                  compact_query_results, enqueue_query, execute_query)
 
 
 FakeResult = namedtuple('FakeResult', 'id')
@@ -48,6 +56,53 @@ class TestEnqueueTask(BaseTestCase):
 
         self.assertEqual(3, execute_query.apply_async.call_count)
 
+    @mock.patch('redash.tasks.queries._result_key_prefix', return_value='celery-task-meta-')
+    def test_replaces_lock_of_finished_job(self, _):
+        query = self.factory.create_query()
+        execute_query.apply_async = mock.MagicMock(side_effect=gen_hash)
+
+        enqueue_query(query.query_text, query.data_source, query.user_id, False, None, {'Query ID': query.id})
+        _, kwargs = execute_query.apply_async.call_args
+        redis_connection.set('celery-task-meta-' + kwargs['task_id'], json_dumps({'status': 'SUCCESS'}))
+        enqueue_query(query.query_text, query.data_source, query.user_id, False, None, {'Query ID': query.id})
+
+        self.assertEqual(2, execute_query.apply_async.call_count)
+
+    @mock.patch('redash.tasks.queries._result_key_prefix', return_value='')
+    def test_replaces_lock_of_finished_job_without_result_backend_access(self, _):
+        query = self.factory.create_query()
+        execute_query.apply_async = mock.MagicMock(side_effect=gen_hash)
+
+        enqueue_query(query.query_text, query.data_source, query.user_id, False, None, {'Query ID': query.id})
+        with mock.patch('redash.tasks.queries.QueryTask.ready', return_value=True):
+            enqueue_query(query.query_text, query.data_source, query.user_id, False, None, {'Query ID': query.id})
+
+        self.assertEqual(2, execute_query.apply_async.call_count)
+
+    @mock.patch('redash.tasks.queries.statsd_client')
+    def test_counts_dedup_hits(self, statsd_client):
+        query = self.factory.create_query()
+        execute_query.apply_async = mock.MagicMock(side_effect=gen_hash)
+
+        enqueue_query(query.query_text, query.data_source, query.user_id, False, None, {'Query ID': query.id})
+        enqueue_query(query.query_text, query.data_source, query.user_id, False, None, {'Query ID': query.id})
+
+        statsd_client.incr.assert_has_calls([mock.call('enqueue_query.new_job'), mock.call('enqueue_query.dedup_hit')])
+
+    @mock.patch('redash.settings.QUERY_FAIR_SHARE_ENABLED', True)
+    @mock.patch('redash.settings.QUERY_FAIR_SHARE_MAX_DISPATCHED', 1)
+    def test_adhoc_queries_go_through_fair_share_queue(self):
+        execute_query.apply_async = mock.MagicMock(side_effect=gen_hash)
+        first = self.factory.create_query(query_text="SELECT 1")
+        second = self.factory.create_query(query_text="SELECT 2")
+
+        first_job = enqueue_query(first.query_text, first.data_source, first.user_id)
+        enqueue_query(second.query_text, second.data_source, second.user_id)
+
+        self.assertEqual(1, execute_query.apply_async.call_count)
+        self.assertEqual(first_job.id, execute_query.apply_async.call_args[1]['task_id'])
+        self.assertEqual(1, fair_share.get_status()['orgs'][0]['pending'])
+
 
 class QueryExecutorTests(BaseTestCase):
 
@@ -80,6 +135,7 @@ class QueryExecutorTests(BaseTestCase):
             self.assertEqual(q.schedule_failures, 0)
             result = models.QueryResult.query.get(result_id)
             self.assertEqual(q.latest_query_data, result)
+            self.assertTrue(utcnow() < q.next_run_at <= utcnow() + datetime.timedelta(seconds=300))
 
     def test_failure_scheduled(self):
         """
@@ -124,3 +180,97 @@ class QueryExecutorTests(BaseTestCase):
                           scheduled_query_id=q.id)
             q = models.Query.get_by_id(q.id)
             self.assertEqual(q.schedule_failures, 0)
+
+    @mock.patch('redash.settings.QUERY_RESULTS_STREAMING_ENABLED', True)
+    def test_success_streaming(self):
+        """
+        Runners that support streaming have their batches encoded incrementally.
+        """
+        cm = mock.patch("celery.app.task.Context.delivery_info", {'routing_key': 'test'})
+        columns = [{'name': 'a', 'friendly_name': 'a', 'type': 'integer'}]
+        batches = (batch for batch in [[{'a': 1}], [{'a': 2}]])
+        with cm, mock.patch.object(PostgreSQL, "run_query_iter") as qr:
+            qr.return_value = (columns, batches)
+            result_id = execute_query("SELECT 1", self.factory.data_source.id, {})
+            self.assertEqual(1, qr.call_count)
+            result = models.QueryResult.query.get(result_id)
+            self.assertEqual([{'a': 1}, {'a': 2}], json_loads(result.data)['rows'])
+
+    def test_deferred_when_data_source_is_busy(self):
+        """
+        Queries of a data source with all of its slots taken are retried later, instead of being executed.
+        """
+        cm = mock.patch("celery.app.task.Context.delivery_info", {'routing_key': 'test'})
+        data_source = self.factory.create_data_source(max_concurrent_queries=1)
+        data_source.acquire_query_slot('other-job', 60, 30)
+        with cm, mock.patch.object(PostgreSQL, "run_query") as qr:
+            qr.return_value = ([1, 2], None)
+            with self.assertRaises(Retry):
+                execute_query("SELECT 1, 2", data_source.id, {})
+            self.assertEqual(0, qr.call_count)
+            self.assertEqual(1, data_source.queries_waiting)
+
+    def test_releases_data_source_slot(self):
+        cm = mock.patch("celery.app.task.Context.delivery_info", {'routing_key': 'test'})
+        data_source = self.factory.create_data_source(max_concurrent_queries=1)
+        with cm, mock.patch.object(PostgreSQL, "run_query") as qr:
+            qr.side_effect = ValueError("broken")
+            with self.assertRaises(QueryExecutionError):
+                execute_query("SELECT 1, 2", data_source.id, {})
+            qr.side_effect = None
+            qr.return_value = ([1, 2], None)
+            execute_query("SELECT 1, 2", data_source.id, {})
+            self.assertEqual(2, qr.call_count)
+            self.assertEqual(0, data_source.queries_in_flight)
+
+
+class TestCompactQueryResults(BaseTestCase):
+    def test_converts_legacy_results(self):
+        data = {'columns': [{'name': 'a', 'type': 'integer'}], 'rows': [{'a': 1}]}
+        qr = self.factory.create_query_result(data=json_dumps(data))
+        unparsable = self.factory.create_query_result(data='{1,2}')
+        models.db.session.commit()
+
+        compact_query_results()
+
+        self.assertTrue(models.QueryResult.query.get(qr.id).data.startswith(COMPACT_PREFIX))
+        self.assertEqual(data, models.QueryResult.query.get(qr.id).get_data())
+        self.assertEqual('{1,2}', models.QueryResult.query.get(unparsable.id).data)
+        self.assertEqual(str(unparsable.id), redis_connection.get(COMPACT_QUERY_RESULTS_LAST_ID_KEY))
+
+
+class TestCleanupQueryResults(BaseTestCase):
+    def test_deletes_external_results_of_unused_query_results(self):
+        storage_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, storage_dir)
+        two_weeks_ago = utcnow() - datetime.timedelta(days=14)
+
+        with mock.patch('redash.settings.QUERY_RESULTS_STORAGE_URL', 'file://' + storage_dir):
+            storage = get_result_storage()
+            storage.put('1/unused', b'{}')
+            storage.put('1/used', b'{}')
+            unused_qr = self.factory.create_query_result(retrieved_at=two_weeks_ago, data=None, data_key='1/unused')
+            used_qr = self.factory.create_query_result(retrieved_at=two_weeks_ago, data=None, data_key='1/used')
+            self.factory.create_query(latest_query_data=used_qr)
+            models.db.session.commit()
+
+            cleanup_query_results()
+
+            self.assertIsNone(models.QueryResult.query.get(unused_qr.id))
+            self.assertRaises(IOError, storage.get, '1/unused')
+            self.assertEqual(b'{}', storage.get('1/used'))
+
+    @mock.patch('redash.settings.QUERY_RESULTS_CACHE_SIZE', 1024)
+    def test_removes_cached_unused_query_results(self):
+        two_weeks_ago = utcnow() - datetime.timedelta(days=14)
+        unused_qr = self.factory.create_query_result(retrieved_at=two_weeks_ago)
+        used_qr = self.factory.create_query_result(retrieved_at=two_weeks_ago)
+        self.factory.create_query(latest_query_data=used_qr)
+        models.db.session.commit()
+        query_result_cache.put(unused_qr.id, 'full', '{}')
+        query_result_cache.put(used_qr.id, 'full', '{}')
+
+        cleanup_query_results()
+
+        self.assertIsNone(query_result_cache.get(unused_qr.id, 'full'))
+        self.assertEqual(b'{}', query_result_cache.get(used_qr.id, 'full'))
@@ -6,7 +6,9 @@ from tests import BaseTestCase
 from redash.utils.configuration import ConfigurationContainer
 from redash.query_runner import query_runners
 from redash.cli import manager
-from redash.models import DataSource, Group, Organization, User, db
+from redash.models import DataSource, Group, Organization, QueryResult, User, db
+from redash.utils import json_dumps, json_loads
+from redash.utils.query_results import COMPRESSED_PREFIX
 
 
 class DataSourceCommandTests(BaseTestCase):
@@ -479,3 +481,36 @@ class UserCommandTests(BaseTestCase):
         db.session.add(u)
         self.assertEqual(u.group_ids, [u.org.default_group.id,
                                        u.org.admin_group.id])
+
+
+class DatabaseCommandTests(BaseTestCase):
+    @mock.patch('redash.settings.QUERY_RESULTS_COMPRESSION_THRESHOLD', 10)
+    def test_compress_query_results(self):
+        data = json_dumps({'columns': [{'name': 'a'}], 'rows': [{'a': i} for i in range(100)]})
+        large = self.factory.create_query_result(data=data)
+        small = self.factory.create_query_result(data='{}')
+        db.session.commit()
+
+        runner = CliRunner()
+        result = runner.invoke(manager, ['database', 'compress_query_results', '--chunk-size', '1'])
+        self.assertFalse(result.exception)
+        self.assertEqual(result.exit_code, 0)
+
+        large = QueryResult.query.get(large.id)
+        self.assertTrue(large.data.startswith(COMPRESSED_PREFIX))
+        self.assertEqual(json_loads(data), large.get_data())
+        self.assertEqual('{}', QueryResult.query.get(small.id).data)
+
+
+class QueriesCommandTests(BaseTestCase):
+    def test_schedule_report(self):
+        self.factory.create_query(schedule={'interval': '600', 'until': None, 'time': None, 'day_of_week': None})
+        runner = CliRunner()
+        result = runner.invoke(manager, ['queries', 'schedule_report', '--minutes', '60', '--jitter-window', '300'])
+
+        self.assertFalse(result.exception)
+        self.assertEqual(result.exit_code, 0)
+        lines = result.output.strip().split('\n')
+        self.assertEqual(61, len(lines))
+        # depending on the query's offset, its first run is 5 to 15 minutes from now
+        self.assertRegexpMatches(lines[-1], r'^Total: [56], peak: 1 per minute\.$')
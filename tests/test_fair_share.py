@@ -0,0 +1,98 @@
+import mock
+
+from tests import BaseTestCase
+from redash import fair_share
+
+
+class TestFairShare(BaseTestCase):
+    def take_all(self):
+        jobs = []
+        while True:
+            job = fair_share.take_job()
+            if job is None:
+                return jobs
+            jobs.append((job['org_id'], job['job_id']))
+
+    def test_serves_organizations_in_turns(self):
+        for i in range(3):
+            fair_share.push_job(1, 'a{}'.format(i), 0)
+        fair_share.push_job(2, 'b0', 0)
+        fair_share.push_job(2, 'b1', 0)
+
+        self.assertEqual([(1, 'a0'), (2, 'b0'), (1, 'a1'), (2, 'b1'), (1, 'a2')], self.take_all())
+
+    def test_keeps_the_arguments_of_the_job(self):
+        fair_share.push_job(1, 'a', 0, args=['SELECT 1', 1], queue='queries')
+
+        job = fair_share.take_job()
+        self.assertEqual(['SELECT 1', 1], job['args'])
+        self.assertEqual('queries', job['queue'])
+
+    def test_holds_jobs_over_quota(self):
+        for i in range(3):
+            fair_share.push_job(1, 'a{}'.format(i), 2)
+        fair_share.push_job(2, 'b0', 2)
+
+        self.assertEqual([(1, 'a0'), (2, 'b0'), (1, 'a1')], self.take_all())
+
+        fair_share.release_job(1, 'a0')
+        self.assertEqual([(1, 'a2')], self.take_all())
+
+    @mock.patch('redash.settings.QUERY_FAIR_SHARE_MAX_DISPATCHED', 1)
+    def test_limits_dispatched_jobs(self):
+        fair_share.push_job(1, 'a', 0)
+        fair_share.push_job(2, 'b', 0)
+
+        self.assertEqual([(1, 'a')], self.take_all())
+        fair_share.release_job(1, 'a')
+        self.assertEqual([(2, 'b')], self.take_all())
+
+    def test_dispatched_jobs_count_for_their_time_limit(self):
+        fair_share.push_job(1, 'a0', 1, soft_time_limit=60)
+        fair_share.push_job(1, 'a1', 1, soft_time_limit=60)
+
+        with mock.patch('time.time', return_value=1000):
+            self.assertEqual([(1, 'a0')], self.take_all())
+        with mock.patch('time.time', return_value=1000 + 60 + fair_share.DISPATCH_LEASE_MARGIN - 1):
+            self.assertEqual([], self.take_all())
+        with mock.patch('time.time', return_value=1000 + 60 + fair_share.DISPATCH_LEASE_MARGIN + 1):
+            self.assertEqual([(1, 'a1')], self.take_all())
+
+    def test_renewed_jobs_keep_counting(self):
+        fair_share.push_job(1, 'a0', 1, soft_time_limit=60)
+        fair_share.push_job(1, 'a1', 1, soft_time_limit=60)
+
+        with mock.patch('time.time', return_value=1000):
+            self.assertEqual([(1, 'a0')], self.take_all())
+        with mock.patch('time.time', return_value=1500):
+            fair_share.renew_job(1, 'a0', 3600)
+        with mock.patch('time.time', return_value=1500 + 3600 - 1):
+            self.assertEqual([], self.take_all())
+
+    def test_returned_job_goes_first(self):
+        fair_share.push_job(1, 'a0', 0)
+        fair_share.push_job(1, 'a1', 0)
+        fair_share.push_job(2, 'b0', 0)
+
+        fair_share.return_job(fair_share.take_job())
+
+        self.assertEqual([(1, 'a0'), (2, 'b0'), (1, 'a1')], self.take_all())
+
+    def test_reports_wait_percentiles(self):
+        with mock.patch('time.time', return_value=1000):
+            for i in range(10):
+                fair_share.push_job(1, 'a{}'.format(i), 3)
+
+        for i in range(10):
+            with mock.patch('time.time', return_value=1001 + i):
+                fair_share.take_job()
+                fair_share.release_job(1, 'a{}'.format(i))
+
+        status = fair_share.get_status()
+        org = status['orgs'][0]
+        self.assertEqual(1, org['org_id'])
+        self.assertEqual(3, org['quota'])
+        self.assertEqual(0, org['pending'])
+        self.assertEqual(5.0, org['wait_p50'])
+        self.assertEqual(9.0, org['wait_p90'])
+        self.assertEqual(10.0, org['wait_p99'])
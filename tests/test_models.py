@@ -3,6 +3,7 @@ import calendar
 import datetime
 from unittest import TestCase
 
+import mock
 import pytz
 from dateutil.parser import parse as date_parse
 from tests import BaseTestCase
@@ -137,6 +138,43 @@ class ShouldScheduleNextTest(TestCase):
         self.assertFalse(models.should_schedule_next(two_hours_ago, now, "3600", failures=32))
 
 
+class ScheduleJitterTest(TestCase):
+    def test_schedule_offset(self):
+        self.assertIsNone(models.schedule_offset(1, 0))
+        offsets = [models.schedule_offset(query_id, 600) for query_id in range(1, 101)]
+        self.assertEqual(offsets, [models.schedule_offset(query_id, 600) for query_id in range(1, 101)])
+        self.assertTrue(all(0 <= offset < 600 for offset in offsets))
+        # consecutive ids are spread across the window
+        self.assertGreater(len(set(offset // 60 for offset in offsets)), 5)
+
+    def test_interval_schedule_runs_at_its_offset(self):
+        previous = datetime.datetime(2019, 1, 1, 10, 0, 20, tzinfo=pytz.utc)
+        next_run_at = models.compute_next_run_at(previous, "3600", offset=600)
+        self.assertEqual(datetime.datetime(2019, 1, 1, 11, 10, tzinfo=pytz.utc), next_run_at)
+
+        # later runs keep their phase
+        next_run_at = models.compute_next_run_at(next_run_at, "3600", offset=600)
+        self.assertEqual(datetime.datetime(2019, 1, 1, 12, 10, tzinfo=pytz.utc), next_run_at)
+
+    def test_interval_schedule_never_runs_early(self):
+        previous = datetime.datetime(2019, 1, 1, 11, 10, 25, tzinfo=pytz.utc)
+        next_run_at = models.compute_next_run_at(previous, "3600", offset=600)
+        self.assertEqual(datetime.datetime(2019, 1, 1, 13, 10, tzinfo=pytz.utc), next_run_at)
+
+    def test_offset_is_capped_to_interval(self):
+        previous = datetime.datetime(2019, 1, 1, 10, 0, 0, tzinfo=pytz.utc)
+        next_run_at = models.compute_next_run_at(previous, "60", offset=90)
+        self.assertEqual(datetime.datetime(2019, 1, 1, 10, 1, 30, tzinfo=pytz.utc), next_run_at)
+
+    def test_time_schedule_runs_after_its_offset(self):
+        now = utcnow()
+        yesterday = now - datetime.timedelta(days=1)
+        schedule = (now - datetime.timedelta(minutes=5)).strftime("%H:%M")
+
+        self.assertTrue(models.should_schedule_next(yesterday, now, "86400", schedule, offset=60))
+        self.assertFalse(models.should_schedule_next(yesterday, now, "86400", schedule, offset=600))
+
+
 class QueryOutdatedQueriesTest(BaseTestCase):
     # TODO: this test can be refactored to use mock version of should_schedule_next to simplify it.
     def test_outdated_queries_skips_unscheduled_queries(self):
@@ -287,6 +325,44 @@ class QueryOutdatedQueriesTest(BaseTestCase):
         queries = models.Query.outdated_queries()
         self.assertIn(query, queries)
 
+    def test_outdated_queries_skips_queries_not_due_yet(self):
+        two_hours_ago = utcnow() - datetime.timedelta(hours=2)
+        query = self.factory.create_query(schedule={'interval':'3600', 'until':None, 'time': None, 'day_of_week':None})
+        query_result = self.factory.create_query_result(query=query.query_text, retrieved_at=two_hours_ago)
+        query.latest_query_data = query_result
+        query.next_run_at = utcnow() + datetime.timedelta(minutes=10)
+
+        queries = models.Query.outdated_queries()
+        self.assertNotIn(query, queries)
+
+    def test_schedule_change_resets_next_run_at(self):
+        query = self.factory.create_query(schedule={'interval':'3600', 'until':None, 'time': None, 'day_of_week':None})
+        query.next_run_at = utcnow() + datetime.timedelta(hours=1)
+
+        query.schedule = {'interval':'60', 'until':None, 'time': None, 'day_of_week':None}
+        self.assertLessEqual(query.next_run_at, utcnow())
+
+    def test_outdated_queries_only_loads_runnable_schedules(self):
+        yesterday = (utcnow() - datetime.timedelta(days=1)).strftime('%Y-%m-%d')
+        query = self.factory.create_query(schedule={'interval':'3600', 'until':None, 'time': None, 'day_of_week':None})
+        self.factory.create_query(schedule={'interval':None, 'until':None, 'time': None, 'day_of_week':None})
+        self.factory.create_query(schedule={'interval':'3600', 'until':yesterday, 'time': None, 'day_of_week':None})
+
+        with mock.patch.object(models.scheduled_queries_executions, 'refresh') as refresh:
+            models.Query.outdated_queries()
+
+        refresh.assert_called_once_with([query.id])
+
+    def test_outdated_queries_stores_next_run_at_of_queries_not_due(self):
+        half_an_hour_ago = utcnow() - datetime.timedelta(minutes=30)
+        query = self.factory.create_query(schedule={'interval':'3600', 'until':None, 'time': None, 'day_of_week':None})
+        query_result = self.factory.create_query_result(query=query.query_text, retrieved_at=half_an_hour_ago)
+        query.latest_query_data = query_result
+
+        self.assertNotIn(query, models.Query.outdated_queries())
+        db.session.expire(query, ['next_run_at'])
+        self.assertEqual(half_an_hour_ago + datetime.timedelta(hours=1), query.next_run_at)
+
 
 class QueryArchiveTest(BaseTestCase):
     def test_archive_query_sets_flag(self):
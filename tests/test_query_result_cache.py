@@ -0,0 +1,68 @@
+import mock
+
+from tests import BaseTestCase
+from redash import query_result_cache, redis_connection
+
+
+@mock.patch('redash.settings.QUERY_RESULTS_CACHE_SIZE', 100)
+class TestQueryResultCache(BaseTestCase):
+    def test_returns_cached_value(self):
+        self.assertIsNone(query_result_cache.get(1, 'full'))
+
+        query_result_cache.put(1, 'full', u'{"a": 1}')
+
+        self.assertEqual(b'{"a": 1}', query_result_cache.get(1, 'full'))
+        self.assertIsNone(query_result_cache.get(1, 'public'))
+
+    @mock.patch('redash.settings.QUERY_RESULTS_CACHE_SIZE', 0)
+    def test_disabled(self):
+        query_result_cache.put(1, 'full', '{}')
+
+        self.assertIsNone(query_result_cache.get(1, 'full'))
+
+    def test_evicts_least_recently_used_entries(self):
+        with mock.patch('time.time', return_value=1):
+            query_result_cache.put(1, 'full', 'a' * 40)
+        with mock.patch('time.time', return_value=2):
+            query_result_cache.put(2, 'full', 'b' * 40)
+        with mock.patch('time.time', return_value=3):
+            query_result_cache.get(1, 'full')
+        with mock.patch('time.time', return_value=4):
+            query_result_cache.put(3, 'full', 'c' * 40)
+
+        self.assertIsNotNone(query_result_cache.get(1, 'full'))
+        self.assertIsNone(query_result_cache.get(2, 'full'))
+        self.assertIsNotNone(query_result_cache.get(3, 'full'))
+        self.assertEqual(80, int(redis_connection.get(query_result_cache.SIZE_KEY)))
+
+    def test_replacing_an_entry_keeps_its_size(self):
+        query_result_cache.put(1, 'full', 'a' * 40)
+        query_result_cache.put(1, 'full', 'a' * 30)
+
+        self.assertEqual(30, int(redis_connection.get(query_result_cache.SIZE_KEY)))
+
+    @mock.patch('redash.settings.QUERY_RESULTS_CACHE_MAX_ITEM_SIZE', 10)
+    def test_skips_large_values(self):
+        query_result_cache.put(1, 'full', 'a' * 11)
+
+        self.assertIsNone(query_result_cache.get(1, 'full'))
+
+    def test_deletes_all_variants(self):
+        query_result_cache.put(1, 'full', 'a')
+        query_result_cache.put(1, 'public', 'b')
+        query_result_cache.put(2, 'full', 'c')
+
+        query_result_cache.delete([1])
+
+        self.assertIsNone(query_result_cache.get(1, 'full'))
+        self.assertIsNone(query_result_cache.get(1, 'public'))
+        self.assertEqual(b'c', query_result_cache.get(2, 'full'))
+        self.assertEqual(1, int(redis_connection.get(query_result_cache.SIZE_KEY)))
+
+    @mock.patch('redash.query_result_cache.statsd_client')
+    def test_counts_hits_and_misses(self, statsd_client):
+        query_result_cache.get(1, 'full')
+        query_result_cache.put(1, 'full', '{}')
+        query_result_cache.get(1, 'full')
+
+        statsd_client.incr.assert_has_calls([mock.call('query_result_cache.miss'), mock.call('query_result_cache.hit')])
@@ -0,0 +1,63 @@
+import shutil
+import tempfile
+from io import BytesIO
+from unittest import TestCase
+
+import mock
+
+from redash.result_storage import (FileSystemResultStorage, ResultStorageError, delete_results, get_result,
+                                   get_result_storage, put_result)
+
+
+class TestFileSystemResultStorage(TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.storage = FileSystemResultStorage('file://' + self.root)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_put_get_and_delete(self):
+        self.storage.put('1/abc', b'{"rows": []}')
+        self.assertEqual(b'{"rows": []}', self.storage.get('1/abc'))
+
+        self.storage.delete('1/abc')
+        self.assertRaises(IOError, self.storage.get, '1/abc')
+
+    def test_delete_missing_blob(self):
+        self.storage.delete('1/missing')
+
+
+class TestResultStorage(TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        patcher = mock.patch('redash.settings.QUERY_RESULTS_STORAGE_URL', 'file://' + self.root)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_not_configured(self):
+        with mock.patch('redash.settings.QUERY_RESULTS_STORAGE_URL', ''):
+            self.assertIsNone(get_result_storage())
+
+    def test_unsupported_scheme(self):
+        with mock.patch('redash.settings.QUERY_RESULTS_STORAGE_URL', 'ftp://example.com/results'):
+            self.assertRaises(ResultStorageError, get_result_storage)
+
+    def test_round_trip(self):
+        key, content_hash, size = put_result(1, b'{"rows": []}')
+
+        self.assertEqual(12, size)
+        self.assertEqual(b'{"rows": []}', get_result(key, content_hash))
+        self.assertRaises(ResultStorageError, get_result, key, '0' * 64)
+
+        delete_results([key])
+        self.assertRaises(IOError, get_result, key)
+
+    def test_round_trip_of_file(self):
+        key, content_hash, size = put_result(1, BytesIO(b'{"rows": []}'))
+
+        self.assertEqual((content_hash, size), put_result(1, b'{"rows": []}')[1:])
+        self.assertEqual(b'{"rows": []}', get_result(key, content_hash))
@@ -1,8 +1,11 @@
+import datetime
+import decimal
+import uuid
 from collections import namedtuple
 from unittest import TestCase
 
 from redash.utils import (build_url, collect_parameters_from_request,
-                          filter_none, json_dumps, generate_token)
+                          filter_none, json_dumps, json_loads, json_normalize, generate_token)
 
 try:
     buffer
@@ -52,6 +55,35 @@ class TestJsonDumps(TestCase):
         self.assertEqual(json_dumps(buffer("test")), '"74657374"')
 
 
+class TestJsonNormalize(TestCase):
+    def test_matches_json_round_trip(self):
+        value = {
+            'datetime': datetime.datetime(2019, 5, 26, 12, 39, 23, 26000),
+            'date': datetime.date(2019, 5, 26),
+            'decimal': decimal.Decimal('1.5'),
+            'uuid': uuid.UUID('12345678123456781234567812345678'),
+            'nested': [{'a': (1, u'b', None, True)}, 2.5],
+        }
+
+        self.assertEqual(json_loads(json_dumps(value)), json_normalize(value))
+
+    def test_ignores_nan(self):
+        self.assertEqual([None, 1.0], json_normalize([float('nan'), 1.0], ignore_nan=True))
+
+    def test_matches_json_round_trip_of_each_value(self):
+        values = [
+            b'caf\xc3\xa9',
+            {1: 'a', 2.5: 'b', False: 'c', None: 'd', b'k': 'e', u'\xe9': b'f'},
+            [decimal.Decimal('0.1'), decimal.Decimal('10')],
+            [datetime.datetime(2019, 5, 26, 12, 39, 23, 26000), datetime.date(2019, 5, 26)],
+            [float('nan'), float('inf'), 1.0],
+        ]
+
+        for value in values:
+            expected = json_loads(json_dumps(value, ignore_nan=True))
+            self.assertEqual(expected, json_normalize(value, ignore_nan=True))
+
+
 class TestGenerateToken(TestCase):
     def test_format(self):
         token = generate_token(40)
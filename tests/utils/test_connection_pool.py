@@ -0,0 +1,120 @@
+from unittest import TestCase
+
+import mock
+
+from redash.utils import connection_pool
+from redash.utils.connection_pool import ConnectionPool, close_pools, get_pool
+
+
+class FakeConnection(object):
+    def __init__(self):
+        self.closed = False
+        self.healthy = True
+
+    def close(self):
+        self.closed = True
+
+
+def check(connection):
+    if not connection.healthy:
+        raise Exception("connection lost")
+
+
+class TestConnectionPool(TestCase):
+    def setUp(self):
+        self.pool = ConnectionPool(FakeConnection, max_size=2, idle_timeout=60, check=check)
+
+    def test_reuses_released_connections(self):
+        connection = self.pool.acquire()
+        self.pool.release(connection)
+
+        self.assertIs(connection, self.pool.acquire())
+
+    def test_discards_connections_failing_health_check(self):
+        connection = self.pool.acquire()
+        self.pool.release(connection)
+        connection.healthy = False
+
+        self.assertIsNot(connection, self.pool.acquire())
+        self.assertTrue(connection.closed)
+
+    def test_discards_connections_failing_reset(self):
+        reset = mock.Mock(side_effect=Exception("reset failed"))
+        pool = ConnectionPool(FakeConnection, max_size=2, idle_timeout=60, reset=reset)
+        connection = pool.acquire()
+        pool.release(connection)
+
+        reset.assert_called_once_with(connection)
+        self.assertTrue(connection.closed)
+        self.assertEqual(0, len(pool))
+
+    def test_release_with_discard(self):
+        connection = self.pool.acquire()
+        self.pool.release(connection, discard=True)
+
+        self.assertTrue(connection.closed)
+        self.assertEqual(0, len(self.pool))
+
+    def test_keeps_at_most_max_size_connections(self):
+        connections = [self.pool.acquire() for _ in range(3)]
+        for connection in connections:
+            self.pool.release(connection)
+
+        self.assertEqual(2, len(self.pool))
+        self.assertTrue(connections[2].closed)
+
+    def test_closes_idle_connections(self):
+        connection = self.pool.acquire()
+        with mock.patch('time.time', return_value=0):
+            self.pool.release(connection)
+
+        self.assertIsNot(connection, self.pool.acquire())
+        self.assertTrue(connection.closed)
+
+
+def create_pool():
+    return ConnectionPool(FakeConnection, 1, 60)
+
+
+class TestGetPool(TestCase):
+    def tearDown(self):
+        close_pools()
+
+    def test_returns_same_pool_for_same_configuration(self):
+        self.assertIs(get_pool('ds', 'config', create_pool), get_pool('ds', 'config', create_pool))
+
+    def test_replaces_pool_when_configuration_changes(self):
+        pool = get_pool('ds', 'config', create_pool)
+        connection = pool.acquire()
+        pool.release(connection)
+
+        new_pool = get_pool('ds', 'new config', create_pool)
+
+        self.assertIsNot(pool, new_pool)
+        self.assertTrue(pool.closed)
+        self.assertTrue(connection.closed)
+
+    def test_doesnt_reuse_pool_of_another_process(self):
+        pool = get_pool('ds', 'config', create_pool)
+        connection = pool.acquire()
+        pool.release(connection)
+
+        with mock.patch.object(connection_pool.os, 'getpid', return_value=-1):
+            self.assertIsNot(pool, get_pool('ds', 'config', create_pool))
+
+        self.assertFalse(connection.closed)
+
+    def test_closes_unused_pools(self):
+        unused = get_pool('ds', 'config', create_pool)
+        in_use = get_pool('other ds', 'config', create_pool)
+        connection = unused.acquire()
+        with mock.patch('time.time', return_value=0):
+            unused.release(connection)
+            in_use.acquire()
+
+        get_pool('another ds', 'config', create_pool)
+
+        self.assertTrue(unused.closed)
+        self.assertTrue(connection.closed)
+        self.assertFalse(in_use.closed)
+        self.assertIsNot(unused, get_pool('ds', 'config', create_pool))
@@ -0,0 +1,174 @@
+from unittest import TestCase
+
+from redash.utils import json_dumps, json_loads
+from redash.utils.query_results import (COMPACT_PREFIX, COMPRESSED_PREFIX, ColumnNotFound, ResultWriter,
+                                        compact_result, compress_result, decode_result, decompress_result, iter_rows,
+                                        load_result_lazily, slice_result)
+
+legacy_data = {
+    'columns': [{'name': 'a', 'friendly_name': 'a', 'type': 'integer'},
+                {'name': 'b', 'friendly_name': 'b', 'type': 'string'}],
+    'rows': [{'a': 1, 'b': 'x'}, {'a': 2}, {'a': 3, 'b': 'z'}],
+    'log': ['line'],
+}
+
+
+class TestResultWriter(TestCase):
+    def test_writes_rows_in_batches(self):
+        with ResultWriter([{'name': 'a'}], compact=False) as writer:
+            writer.write_rows([{'a': 1}, {'a': 2}])
+            writer.write_rows([])
+            writer.write_rows([{'a': 3}])
+            writer.finish([{'name': 'a', 'friendly_name': 'a', 'type': 'integer'}])
+            data = json_loads(writer.getvalue())
+
+        self.assertEqual([{'a': 1}, {'a': 2}, {'a': 3}], data['rows'])
+        self.assertEqual('a', data['columns'][0]['name'])
+        self.assertEqual(3, writer.row_count)
+
+    def test_writes_empty_result(self):
+        with ResultWriter([], compact=False) as writer:
+            writer.finish([])
+            data = json_loads(writer.getvalue())
+
+        self.assertEqual({'rows': [], 'columns': []}, data)
+
+    def test_refuses_to_read_unfinished_result(self):
+        with ResultWriter([{'name': 'a'}]) as writer:
+            writer.write_rows([{'a': 1}])
+            self.assertRaises(ValueError, writer.getvalue)
+
+
+class TestCompactFormat(TestCase):
+    def test_compacts_legacy_result(self):
+        compacted = compact_result(json_dumps(legacy_data))
+        self.assertTrue(compacted.startswith(COMPACT_PREFIX))
+
+        data = json_loads(compacted)
+        self.assertEqual([1, 'x'], data['rows'][0])
+        # rows that don't match the columns are kept as objects
+        self.assertEqual({'a': 2}, data['rows'][1])
+
+    def test_decodes_to_legacy_result(self):
+        data = json_loads(compact_result(json_dumps(legacy_data)))
+        self.assertEqual(legacy_data, decode_result(data))
+
+    def test_decodes_legacy_result_as_is(self):
+        self.assertEqual(legacy_data, decode_result(legacy_data))
+        self.assertEqual(legacy_data['rows'], list(iter_rows(legacy_data)))
+
+    def test_leaves_other_payloads_unchanged(self):
+        for text in ['', '{1,2}', json_dumps({}), json_dumps([1, 2])]:
+            self.assertEqual(text, compact_result(text))
+
+    def test_compacts_only_once(self):
+        compacted = compact_result(json_dumps(legacy_data))
+        self.assertIs(compacted, compact_result(compacted))
+
+
+class TestLoadResultLazily(TestCase):
+    def test_decodes_rows_as_they_are_iterated(self):
+        data = load_result_lazily(compact_result(json_dumps(legacy_data)))
+
+        self.assertEqual(legacy_data['columns'], data['columns'])
+        self.assertEqual(['line'], data['log'])
+        self.assertFalse(isinstance(data['rows'], list))
+        self.assertEqual(legacy_data['rows'], list(iter_rows(data)))
+
+    def test_reads_rows_written_in_batches(self):
+        with ResultWriter([{'name': 'a'}], compact=True) as writer:
+            writer.write_rows([{'a': '], "columns": '}, {'a': [1, 2]}])
+            writer.write_rows([{'a': 3}])
+            writer.finish([{'name': 'a'}], extra={'x': [1], 'columns': []})
+            data = load_result_lazily(writer.getvalue())
+
+        self.assertEqual([{'name': 'a'}], data['columns'])
+        self.assertEqual({'x': [1], 'columns': []}, data['extra'])
+        self.assertEqual([['], "columns": '], [[1, 2]], [3]], list(data['rows']))
+
+    def test_reads_empty_result(self):
+        with ResultWriter([], compact=True) as writer:
+            writer.finish([])
+            data = load_result_lazily(writer.getvalue())
+
+        self.assertEqual([], data['columns'])
+        self.assertEqual([], list(data['rows']))
+
+    def test_decodes_legacy_rows_as_they_are_iterated(self):
+        text = '{"rows": [{"a": [1], "b": "x"}, {"a": 2}], "log": ["line"], "columns": [{"name": "a"}, {"name": "b"}]}'
+        data = load_result_lazily(text)
+
+        self.assertEqual([{'name': 'a'}, {'name': 'b'}], data['columns'])
+        self.assertNotIn('version', data)
+        self.assertEqual([{'a': [1], 'b': 'x'}, {'a': 2}], list(iter_rows(data)))
+        # It comes before the columns, so it's only parsed along with the rows.
+        self.assertEqual(['line'], data['log'])
+
+    def test_parses_other_results_in_full(self):
+        for text in ('{"columns": [{"name": "a"}], "rows": [{"a": 1}]}', '{"rows": [{"a": 1}]}'):
+            self.assertEqual(json_loads(text), load_result_lazily(text))
+
+
+class TestSliceResult(TestCase):
+    def test_slices_rows_in_either_format(self):
+        compact_data = json_loads(compact_result(json_dumps(legacy_data)))
+
+        for data in (legacy_data, compact_data):
+            page = slice_result(data, offset=1, limit=1)
+            self.assertEqual([{'a': 2}], page['rows'])
+            self.assertEqual(legacy_data['columns'], page['columns'])
+            self.assertEqual(3, page['total_rows'])
+            self.assertEqual(['line'], page['log'])
+            self.assertNotIn('version', page)
+
+    def test_slices_lazily_loaded_rows(self):
+        legacy_text = '{{"rows": {}, "log": ["line"], "columns": {}}}'.format(
+            json_dumps(legacy_data['rows']), json_dumps(legacy_data['columns']))
+        for text in (legacy_text, compact_result(json_dumps(legacy_data))):
+            data = load_result_lazily(text)
+            self.assertFalse(isinstance(data['rows'], list))
+
+            page = slice_result(data, offset=1, limit=1)
+            self.assertEqual([{'a': 2}], page['rows'])
+            self.assertEqual(3, page['total_rows'])
+            self.assertEqual(['line'], page['log'])
+
+        page = slice_result(load_result_lazily(legacy_text), offset=10)
+        self.assertEqual([], page['rows'])
+        self.assertEqual(3, page['total_rows'])
+
+    def test_without_limit_returns_remaining_rows(self):
+        self.assertEqual(legacy_data['rows'][1:], slice_result(legacy_data, offset=1)['rows'])
+        self.assertEqual([], slice_result(legacy_data, offset=10)['rows'])
+
+    def test_projects_columns(self):
+        data = json_loads(compact_result(json_dumps(legacy_data)))
+
+        page = slice_result(data, columns=['b'])
+        self.assertEqual([legacy_data['columns'][1]], page['columns'])
+        self.assertEqual([{'b': 'x'}, {}, {'b': 'z'}], page['rows'])
+
+    def test_unknown_column(self):
+        self.assertRaises(ColumnNotFound, slice_result, legacy_data, columns=['c'])
+
+
+class TestCompression(TestCase):
+    def test_round_trips(self):
+        text = json_dumps(legacy_data)
+        compressed = compress_result(text)
+
+        self.assertTrue(compressed.startswith(COMPRESSED_PREFIX))
+        self.assertEqual(text, decompress_result(compressed))
+
+    def test_returns_uncompressed_result_as_is(self):
+        text = json_dumps(legacy_data)
+        self.assertIs(text, decompress_result(text))
+
+    def test_compresses_streamed_result(self):
+        with ResultWriter([{'name': 'a'}], compact=False) as writer:
+            writer.write_rows(legacy_data['rows'])
+            writer.finish(legacy_data['columns'])
+            compressed = compress_result(writer)
+            self.assertEqual(compress_result(writer.getvalue()), compressed)
+
+        self.assertEqual(legacy_data['rows'], json_loads(decompress_result(compressed))['rows'])
@@ -0,0 +1,22 @@
+import time
+
+import pytest
+
+from redash.utils.threads import map_in_threads
+from tests import BaseTestCase
+
+
+class TestMapInThreads(BaseTestCase):
+    def test_returns_results_in_order(self):
+        def double(value):
+            time.sleep(0.1 * (3 - value))
+            return value * 2
+
+        self.assertEqual([0, 2, 4], map_in_threads(double, range(3), 3))
+
+    def test_raises_first_error(self):
+        def fail(value):
+            raise ValueError(value)
+
+        with pytest.raises(ValueError):
+            map_in_threads(fail, range(3), 2)